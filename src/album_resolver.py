@@ -0,0 +1,179 @@
+# Expands imgur albums and galleries into the urls of their images with the imgur API, so the images go through
+# the normal concurrent download path instead of the slow and heavily throttled server-side album zips.
+#
+# The API needs a client id, read from the IMGUR_CLIENT_ID environment variable. The base url of the API can be
+# changed with IMGUR_API_URL, e.g. to point it to a stand-in server.
+# The manifests (the image urls of each album) are cached in SQLite: albums rarely change, so a restarted job
+# does not spend its API quota resolving them again. Albums the API does not know are cached as missing for a while.
+# When an album cannot be resolved (no client id, throttled, server error) the caller falls back to the zip.
+
+import json
+import os
+import sqlite3
+import time
+
+
+DEFAULT_API_URL = 'https://api.imgur.com/3'
+DEFAULT_CACHE_PATH = './data/album_manifests.sqlite'
+# Number of seconds an album missing from the API is trusted
+MISSING_TTL = 30 * 86400
+
+
+def get_album_id(download_url):
+    """
+    Get the id of the album of a downloadable album url
+
+    :param download_url: A url returned by imgur.transform_imgur_url_for_download
+    :return: The album id, or None if the url is not an album zip url
+    """
+    if not download_url.endswith('/zip'):
+        return None
+    return download_url[:-len('/zip')].rstrip('/').rpartition('/')[2] or None
+
+
+def get_image_url(image):
+    """
+    Get the downloadable url of an image of the imgur API
+
+    :param image: The image dictionary of the API
+    :return: The url, the mp4 version of animated images
+    """
+    return image.get('mp4') or image['link']
+
+
+class ManifestCache:
+    """
+    SQLite table {album id: image urls, fetch time}, the image urls are NULL for a missing album
+    """
+
+    def __init__(self, cache_path=DEFAULT_CACHE_PATH, missing_ttl=MISSING_TTL):
+        """
+        :param cache_path: The path of the SQLite database
+        :param missing_ttl: The number of seconds an album missing from the API is trusted
+        """
+        self.cache_path = cache_path
+        self.missing_ttl = missing_ttl
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(cache_path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS manifests ('
+                         'album_id TEXT PRIMARY KEY, image_urls TEXT, fetched INTEGER NOT NULL)')
+        self._db.commit()
+
+    def get(self, album_id):
+        """
+        Get the cached manifest of an album
+
+        :param album_id: The album id
+        :return: The list of image urls, an empty list if the album is missing, None if it is not cached
+        """
+        row = self._db.execute('SELECT image_urls, fetched FROM manifests WHERE album_id = ?', (album_id,)).fetchone()
+        if row is None:
+            return None
+        image_urls, fetched = row
+        if image_urls is None:
+            return [] if fetched + self.missing_ttl >= time.time() else None
+        return json.loads(image_urls)
+
+    def set(self, album_id, image_urls):
+        """
+        Store the manifest of an album
+
+        :param album_id: The album id
+        :param image_urls: The list of image urls, None or an empty list if the album is missing
+        :return: None
+        """
+        self._db.execute('INSERT OR REPLACE INTO manifests VALUES (?, ?, ?)',
+                         (album_id, json.dumps(image_urls) if image_urls else None, int(time.time())))
+        self._db.commit()
+
+    def close(self):
+        """
+        Close the database
+
+        :return: None
+        """
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class AlbumResolver:
+    """
+    Resolves albums and galleries into image urls with the imgur API and a manifest cache
+    """
+
+    def __init__(self, client_id=None, api_url=None, cache=None):
+        """
+        :param client_id: The imgur API client id, defaults to the IMGUR_CLIENT_ID environment variable
+        :param api_url: The base url of the API, defaults to the IMGUR_API_URL environment variable or DEFAULT_API_URL
+        :param cache: A ManifestCache, the manifests are only kept in memory if None
+        """
+        self.client_id = client_id if client_id is not None else os.getenv('IMGUR_CLIENT_ID')
+        self.api_url = (api_url or os.getenv('IMGUR_API_URL') or DEFAULT_API_URL).rstrip('/')
+        self.cache = cache
+        self._manifests = {}
+
+    def _cached(self, album_id):
+        if album_id in self._manifests:
+            return self._manifests[album_id]
+        if self.cache is not None:
+            return self.cache.get(album_id)
+        return None
+
+    def _store(self, album_id, image_urls):
+        self._manifests[album_id] = image_urls
+        if self.cache is not None:
+            self.cache.set(album_id, image_urls)
+
+    async def _get(self, http, url, throttle=None):
+        if throttle is not None:
+            await throttle.before_request(url)
+        started = time.monotonic()
+        res = await http.get(url, headers={'Authorization': f'Client-ID {self.client_id}'})
+        if throttle is not None:
+            throttle.on_response(url, res.status_code, time.monotonic() - started, headers=res.headers)
+        return res
+
+    async def resolve(self, http, album_id, throttle=None):
+        """
+        Get the image urls of an album or gallery
+
+        The album endpoint is asked first. An id it does not know is asked to the gallery endpoint, which also
+        knows the galleries made of a single image.
+
+        :param http: An httpx.AsyncClient
+        :param album_id: The album or gallery id
+        :param throttle: A throttle.Throttle pacing the API requests
+        :return: The list of image urls, an empty list if the album does not exist anymore, or None if it could
+            not be resolved and the zip has to be used instead
+        """
+        image_urls = self._cached(album_id)
+        if image_urls is not None:
+            return image_urls
+        if not self.client_id:
+            return None
+        res = await self._get(http, f"{self.api_url}/album/{album_id}/images", throttle=throttle)
+        try:
+            if res.status_code == 200:
+                image_urls = [get_image_url(image) for image in res.json()['data']]
+            elif res.status_code == 404:
+                res = await self._get(http, f"{self.api_url}/gallery/{album_id}", throttle=throttle)
+                if res.status_code == 404:
+                    image_urls = []
+                elif res.status_code == 200:
+                    data = res.json()['data']
+                    images = data.get('images', []) if data.get('is_album') else [data]
+                    image_urls = [get_image_url(image) for image in images]
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            # Not the json the API documents, e.g. an html error page answered with 200
+            print(f"WARNING: could not resolve album {album_id} - unexpected answer ({type(e).__name__})")
+            return None
+        if image_urls is None:
+            print(f"WARNING: could not resolve album {album_id} - {res.status_code}")
+            return None
+        self._store(album_id, image_urls)
+        return image_urls
@@ -0,0 +1,246 @@
+# SQLite index of the key fields of the archived submissions, so questions about the archive
+# (which subreddits link to imgur, how many links were removed, the links of a year with a minimum score, ...)
+# are indexed queries instead of a walk over every json file and segment.
+#
+# The index is updated incrementally: the size and modification time of every json file and the indexed end
+# offset of every segment are recorded, so an update only parses the files that changed and the data appended
+# to the segments since the last update.
+#
+# Tables:
+#   submissions - id, subreddit, created_utc, domain, url, removed_by_category, score, imgur flag and the location
+#                 of the submission in the archive (json file or segment path relative to the archive folder, and
+#                 the line in the segment)
+#   sources     - the archive files already indexed
+
+import json
+import os
+import sqlite3
+
+import archive_store
+
+
+DEFAULT_INDEX_PATH = './data/archive_index.sqlite'
+# Location kinds, json files sort before segments like in the link extraction
+FILE = 0
+SEGMENT = 1
+
+
+def is_imgur_link(domain, url):
+    """
+    Check if a submission links to imgur, with the same test as imgur.get_imgur_url_from_submission
+
+    :param domain: The domain of the submission
+    :param url: The url of the submission
+    :return: True if both the domain and the url contain 'imgur'
+    """
+    return domain is not None and url is not None and 'imgur' in domain and 'imgur' in url
+
+
+def get_submission_row(submission, subreddit, kind, location, position):
+    """
+    Get the row of a submission in the submissions table
+
+    :param submission: The submission dictionary
+    :param subreddit: The subreddit the submission is archived in
+    :param kind: FILE or SEGMENT
+    :param location: The path of the json file or segment, relative to the archive folder
+    :param position: The line of the submission in the segment, 0 for a json file
+    :return: A tuple with the values of the columns
+    """
+    domain = submission.get('domain')
+    url = submission.get('url')
+    removed_by_category = submission.get('removed_by_category')
+    return (submission['id'], subreddit, submission.get('created_utc'), domain, url,
+            str(removed_by_category) if removed_by_category is not None else None, submission.get('score'),
+            int(is_imgur_link(domain, url)), kind, location, position)
+
+
+class ArchiveIndex:
+    """
+    SQLite index of the archived submissions
+    """
+
+    def __init__(self, index_path=DEFAULT_INDEX_PATH):
+        """
+        :param index_path: The path of the SQLite database
+        """
+        self.index_path = index_path
+        os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(index_path)
+        # The index is rebuilt from the archive if it is lost, trade durability for insert speed
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS submissions ('
+                         'id TEXT NOT NULL, subreddit TEXT NOT NULL, created_utc INTEGER, domain TEXT, url TEXT, '
+                         'removed_by_category TEXT, score INTEGER, imgur INTEGER NOT NULL, '
+                         'kind INTEGER NOT NULL, location TEXT NOT NULL, position INTEGER NOT NULL, '
+                         'PRIMARY KEY (subreddit, id))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS submissions_imgur '
+                         'ON submissions (imgur, subreddit, kind, location, position)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS submissions_created ON submissions (subreddit, created_utc)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS submissions_location ON submissions (location)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS sources ('
+                         'location TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, end_offset INTEGER)')
+        self._db.commit()
+
+    def _insert(self, rows):
+        self._db.executemany('INSERT OR REPLACE INTO submissions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def _forget(self, location):
+        self._db.execute('DELETE FROM submissions WHERE location = ?', (location,))
+        self._db.execute('DELETE FROM sources WHERE location = ?', (location,))
+
+    def update_subreddit(self, archive_folder, subreddit, batch_size=10000):
+        """
+        Index what changed in the archive of a subreddit since the last update
+
+        :param archive_folder: The folder containing the subreddit folders
+        :param subreddit: The name of the subreddit folder
+        :param batch_size: The number of rows inserted per transaction
+        :return: The number of submissions indexed
+        """
+        subreddit_folder = os.path.join(archive_folder, subreddit)
+        known = {location: (size, mtime_ns, end_offset) for location, size, mtime_ns, end_offset in
+                 self._db.execute('SELECT location, size, mtime_ns, end_offset FROM sources '
+                                  'WHERE location >= ? AND location < ?', (subreddit + '/', subreddit + '0'))}
+        seen = set()
+        rows = []
+        indexed = 0
+
+        def flush():
+            nonlocal rows, indexed
+            self._insert(rows)
+            self._db.commit()
+            indexed += len(rows)
+            rows = []
+
+        # The json files of the per-file layout
+        for root, dirs, files in os.walk(subreddit_folder):
+            for file in files:
+                if not file.endswith('.json'):
+                    continue
+                file_path = os.path.join(root, file)
+                location = os.path.relpath(file_path, archive_folder)
+                seen.add(location)
+                stat = os.stat(file_path)
+                if known.get(location, (None, None))[:2] == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                with open(file_path, 'rb') as f:
+                    submission = json.loads(f.read())
+                self._forget(location)
+                rows.append(get_submission_row(submission, subreddit, FILE, location, 0))
+                self._db.execute('INSERT INTO sources VALUES (?, ?, ?, NULL)',
+                                 (location, stat.st_size, stat.st_mtime_ns))
+                if len(rows) >= batch_size:
+                    flush()
+        # The compressed segments, only the members appended since the last update are parsed
+        for segment_path in archive_store.list_segments(subreddit_folder):
+            location = os.path.relpath(segment_path, archive_folder)
+            seen.add(location)
+            end_offset = archive_store.get_segment_end(segment_path)
+            previous_end = known.get(location, (None, None, None))[2]
+            if previous_end == end_offset:
+                continue
+            if previous_end is not None and previous_end < end_offset:
+                start_offset = previous_end
+                position = self._db.execute('SELECT COUNT(*) FROM submissions WHERE location = ?',
+                                            (location,)).fetchone()[0]
+            else:
+                # A new segment, or one that shrank and is indexed again from the start
+                start_offset = 0
+                position = 0
+                self._forget(location)
+            for line in archive_store.iter_segment_lines(segment_path, start_offset=start_offset,
+                                                         end_offset=end_offset):
+                rows.append(get_submission_row(json.loads(line), subreddit, SEGMENT, location, position))
+                position += 1
+                if len(rows) >= batch_size:
+                    flush()
+            # Record the segment in the same transaction as its last rows
+            self._db.execute('INSERT OR REPLACE INTO sources VALUES (?, NULL, NULL, ?)', (location, end_offset))
+            flush()
+        # Forget the files that were deleted from the archive
+        for location in known.keys() - seen:
+            self._forget(location)
+        flush()
+        return indexed
+
+    def update(self, archive_folder, subreddits=None):
+        """
+        Index what changed in the archive since the last update
+
+        :param archive_folder: The folder containing the subreddit folders
+        :param subreddits: The subreddits to update, all the subreddit folders if None
+        :return: The number of submissions indexed
+        """
+        if subreddits is None:
+            subreddits = sorted(f.name for f in os.scandir(archive_folder) if f.is_dir())
+        return sum(self.update_subreddit(archive_folder, subreddit) for subreddit in subreddits)
+
+    def subreddits(self, imgur_only=False):
+        """
+        Get the indexed subreddits
+
+        :param imgur_only: Only the subreddits with at least one imgur link
+        :return: A sorted list of subreddit names
+        """
+        query = 'SELECT DISTINCT subreddit FROM submissions'
+        if imgur_only:
+            query += ' WHERE imgur = 1'
+        return [subreddit for subreddit, in self._db.execute(query + ' ORDER BY subreddit')]
+
+    def iter_imgur_urls(self, subreddit=None, since=None, until=None, min_score=None, include_removed=False):
+        """
+        Iterate over the imgur links of the archive, in the order of the link extraction of imgur.py
+
+        :param subreddit: Only the links of this subreddit
+        :param since: Only the submissions created at or after this timestamp
+        :param until: Only the submissions created before this timestamp
+        :param min_score: Only the submissions with at least this score
+        :param include_removed: Include the submissions removed by the moderators
+        :return: A generator of urls
+        """
+        conditions = ['imgur = 1']
+        params = []
+        if subreddit is not None:
+            conditions.append('subreddit = ?')
+            params.append(subreddit)
+        if since is not None:
+            conditions.append('created_utc >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append('created_utc < ?')
+            params.append(until)
+        if min_score is not None:
+            conditions.append('score >= ?')
+            params.append(min_score)
+        if not include_removed:
+            conditions.append('removed_by_category IS NULL')
+        cursor = self._db.execute(f"SELECT url FROM submissions WHERE {' AND '.join(conditions)} "
+                                  'ORDER BY subreddit, kind, location, position', params)
+        for url, in cursor:
+            yield url
+
+    def count_imgur_links(self):
+        """
+        Count the imgur links of every subreddit
+
+        :return: A dictionary {subreddit: (number of imgur links, number of them removed by the moderators)}
+        """
+        return {subreddit: (links, removed) for subreddit, links, removed in
+                self._db.execute('SELECT subreddit, COUNT(*), COUNT(removed_by_category) FROM submissions '
+                                 'WHERE imgur = 1 GROUP BY subreddit ORDER BY subreddit')}
+
+    def close(self):
+        """
+        Close the database
+
+        :return: None
+        """
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
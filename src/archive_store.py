@@ -0,0 +1,259 @@
+# Packed storage backend for archived subreddit submissions.
+# Instead of one pretty-printed json file per submission, submissions are appended to one compressed
+# JSONL segment per subreddit-month, with a small text index mapping each submission id to its location.
+#
+# Layout:
+#   ./Archive/<subreddit>/<YYYY>-<MM>.jsonl.gz  - concatenated gzip members, each holding a batch of json lines
+#   ./Archive/<subreddit>/<YYYY>-<MM>.idx       - one '<id>\t<member offset>\t<member length>\t<line>' line per submission
+
+import datetime
+import gzip
+import io
+import json
+import os
+
+
+SEGMENT_EXTENSION = '.jsonl.gz'
+INDEX_EXTENSION = '.idx'
+
+
+def get_segment_name(created_utc):
+    """
+    Get the name of the segment a submission belongs to
+
+    Uses the same local time conversion as the per-file archive layout, so both layouts split months the same way.
+
+    :param created_utc: The creation timestamp of the submission
+    :return: The segment name in the format 'YYYY-MM'
+    """
+    return datetime.datetime.fromtimestamp(created_utc).strftime('%Y-%m')
+
+
+def get_index_path(segment_path):
+    """
+    Get the path of the index file of a segment
+
+    :param segment_path: The path to the segment file
+    :return: The path to the index file
+    """
+    return segment_path[:-len(SEGMENT_EXTENSION)] + INDEX_EXTENSION
+
+
+def load_segment_index(segment_path):
+    """
+    Load the index of a segment
+
+    :param segment_path: The path to the segment file
+    :return: A dictionary mapping submission ids to (member offset, member length, line) tuples
+    """
+    index = {}
+    index_path = get_index_path(segment_path)
+    if not os.path.exists(index_path):
+        return index
+    with open(index_path, 'r') as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            # Skip a partially written last line
+            if len(parts) != 4:
+                continue
+            index[parts[0]] = (int(parts[1]), int(parts[2]), int(parts[3]))
+    return index
+
+
+def list_segments(subreddit_folder):
+    """
+    Get a sorted list of all the segment files of a subreddit
+
+    :param subreddit_folder: The folder containing the subreddit archive
+    :return: A list of segment file paths, oldest month first
+    """
+    if not os.path.isdir(subreddit_folder):
+        return []
+    return sorted(os.path.join(subreddit_folder, f) for f in os.listdir(subreddit_folder)
+                  if f.endswith(SEGMENT_EXTENSION))
+
+
+def get_segment_end(segment_path):
+    """
+    Get the end offset of the last complete member of a segment
+
+    Bytes after this offset belong to a write that was interrupted and are not part of the segment.
+
+    :param segment_path: The path to the segment file
+    :return: The byte offset just after the last indexed member
+    """
+    index = load_segment_index(segment_path)
+    return max((offset + length for offset, length, line in index.values()), default=0)
+
+
+def iter_segment_lines(segment_path, start_offset=0, end_offset=None):
+    """
+    Iterate over the raw json lines stored in a segment, without decoding them
+
+    A truncated member at the end of the segment (e.g. from a crash while writing) ends the iteration.
+
+    :param segment_path: The path to the segment file
+    :param start_offset: The byte offset of the first member to read
+    :param end_offset: The byte offset to stop reading at, must be a member boundary
+    :return: A generator of json encoded submissions as bytes
+    """
+    with open(segment_path, 'rb') as raw:
+        raw.seek(start_offset)
+        fileobj = raw if end_offset is None else io.BytesIO(raw.read(end_offset - start_offset))
+        with gzip.GzipFile(fileobj=fileobj, mode='rb') as f:
+            try:
+                yield from f
+            except (EOFError, gzip.BadGzipFile):
+                return
+
+
+def iter_segment(segment_path, start_offset=0, end_offset=None):
+    """
+    Iterate over the submissions stored in a segment
+
+    :param segment_path: The path to the segment file
+    :param start_offset: The byte offset of the first member to read
+    :param end_offset: The byte offset to stop reading at, must be a member boundary
+    :return: A generator of submission dictionaries
+    """
+    for line in iter_segment_lines(segment_path, start_offset=start_offset, end_offset=end_offset):
+        yield json.loads(line)
+
+
+def iter_submissions(subreddit_folder):
+    """
+    Iterate over all the submissions stored in the segments of a subreddit
+
+    :param subreddit_folder: The folder containing the subreddit archive
+    :return: A generator of submission dictionaries
+    """
+    for segment_path in list_segments(subreddit_folder):
+        yield from iter_segment(segment_path)
+
+
+def read_submission(subreddit_folder, submission_id):
+    """
+    Read a single submission from the segments of a subreddit using the segment indexes
+
+    :param subreddit_folder: The folder containing the subreddit archive
+    :param submission_id: The id of the submission
+    :return: The submission dictionary or None if it is not archived
+    """
+    for segment_path in list_segments(subreddit_folder):
+        index = load_segment_index(segment_path)
+        if submission_id not in index:
+            continue
+        offset, length, line = index[submission_id]
+        with open(segment_path, 'rb') as f:
+            f.seek(offset)
+            member = gzip.decompress(f.read(length))
+        return json.loads(member.splitlines()[line])
+    return None
+
+
+class SegmentWriter:
+    """
+    Append submissions to the compressed segments of a subreddit
+
+    Submissions are buffered per month and written as one gzip member per batch, which keeps the
+    compression ratio close to compressing the whole month at once while still allowing appends.
+    """
+
+    def __init__(self, subreddit_folder, batch_size=1000):
+        """
+        :param subreddit_folder: The folder containing the subreddit archive
+        :param batch_size: The number of buffered submissions per month that triggers a write
+        """
+        self.subreddit_folder = subreddit_folder
+        self.batch_size = batch_size
+        self._indexes = {}
+        self._buffers = {}
+        self._buffered_ids = set()
+        os.makedirs(subreddit_folder, exist_ok=True)
+
+    def _segment_path(self, segment_name):
+        return os.path.join(self.subreddit_folder, segment_name + SEGMENT_EXTENSION)
+
+    def _load(self, segment_name):
+        # Load the index of a month the first time it is touched
+        if segment_name in self._indexes:
+            return self._indexes[segment_name]
+        segment_path = self._segment_path(segment_name)
+        index = load_segment_index(segment_path)
+        # Drop any bytes written after the last indexed member, they belong to an interrupted write
+        valid_end = max((offset + length for offset, length, line in index.values()), default=0)
+        if os.path.exists(segment_path) and os.path.getsize(segment_path) > valid_end:
+            with open(segment_path, 'r+b') as f:
+                f.truncate(valid_end)
+        self._indexes[segment_name] = index
+        self._buffers[segment_name] = []
+        return index
+
+    def contains(self, submission):
+        """
+        Check if a submission is already archived
+
+        :param submission: The submission dictionary
+        :return: True if the submission is in the segments or in the write buffer
+        """
+        segment_name = get_segment_name(submission['created_utc'])
+        index = self._load(segment_name)
+        return submission['id'] in index or submission['id'] in self._buffered_ids
+
+    def append(self, submission):
+        """
+        Add a submission to its month segment
+
+        :param submission: The submission dictionary
+        :return: True if the submission was added, False if it was already archived
+        """
+        if self.contains(submission):
+            return False
+        segment_name = get_segment_name(submission['created_utc'])
+        self._buffers[segment_name].append(submission)
+        self._buffered_ids.add(submission['id'])
+        if len(self._buffers[segment_name]) >= self.batch_size:
+            self._flush_segment(segment_name)
+        return True
+
+    def _flush_segment(self, segment_name):
+        buffer = self._buffers[segment_name]
+        if not buffer:
+            return
+        segment_path = self._segment_path(segment_name)
+        lines = [json.dumps(submission, separators=(',', ':')).encode('utf-8') + b'\n' for submission in buffer]
+        member = gzip.compress(b''.join(lines))
+        # Write the data before the index, so an index entry never points to missing data
+        with open(segment_path, 'ab') as f:
+            offset = f.tell()
+            f.write(member)
+        index = self._indexes[segment_name]
+        with open(get_index_path(segment_path), 'a') as f:
+            for line, submission in enumerate(buffer):
+                f.write(f"{submission['id']}\t{offset}\t{len(member)}\t{line}\n")
+                index[submission['id']] = (offset, len(member), line)
+                self._buffered_ids.discard(submission['id'])
+        self._buffers[segment_name] = []
+
+    def flush(self):
+        """
+        Write all the buffered submissions to their segments
+
+        :return: None
+        """
+        for segment_name in list(self._buffers):
+            self._flush_segment(segment_name)
+
+    def close(self):
+        """
+        Flush the buffered submissions
+
+        :return: None
+        """
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,540 @@
+# Benchmarks for the hot paths of the archive and download pipelines.
+# Everything runs offline against generated data and the local stand-ins of standin.py, e.g.:
+#   python benchmark.py extraction --submissions 20000 --imgur-ratio 0.05
+#   python benchmark.py download --links 2000 --image-size 262144 --concurrency 32
+#   python benchmark.py crawljob --links 100000
+#   python benchmark.py archive --submissions 5000
+#   python benchmark.py dumps --months 4 --submissions-per-month 50000
+
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import string
+import tempfile
+import time
+
+import httpx
+import zstandard
+
+import archive_store
+import imgur
+import standin
+from submission_json import orjson
+
+
+def random_id(length=6):
+    """
+    Get a random base36 id like the ones used by reddit
+
+    :param length: The length of the id
+    :return: The id
+    """
+    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=length))
+
+
+def random_imgur_url():
+    """
+    Get a random imgur url in one of the forms found in reddit submissions
+
+    :return: The imgur url
+    """
+    imgur_id = ''.join(random.choices(string.ascii_letters + string.digits, k=random.choice([5, 7])))
+    return random.choice([
+        f"https://i.imgur.com/{imgur_id}.jpg",
+        f"https://i.imgur.com/{imgur_id}.png",
+        f"https://i.imgur.com/{imgur_id}.gifv",
+        f"https://imgur.com/{imgur_id}",
+        f"https://imgur.com/a/{imgur_id}",
+        f"https://imgur.com/gallery/{imgur_id}",
+        f"https://m.imgur.com/{imgur_id}",
+    ])
+
+
+def generate_submission(subreddit, created_utc, imgur_ratio=0.1, removed_ratio=0.05):
+    """
+    Generate a submission with the fields and size of a Pushshift submission
+
+    :param subreddit: The subreddit of the submission
+    :param created_utc: The creation timestamp of the submission
+    :param imgur_ratio: The probability that the submission links to imgur
+    :param removed_ratio: The probability that the submission was removed by a moderator
+    :return: The submission dictionary
+    """
+    submission_id = random_id()
+    if random.random() < imgur_ratio:
+        url = random_imgur_url()
+        domain = url.split('/')[2]
+    elif random.random() < 0.5:
+        url = f"https://www.reddit.com/r/{subreddit}/comments/{submission_id}/"
+        domain = f"self.{subreddit}"
+    else:
+        domain = random.choice(['i.redd.it', 'youtube.com', 'v.redd.it', 'gfycat.com'])
+        url = f"https://{domain}/{random_id(12)}"
+    return {
+        "all_awardings": [],
+        "allow_live_comments": False,
+        "author": random_id(10),
+        "author_flair_css_class": None,
+        "author_flair_richtext": [],
+        "author_flair_text": None,
+        "author_flair_type": "text",
+        "author_fullname": f"t2_{random_id(8)}",
+        "author_patreon_flair": False,
+        "author_premium": False,
+        "awarders": [],
+        "can_mod_post": False,
+        "contest_mode": False,
+        "created_utc": created_utc,
+        "domain": domain,
+        "full_link": f"https://www.reddit.com/r/{subreddit}/comments/{submission_id}/",
+        "gildings": {},
+        "id": submission_id,
+        "is_crosspostable": True,
+        "is_meta": False,
+        "is_original_content": False,
+        "is_reddit_media_domain": domain == 'i.redd.it',
+        "is_robot_indexable": True,
+        "is_self": domain.startswith('self.'),
+        "is_video": False,
+        "link_flair_background_color": "",
+        "link_flair_richtext": [],
+        "link_flair_text_color": "dark",
+        "link_flair_type": "text",
+        "locked": False,
+        "media_only": False,
+        "no_follow": True,
+        "num_comments": random.randint(0, 500),
+        "num_crossposts": 0,
+        "over_18": False,
+        "parent_whitelist_status": "all_ads",
+        "permalink": f"/r/{subreddit}/comments/{submission_id}/",
+        "pinned": False,
+        "pwls": 6,
+        "removed_by_category": "moderator" if random.random() < removed_ratio else None,
+        "retrieved_on": created_utc + 3600,
+        "score": random.randint(0, 5000),
+        "selftext": ''.join(random.choices(string.ascii_letters + ' ', k=random.randint(0, 800))),
+        "send_replies": True,
+        "spoiler": False,
+        "stickied": False,
+        "subreddit": subreddit,
+        "subreddit_id": "t5_2qh0u",
+        "subreddit_subscribers": 100000,
+        "subreddit_type": "public",
+        "thumbnail": "default",
+        "title": ''.join(random.choices(string.ascii_letters + ' ', k=random.randint(10, 200))),
+        "total_awards_received": 0,
+        "treatment_tags": [],
+        "upvote_ratio": 1.0,
+        "url": url,
+        "whitelist_status": "all_ads",
+        "wls": 6
+    }
+
+
+def generate_archive(archive_folder,
+                     subreddits=('pics', 'funny', 'aww'),
+                     submissions_per_subreddit=10000,
+                     imgur_ratio=0.1,
+                     start_utc=1262304000,
+                     end_utc=1672531200,
+                     seed=0,
+                     storage='files'):
+    """
+    Generate a synthetic archive with the same layout as reddit.archive_subreddit
+
+    The path format is '<archive_folder>/subreddit/YYYY/MM/YYYY-MM-DD_submission_id.json',
+    or '<archive_folder>/subreddit/YYYY-MM.jsonl.gz' with storage='segments'
+
+    :param archive_folder: The folder to write the archive to
+    :param subreddits: The subreddits to generate
+    :param submissions_per_subreddit: The number of submissions in each subreddit
+    :param imgur_ratio: The probability that a submission links to imgur
+    :param start_utc: The earliest creation timestamp
+    :param end_utc: The latest creation timestamp
+    :param seed: The random seed, the same seed generates the same archive
+    :param storage: The storage backend, either 'files' or 'segments'
+    :return: None
+    """
+    random.seed(seed)
+    for subreddit in subreddits:
+        if storage == 'segments':
+            with archive_store.SegmentWriter(os.path.join(archive_folder, subreddit)) as writer:
+                for _ in range(submissions_per_subreddit):
+                    writer.append(generate_submission(subreddit, random.randint(start_utc, end_utc),
+                                                      imgur_ratio=imgur_ratio))
+            continue
+        for _ in range(submissions_per_subreddit):
+            submission = generate_submission(subreddit, random.randint(start_utc, end_utc), imgur_ratio=imgur_ratio)
+            submission_date = datetime.datetime.fromtimestamp(submission['created_utc'])
+            submission_path = os.path.join(archive_folder, subreddit,
+                                           submission_date.strftime('%Y'), submission_date.strftime('%m'),
+                                           f"{submission_date.strftime('%Y-%m-%d')}_{submission['id']}.json")
+            os.makedirs(os.path.dirname(submission_path), exist_ok=True)
+            with open(submission_path, 'w') as f:
+                json.dump(submission, f, indent=2)
+
+
+def generate_dump(dump_folder,
+                  year,
+                  month,
+                  submissions=10000,
+                  subreddits=('pics', 'funny', 'aww', 'AskReddit', 'news'),
+                  imgur_ratio=0.1,
+                  seed=0):
+    """
+    Generate a synthetic Pushshift monthly dump, a zstd compressed file with one submission json per line
+
+    :param dump_folder: The folder to write 'RS_YYYY-MM.zst' to
+    :param year: The year of the dump
+    :param month: The month of the dump
+    :param submissions: The number of submissions, spread over the subreddits
+    :param subreddits: The subreddits of the submissions
+    :param imgur_ratio: The probability that a submission links to imgur
+    :param seed: The random seed, the same seed generates the same dump
+    :return: The path of the dump
+    """
+    random.seed(seed)
+    start_utc = int(datetime.datetime(year, month, 1, tzinfo=datetime.timezone.utc).timestamp())
+    end_utc = int(datetime.datetime(year + month // 12, month % 12 + 1, 1, tzinfo=datetime.timezone.utc).timestamp())
+    dump_path = os.path.join(dump_folder, f"RS_{year:04d}-{month:02d}.zst")
+    os.makedirs(dump_folder, exist_ok=True)
+    with open(dump_path, 'wb') as f, zstandard.ZstdCompressor().stream_writer(f) as writer:
+        for _ in range(submissions):
+            submission = generate_submission(random.choice(subreddits), random.randint(start_utc, end_utc - 1),
+                                             imgur_ratio=imgur_ratio)
+            writer.write(json.dumps(submission).encode('utf-8') + b'\n')
+    return dump_path
+
+
+def generate_submissions(subreddit, count, imgur_ratio=0.1, start_utc=1262304000, end_utc=1672531200, seed=0):
+    """
+    Generate a list of submissions with unique ids, e.g. for the Pushshift stand-in
+
+    :param subreddit: The subreddit of the submissions
+    :param count: The number of submissions
+    :param imgur_ratio: The probability that a submission links to imgur
+    :param start_utc: The earliest creation timestamp
+    :param end_utc: The latest creation timestamp
+    :param seed: The random seed
+    :return: A list of submission dictionaries
+    """
+    random.seed(seed)
+    submissions = {}
+    while len(submissions) < count:
+        submission = generate_submission(subreddit, random.randint(start_utc, end_utc), imgur_ratio=imgur_ratio)
+        submissions[submission['id']] = submission
+    return list(submissions.values())
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """
+    Get percentiles of a list of values with the nearest rank method
+
+    :param values: The values
+    :param points: The percentiles to compute
+    :return: A dictionary {percentile: value}, empty if there are no values
+    """
+    if not values:
+        return {}
+    ordered = sorted(values)
+    return {point: ordered[min(len(ordered) - 1, max(0, int(round(point / 100 * len(ordered))) - 1))]
+            for point in points}
+
+
+def format_latencies(latencies):
+    """
+    Format the latency percentiles of a list of durations
+
+    :param latencies: The durations in seconds
+    :return: A 'p50 ... ms  p90 ... ms  p99 ... ms' string
+    """
+    return '  '.join(f"p{point} {value * 1000:.1f} ms" for point, value in percentiles(latencies).items())
+
+
+def get_imgur_url_full_decode(submission_json, filter_moderated=True):
+    """
+    Reference implementation of imgur.get_imgur_url that decodes every document with the json module
+
+    :param submission_json: The submission json file
+    :param filter_moderated: Whether to filter out moderated submissions
+    :return: The imgur url
+    """
+    with open(submission_json) as json_file:
+        return imgur.get_imgur_url_from_submission(json.load(json_file), filter_moderated)
+
+
+def benchmark_extraction(submissions=20000, imgur_ratio=0.05, repeat=3):
+    """
+    Compare the fast path of imgur.get_imgur_url with a full json decode of every document
+
+    :param submissions: The number of submissions in the synthetic archive
+    :param imgur_ratio: The probability that a submission links to imgur
+    :param repeat: The number of timed passes, the best one is reported
+    :return: A dictionary with the files/s of both implementations
+    """
+    archive_folder = tempfile.mkdtemp(prefix='imgur_benchmark_')
+    try:
+        generate_archive(archive_folder, subreddits=('pics',), submissions_per_subreddit=submissions,
+                         imgur_ratio=imgur_ratio)
+        json_files = sorted(os.path.join(root, file) for root, dirs, files in os.walk(archive_folder)
+                            for file in files if file.endswith('.json'))
+        results = {}
+        for name, function in (('full_decode', get_imgur_url_full_decode), ('fast_path', imgur.get_imgur_url)):
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                urls = [function(json_file) for json_file in json_files]
+                timings.append(time.perf_counter() - start)
+            results[name] = {'files_per_second': len(json_files) / min(timings), 'urls': urls}
+        if results['full_decode']['urls'] != results['fast_path']['urls']:
+            raise AssertionError("The fast path returned different urls than the full decode")
+        print(f"Extraction over {len(json_files)} files "
+              f"(imgur ratio {imgur_ratio}, orjson {'on' if orjson is not None else 'off'}):")
+        for name in results:
+            print(f"  {name:12} {results[name]['files_per_second']:10.0f} files/s")
+        print(f"  speedup      {results['fast_path']['files_per_second'] / results['full_decode']['files_per_second']:10.2f}x")
+        return {name: results[name]['files_per_second'] for name in results}
+    finally:
+        shutil.rmtree(archive_folder)
+
+
+def benchmark_download(links=2000,
+                       image_size=256 * 1024,
+                       concurrency=32,
+                       removed_ratio=0.05,
+                       requests_per_second=None,
+                       latency=0.0,
+                       host_rate=None,
+                       resolve_albums=False):
+    """
+    Download a generated link file from the imgur stand-in through imgur.download_imgur_url
+
+    :param links: The number of links in the link file
+    :param image_size: The number of bytes of each image
+    :param concurrency: The maximum number of downloads running at the same time
+    :param removed_ratio: The share of removed images
+    :param requests_per_second: The rate limit of each stand-in host, no limit if None
+    :param latency: The number of seconds each stand-in request takes
+    :param host_rate: The starting requests per second of the download throttle for each imgur host,
+        the production rates of throttle.py are used if None
+    :param resolve_albums: Expand the albums with the stand-in API instead of downloading their zips
+    :return: A dictionary with the links/s, MB/s, the outcomes and the latency percentiles
+    """
+    work_folder = tempfile.mkdtemp(prefix='imgur_benchmark_')
+    try:
+        random.seed(0)
+        link_file = os.path.join(work_folder, 'pics.txt')
+        with open(link_file, 'w') as f:
+            f.writelines(random_imgur_url() + '\n' for _ in range(links))
+        output_folder = os.path.join(work_folder, 'output')
+        with standin.ImgurStandin(image_size=image_size,
+                                  removed_ratio=removed_ratio,
+                                  requests_per_second=requests_per_second,
+                                  latency=latency) as server:
+            limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+            transport = standin.RewritingTransport(server.url, httpx.AsyncHTTPTransport(limits=limits))
+            throttle = None
+            if host_rate is not None:
+                throttle = imgur.Throttle(max_concurrency=concurrency, initial_concurrency=concurrency,
+                                          host_rates={'imgur.com': (host_rate, host_rate),
+                                                      'i.imgur.com': (host_rate, host_rate),
+                                                      'api.imgur.com': (host_rate, host_rate)})
+            resolver = None
+            if resolve_albums:
+                resolver = imgur.AlbumResolver(client_id='benchmark', api_url='https://api.imgur.com/3',
+                                               cache=imgur.ManifestCache(os.path.join(work_folder, 'manifests.sqlite')))
+            start = time.perf_counter()
+            outcomes = imgur.download_imgur_url(link_file, output_folder, concurrency=concurrency, transport=transport,
+                                                throttle=throttle, resolver=resolver)
+            elapsed = time.perf_counter() - start
+            if resolver is not None:
+                resolver.cache.close()
+            status_codes = dict(server.status_codes)
+        downloaded_bytes = sum(os.path.getsize(os.path.join(root, name))
+                               for root, dirs, names in os.walk(os.path.join(output_folder, '.blobs'))
+                               for name in names if name != 'placeholders.txt')
+        result = {
+            'links_per_second': links / elapsed,
+            'mb_per_second': downloaded_bytes / elapsed / 1024 / 1024,
+            'outcomes': outcomes,
+            'status_codes': status_codes,
+            'latency': percentiles(transport.latencies),
+        }
+        print(f"Download of {links} links ({image_size} bytes per image, concurrency {concurrency}):")
+        print(f"  {result['links_per_second']:10.1f} links/s  {result['mb_per_second']:10.1f} MB/s  in {elapsed:.1f} s")
+        print(f"  outcomes     {outcomes}")
+        print(f"  status codes {status_codes}")
+        print(f"  latency      {format_latencies(transport.latencies)}")
+        return result
+    finally:
+        shutil.rmtree(work_folder)
+
+
+def benchmark_crawljob(links=100000, limit=10000, latency=0.05):
+    """
+    Create a crawljob twice against the Wastebin stand-in, the second run reuses the cached pastes
+
+    :param links: The number of links in the crawljob
+    :param limit: The number of links in each paste
+    :param latency: The number of seconds each post takes
+    :return: A dictionary with the links/s of the first and the second run
+    """
+    work_folder = tempfile.mkdtemp(prefix='imgur_benchmark_')
+    wastebin_url = os.environ.get('WASTEBIN_URL')
+    try:
+        random.seed(0)
+        imgur_urls = [random_imgur_url() for _ in range(links)]
+        results = {}
+        with standin.WastebinStandin(latency=latency) as server, \
+                imgur.wastebin.PasteCache(os.path.join(work_folder, 'pastes.json')) as paste_cache:
+            os.environ['WASTEBIN_URL'] = server.url
+            session = imgur.wastebin.create_session()
+            for name in ('first_run', 'cached_run'):
+                posts = len(server.pastes)
+                start = time.perf_counter()
+                imgur.create_crawljob_file_from_imgur_urls(imgur_urls, 'pics', limit=limit,
+                                                           output_folder=work_folder, recreate_file=True,
+                                                           session=session, paste_cache=paste_cache)
+                elapsed = time.perf_counter() - start
+                results[name] = {'links_per_second': links / elapsed, 'posts': len(server.pastes) - posts}
+        print(f"Crawljob of {links} links in pastes of {limit} (post latency {latency * 1000:.0f} ms):")
+        for name in results:
+            print(f"  {name:12} {results[name]['links_per_second']:12.0f} links/s  {results[name]['posts']:4} posts")
+        return results
+    finally:
+        if wastebin_url is None:
+            os.environ.pop('WASTEBIN_URL', None)
+        else:
+            os.environ['WASTEBIN_URL'] = wastebin_url
+        shutil.rmtree(work_folder)
+
+
+def benchmark_archive(submissions=5000, storage='segments', latency=0.0, requests_per_minute=6000, window_days=365):
+    """
+    Archive a subreddit from the Pushshift stand-in with reddit.archive_subreddit
+
+    The submissions are spread over the last two years.
+
+    :param submissions: The number of submissions of the subreddit
+    :param storage: The storage backend, either 'files' or 'segments'
+    :param latency: The number of seconds each search request takes
+    :param requests_per_minute: The rate limit of the Pushshift requests
+    :param window_days: The number of days requested and checkpointed at a time
+    :return: A dictionary with the submissions/s and the number of requests
+    """
+    # reddit is imported here because it needs pmaw, which the other benchmarks do not
+    import reddit
+    work_folder = tempfile.mkdtemp(prefix='imgur_benchmark_')
+    current_folder = os.getcwd()
+    pushshift_url = reddit.PUSHSHIFT_URL
+    try:
+        end_utc = int(time.time()) - 2 * 86400
+        generated = generate_submissions('pics', submissions, start_utc=end_utc - 2 * 365 * 86400, end_utc=end_utc)
+        with standin.PushshiftStandin({'pics': generated}, latency=latency) as server:
+            reddit.PUSHSHIFT_URL = server.url
+            # archive_subreddit writes to './Archive'
+            os.chdir(work_folder)
+            start = time.perf_counter()
+            reddit.archive_subreddit('pics', storage=storage, rate_limiter=reddit.RateLimiter(requests_per_minute),
+                                     window_days=window_days)
+            elapsed = time.perf_counter() - start
+            result = {'submissions_per_second': submissions / elapsed, 'requests': server.requests}
+        print(f"Archive of {submissions} submissions ({storage}):")
+        print(f"  {result['submissions_per_second']:10.0f} submissions/s  {result['requests']} requests  in {elapsed:.1f} s")
+        return result
+    finally:
+        os.chdir(current_folder)
+        reddit.PUSHSHIFT_URL = pushshift_url
+        shutil.rmtree(work_folder)
+
+
+def benchmark_dumps(months=4, submissions_per_month=50000, storage='links', max_workers=None):
+    """
+    Ingest synthetic Pushshift dumps with reddit.ingest_dumps, keeping two of their five subreddits
+
+    :param months: The number of monthly dumps
+    :param submissions_per_month: The number of submissions in each dump
+    :param storage: The output, either 'files', 'segments' or 'links'
+    :param max_workers: The number of dumps filtered at the same time, one per cpu if None
+    :return: A dictionary with the submissions/s and the number of submissions or links written
+    """
+    # reddit is imported here because it needs pmaw, which the other benchmarks do not
+    import reddit
+    work_folder = tempfile.mkdtemp(prefix='imgur_benchmark_')
+    current_folder = os.getcwd()
+    try:
+        for i in range(months):
+            generate_dump(os.path.join(work_folder, 'dumps'), 2020 + i // 12, i % 12 + 1,
+                          submissions=submissions_per_month, seed=i)
+        with open(os.path.join(work_folder, 'consolidated_subreddits.txt'), 'w') as f:
+            f.write('pics\naskreddit\n')
+        # ingest_dumps writes to './Archive'
+        os.chdir(work_folder)
+        start = time.perf_counter()
+        written = reddit.ingest_dumps('dumps', storage=storage, links_folder='links', max_workers=max_workers)
+        elapsed = time.perf_counter() - start
+        result = {'submissions_per_second': months * submissions_per_month / elapsed,
+                  'written': sum(written.values())}
+        print(f"Ingestion of {months} dumps of {submissions_per_month} submissions ({storage}):")
+        print(f"  {result['submissions_per_second']:10.0f} submissions/s  {result['written']} written  "
+              f"in {elapsed:.1f} s")
+        return result
+    finally:
+        os.chdir(current_folder)
+        shutil.rmtree(work_folder)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the reddit imgur archive pipelines')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    extraction = subparsers.add_parser('extraction', help='imgur url extraction from archived json files')
+    extraction.add_argument('--submissions', type=int, default=20000)
+    extraction.add_argument('--imgur-ratio', type=float, default=0.05)
+    extraction.add_argument('--repeat', type=int, default=3)
+    download = subparsers.add_parser('download', help='imgur downloads from the imgur stand-in')
+    download.add_argument('--links', type=int, default=2000)
+    download.add_argument('--image-size', type=int, default=256 * 1024)
+    download.add_argument('--concurrency', type=int, default=32)
+    download.add_argument('--removed-ratio', type=float, default=0.05)
+    download.add_argument('--requests-per-second', type=float, default=None)
+    download.add_argument('--latency', type=float, default=0.0)
+    download.add_argument('--host-rate', type=float, default=None)
+    download.add_argument('--resolve-albums', action='store_true')
+    crawljob = subparsers.add_parser('crawljob', help='crawljob creation against the Wastebin stand-in')
+    crawljob.add_argument('--links', type=int, default=100000)
+    crawljob.add_argument('--limit', type=int, default=10000)
+    crawljob.add_argument('--latency', type=float, default=0.05)
+    archive = subparsers.add_parser('archive', help='subreddit archiving from the Pushshift stand-in')
+    archive.add_argument('--submissions', type=int, default=5000)
+    archive.add_argument('--storage', choices=('files', 'segments'), default='segments')
+    archive.add_argument('--latency', type=float, default=0.0)
+    archive.add_argument('--requests-per-minute', type=int, default=6000)
+    archive.add_argument('--window-days', type=int, default=365)
+    dumps = subparsers.add_parser('dumps', help='ingestion of synthetic Pushshift monthly dumps')
+    dumps.add_argument('--months', type=int, default=4)
+    dumps.add_argument('--submissions-per-month', type=int, default=50000)
+    dumps.add_argument('--storage', choices=('files', 'segments', 'links'), default='links')
+    dumps.add_argument('--max-workers', type=int, default=None)
+    args = parser.parse_args()
+    if args.benchmark == 'extraction':
+        benchmark_extraction(submissions=args.submissions, imgur_ratio=args.imgur_ratio, repeat=args.repeat)
+    elif args.benchmark == 'download':
+        benchmark_download(links=args.links, image_size=args.image_size, concurrency=args.concurrency,
+                           removed_ratio=args.removed_ratio, requests_per_second=args.requests_per_second,
+                           latency=args.latency, host_rate=args.host_rate, resolve_albums=args.resolve_albums)
+    elif args.benchmark == 'crawljob':
+        benchmark_crawljob(links=args.links, limit=args.limit, latency=args.latency)
+    elif args.benchmark == 'archive':
+        benchmark_archive(submissions=args.submissions, storage=args.storage, latency=args.latency,
+                          requests_per_minute=args.requests_per_minute, window_days=args.window_days)
+    elif args.benchmark == 'dumps':
+        benchmark_dumps(months=args.months, submissions_per_month=args.submissions_per_month, storage=args.storage,
+                        max_workers=args.max_workers)
+
+
+if __name__ == '__main__':
+    main()
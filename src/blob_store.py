@@ -0,0 +1,119 @@
+# Content-addressed storage of the downloaded media.
+# Every file is stored once under its sha256 as '<blob folder>/ab/cd/<sha256>' and the human readable
+# filenames in the output folder are hardlinks to it, so re-uploads and the same image under different ids
+# take the disk space of a single copy.
+#
+# Known placeholder images (e.g. imgur's "removed" image) are rejected by hash. Imgur's "removed" image is known
+# out of the box by the md5 it is commonly identified with, only the small files are checked against it. More
+# sha256 hashes are read from the PLACEHOLDER_HASHES environment variable (comma separated) and from the
+# 'placeholders.txt' file of the blob folder (one per line).
+
+import hashlib
+import os
+import shutil
+
+
+BLOB_FOLDER_NAME = '.blobs'
+PLACEHOLDERS_FILE_NAME = 'placeholders.txt'
+# md5 of the built-in placeholders: imgur's "removed" image (https://i.imgur.com/removed.png, 503 bytes)
+DEFAULT_PLACEHOLDER_MD5S = frozenset(['d835884373f4d6c8f24742ceabe74946'])
+# Only the files up to this size are compared with the built-in placeholders
+DEFAULT_PLACEHOLDER_MAX_SIZE = 16 * 1024
+
+
+class PlaceholderContent(Exception):
+    """
+    Raised when a downloaded file is a known placeholder image
+    """
+
+
+def new_hash():
+    """
+    Create the hash object the content is addressed with
+
+    :return: A hashlib sha256 object
+    """
+    return hashlib.sha256()
+
+
+class BlobStore:
+    """
+    Folder of blobs named after the sha256 of their content
+    """
+
+    def __init__(self, blob_folder):
+        """
+        :param blob_folder: The folder the blobs are stored in.
+            Hardlinks only work within one filesystem, keep it on the same filesystem as the output folders.
+        """
+        self.blob_folder = blob_folder
+        os.makedirs(blob_folder, exist_ok=True)
+        self.placeholders = set()
+        for digest in os.environ.get('PLACEHOLDER_HASHES', '').split(','):
+            if digest.strip():
+                self.placeholders.add(digest.strip().lower())
+        placeholders_path = os.path.join(blob_folder, PLACEHOLDERS_FILE_NAME)
+        if os.path.exists(placeholders_path):
+            with open(placeholders_path, 'r') as f:
+                self.placeholders.update(line.strip().lower() for line in f if line.strip())
+
+    def blob_path(self, digest):
+        """
+        Get the path of a blob
+
+        :param digest: The hex sha256 of the content
+        :return: The path of the blob
+        """
+        return os.path.join(self.blob_folder, digest[:2], digest[2:4], digest)
+
+    def add_placeholder(self, digest):
+        """
+        Reject the content with this hash from now on
+
+        :param digest: The hex sha256 of the placeholder
+        :return: None
+        """
+        digest = digest.lower()
+        if digest in self.placeholders:
+            return
+        self.placeholders.add(digest)
+        with open(os.path.join(self.blob_folder, PLACEHOLDERS_FILE_NAME), 'a') as f:
+            f.write(digest + '\n')
+
+    def _is_default_placeholder(self, part_path):
+        if os.path.getsize(part_path) > DEFAULT_PLACEHOLDER_MAX_SIZE:
+            return False
+        with open(part_path, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest() in DEFAULT_PLACEHOLDER_MD5S
+
+    def commit(self, part_path, digest, file_path):
+        """
+        Move a completely written file into the store and link its final name to the blob
+
+        :param part_path: The path of the written file, it is moved or removed
+        :param digest: The hex sha256 of the written file
+        :param file_path: The human readable path linked to the blob
+        :return: True if the blob was new, False if the content was already stored
+        :raise PlaceholderContent: If the content is a known placeholder
+        """
+        if digest not in self.placeholders and self._is_default_placeholder(part_path):
+            # Known by its sha256 from now on
+            self.placeholders.add(digest)
+        if digest in self.placeholders:
+            os.remove(part_path)
+            raise PlaceholderContent(digest)
+        blob_path = self.blob_path(digest)
+        new_blob = not os.path.exists(blob_path)
+        if new_blob:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(part_path, blob_path)
+        else:
+            os.remove(part_path)
+        # Link to the now free part path first so an existing file is atomically replaced
+        try:
+            os.link(blob_path, part_path)
+        except OSError:
+            # No hardlinks across filesystems or on this filesystem, keep a plain copy under the final name
+            shutil.copyfile(blob_path, part_path)
+        os.replace(part_path, file_path)
+        return new_blob
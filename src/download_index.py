@@ -0,0 +1,88 @@
+# Persistent index of the files that were completely downloaded to an output folder.
+# The index is an append-only log with one path (relative to the output folder) per line, loaded into a set,
+# so checking if a url was already downloaded does not need to walk the output folder.
+
+import os
+
+
+INDEX_FILE_NAME = '.downloaded'
+
+
+class DownloadIndex:
+    """
+    Set of completely downloaded files, kept up to date by the download engine
+    """
+
+    def __init__(self, output_folder, rebuild=False):
+        """
+        :param output_folder: The folder the files are downloaded to
+        :param rebuild: Rebuild the index from the files on disk instead of loading it
+        """
+        self.output_folder = output_folder
+        self.index_path = os.path.join(output_folder, INDEX_FILE_NAME)
+        self._files = set()
+        os.makedirs(output_folder, exist_ok=True)
+        if rebuild or not os.path.exists(self.index_path):
+            self.rebuild()
+        else:
+            with open(self.index_path, 'r') as f:
+                self._files = {line.rstrip('\n') for line in f if line.endswith('\n')}
+        self._log = open(self.index_path, 'a')
+
+    def _relative_path(self, file_path):
+        return os.path.relpath(file_path, self.output_folder)
+
+    def rebuild(self):
+        """
+        Rebuild the index from the files in the output folder
+
+        Unfinished '.part' files, their '.part.json' metadata and the internal files of the output folder
+        (starting with '.') are left out.
+
+        :return: None
+        """
+        files = set()
+        for root, dirs, names in os.walk(self.output_folder):
+            dirs[:] = [name for name in dirs if not name.startswith('.')]
+            for name in names:
+                if name.startswith('.') or name.endswith('.part') or name.endswith('.part.json'):
+                    continue
+                files.add(self._relative_path(os.path.join(root, name)))
+        with open(self.index_path + '.tmp', 'w') as f:
+            f.writelines(relative_path + '\n' for relative_path in sorted(files))
+        os.replace(self.index_path + '.tmp', self.index_path)
+        self._files = files
+
+    def __contains__(self, file_path):
+        return self._relative_path(file_path) in self._files
+
+    def __len__(self):
+        return len(self._files)
+
+    def add(self, file_path):
+        """
+        Record a completely downloaded file
+
+        :param file_path: The path of the downloaded file
+        :return: None
+        """
+        relative_path = self._relative_path(file_path)
+        if relative_path in self._files:
+            return
+        self._files.add(relative_path)
+        self._log.write(relative_path + '\n')
+        self._log.flush()
+
+    def close(self):
+        """
+        Close the index log
+
+        :return: None
+        """
+        self._log.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,108 @@
+# Append-only journal of the outcome of every url handled by the download engine.
+# Each line is a json object, the last line of a file path is its current outcome, so a later pass can
+# retry only the urls that failed for a transient reason (throttling, server or network errors).
+
+import json
+import os
+import time
+
+
+JOURNAL_FILE_NAME = '.journal.jsonl'
+
+# Outcomes of a url
+DOWNLOADED = 'downloaded'
+SKIPPED = 'skipped'
+REMOVED = 'removed'
+FAILED = 'failed'
+TRANSIENT = 'transient'
+# An album expanded into the jobs of its images
+EXPANDED = 'expanded'
+
+
+class DownloadJournal:
+    """
+    Append-only log of the download outcomes in an output folder
+    """
+
+    def __init__(self, output_folder):
+        """
+        :param output_folder: The folder the files are downloaded to
+        """
+        self.output_folder = output_folder
+        self.journal_path = os.path.join(output_folder, JOURNAL_FILE_NAME)
+        os.makedirs(output_folder, exist_ok=True)
+        self._log = open(self.journal_path, 'a')
+
+    def record(self, job, outcome, status_code=None, error=None):
+        """
+        Record the outcome of a url
+
+        :param job: The DownloadJob of the url
+        :param outcome: One of the outcomes defined in this module
+        :param status_code: The status code of the last response
+        :param error: A short description of the error
+        :return: None
+        """
+        entry = {
+            'time': int(time.time()),
+            'url': job.original_url,
+            'file': os.path.relpath(job.file_path, self.output_folder),
+            'outcome': outcome,
+            'final_url': job.url,
+            'attempts': job.attempts,
+        }
+        if status_code is not None:
+            entry['status'] = status_code
+        if error is not None:
+            entry['error'] = error
+        if job.zip_fallback is not None:
+            entry['zip_fallback'] = job.zip_fallback
+        self._log.write(json.dumps(entry) + '\n')
+        self._log.flush()
+
+    def close(self):
+        """
+        Close the journal
+
+        :return: None
+        """
+        self._log.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def load_outcomes(output_folder):
+    """
+    Load the current outcome of every file in the journal of an output folder
+
+    :param output_folder: The folder the files are downloaded to
+    :return: A dictionary {file path: last journal entry}
+    """
+    journal_path = os.path.join(output_folder, JOURNAL_FILE_NAME)
+    outcomes = {}
+    if not os.path.exists(journal_path):
+        return outcomes
+    with open(journal_path, 'r') as f:
+        for line in f:
+            # Skip a line cut short by a crash
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            outcomes[os.path.join(output_folder, entry['file'])] = entry
+    return outcomes
+
+
+def get_transient_failures(output_folder):
+    """
+    Get the urls whose last outcome is a transient failure
+
+    :param output_folder: The folder the files are downloaded to
+    :return: A list of (url, file path) tuples
+    """
+    return [(entry['url'], file_path) for file_path, entry in load_outcomes(output_folder).items()
+            if entry['outcome'] == TRANSIENT]
@@ -0,0 +1,156 @@
+# Self-contained crawljobs written straight into the folder watched by JDownloader2, without Wastebin.
+#
+# The links are either inlined in the crawljob text or written to a local link list the crawljob refers to.
+# Every file is written under a temporary name and renamed, so JDownloader never reads a half written crawljob.
+# JDownloader renames or moves the crawljobs it has processed, so the '*.crawljob' files left in the folder are
+# the pending ones: new crawljobs are only released while fewer than 'max_pending' are waiting.
+
+import json
+import os
+import time
+
+
+DEFAULT_FOLDERWATCH_PATH = '/folderwatch'
+CRAWLJOB_EXTENSION = '.crawljob'
+
+
+def create_crawljob_entry(text, package_name, comment, download_folder=None):
+    """
+    Create one entry of a .crawljob file
+
+    :param text: The links, or the url of a list of links, to crawl
+    :param package_name: The name of the JDownloader2 package
+    :param comment: The comment of the package
+    :param download_folder: The download folder used by JDownloader2
+    :return: A dictionary with the crawljob entry
+    """
+    return {
+        "text": text,
+        "packageName": package_name,
+        "comment": comment,
+        "autoConfirm": "TRUE",
+        "autoStart": "TRUE",
+        "extractAfterDownload": "FALSE",
+        "overwritePackagizerEnabled": True,
+        "downloadFolder": download_folder if download_folder else "/output/imgur/<jd:packagename>",
+        "deepAnalyseEnabled": True,
+        "addOfflineLink": False
+    }
+
+
+def write_atomically(path, data):
+    """
+    Write a file under a temporary name and rename it to its final name
+
+    The temporary name starts with '.' and does not end with '.crawljob', so JDownloader ignores it.
+
+    :param path: The final path of the file
+    :param data: The text to write
+    :return: None
+    """
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def count_pending_crawljobs(folder):
+    """
+    Count the crawljobs JDownloader2 has not processed yet
+
+    :param folder: The watched folder
+    :return: The number of '*.crawljob' files in the folder
+    """
+    return sum(1 for name in os.listdir(folder) if name.endswith(CRAWLJOB_EXTENSION) and not name.startswith('.'))
+
+
+class FolderwatchWriter:
+    """
+    Writes crawljobs of at most 'link_budget' links into the watched folder, holding them back while
+    'max_pending' crawljobs are waiting to be processed
+    """
+
+    def __init__(self,
+                 folder=DEFAULT_FOLDERWATCH_PATH,
+                 link_budget=5000,
+                 max_pending=2,
+                 poll_interval=10,
+                 links_folder=None,
+                 links_folder_for_jdownloader=None,
+                 download_folder=None):
+        """
+        :param folder: The folder watched by JDownloader2
+        :param link_budget: The maximum number of links in one crawljob
+        :param max_pending: The number of unprocessed crawljobs at which writing pauses. Keep it at 2 or more so a
+            crawljob is always waiting while JDownloader2 processes another one.
+        :param poll_interval: The number of seconds between two counts of the pending crawljobs
+        :param links_folder: Write the links to list files in this folder and refer to them from the crawljobs,
+            the links are inlined in the crawljobs if None
+        :param links_folder_for_jdownloader: The path of links_folder as seen by JDownloader2, if it runs in
+            another container. Defaults to links_folder.
+        :param download_folder: The download folder used by JDownloader2
+        """
+        self.folder = folder
+        self.link_budget = link_budget
+        self.max_pending = max_pending
+        self.poll_interval = poll_interval
+        self.links_folder = links_folder
+        self.links_folder_for_jdownloader = links_folder_for_jdownloader or links_folder
+        self.download_folder = download_folder
+        os.makedirs(folder, exist_ok=True)
+        if links_folder is not None:
+            os.makedirs(links_folder, exist_ok=True)
+
+    def wait_for_capacity(self):
+        """
+        Block until fewer than max_pending crawljobs are waiting in the watched folder
+
+        :return: None
+        """
+        while count_pending_crawljobs(self.folder) >= self.max_pending:
+            time.sleep(self.poll_interval)
+
+    def write_part(self, package_name, part, links):
+        """
+        Write the crawljob of one part of a package once the watched folder has room for it
+
+        :param package_name: The name of the JDownloader2 package
+        :param part: The number of the part
+        :param links: The list of links of the part
+        :return: The path of the crawljob
+        """
+        name = f"{package_name}.{part:05d}"
+        if self.links_folder is not None:
+            write_atomically(os.path.join(self.links_folder, f"{name}.txt"), '\n'.join(links) + '\n')
+            text = f"file://{os.path.join(self.links_folder_for_jdownloader, name + '.txt')}"
+        else:
+            text = '\n'.join(links)
+        entry = create_crawljob_entry(text, package_name, f"Created by Imgur Downloader. Part {part}",
+                                      download_folder=self.download_folder)
+        crawljob_path = os.path.join(self.folder, name + CRAWLJOB_EXTENSION)
+        self.wait_for_capacity()
+        write_atomically(crawljob_path, json.dumps([entry], indent=2))
+        return crawljob_path
+
+    def write_package(self, package_name, links):
+        """
+        Split the links of a package into crawljobs and release them into the watched folder
+
+        :param package_name: The name of the JDownloader2 package
+        :param links: An iterable of links, consumed lazily
+        :return: The number of crawljobs written
+        """
+        part = 0
+        batch = []
+        for link in links:
+            batch.append(link)
+            if len(batch) >= self.link_budget:
+                part += 1
+                self.write_part(package_name, part, batch)
+                batch = []
+        if batch:
+            part += 1
+            self.write_part(package_name, part, batch)
+        return part
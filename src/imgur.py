@@ -1,7 +1,11 @@
 import os
+import re
+import contextlib
 import json
+import functools
 import urllib.request
 import zipfile
+import importlib.util
 import requests
 
 from dotenv import load_dotenv
@@ -10,12 +14,34 @@ from tqdm import tqdm as tqdm_sync
 from tqdm.asyncio import tqdm as tqdm_async
 from apprise import Apprise, AppriseAsset, AppriseConfig, NotifyType, NotifyFormat
 
-
-from urllib.parse import urlparse
+from urllib.parse import urljoin, urlparse
 import asyncio
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import archive_store
+import partial_download
+from album_resolver import AlbumResolver, ManifestCache, get_album_id
+from archive_index import ArchiveIndex
+import download_journal
+import wastebin
+from blob_store import BLOB_FOLDER_NAME, BlobStore, PlaceholderContent, new_hash
+from download_index import DownloadIndex
+from folderwatch import DEFAULT_FOLDERWATCH_PATH, FolderwatchWriter, create_crawljob_entry
+from link_status import DEAD_STATUS_CODES
+from metrics import METRICS, PeriodicSummary, start_exporters_from_environment
+from submission_json import get_imgur_url_from_bytes, get_imgur_url_from_submission
+from throttle import THROTTLE_STATUS_CODES, Throttle
+from work_queue import WorkQueue
 
 load_dotenv()
 
+# Number of bytes read from a response and written to disk at a time
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Number of json files parsed by one worker process at a time during the parallel extraction
+EXTRACTION_SHARD_SIZE = 500
+
 
 #
 # # Function to download file from url
@@ -46,21 +72,14 @@ def get_imgur_url(submission_json, filter_moderated=True):
     """
     Get the imgur url from a submission json file
 
-    :param submission_json: The submission json file
+    :param submission_json: The submission json file, or a submission dictionary read from the archive segments
     :param filter_moderated: Whether to filter out moderated submissions
     :return: The imgur url
     """
-    with open(submission_json) as json_file:
-        submission = json.load(json_file)
-        if filter_moderated:
-            if "removed_by_category" in submission.keys():
-                if submission["removed_by_category"] is not None:
-                    return None
-        if 'domain' in submission.keys() and 'url' in submission.keys():
-            if submission['domain'] is not None and submission['url'] is not None:
-                if 'imgur' in submission['domain'] and 'imgur' in submission['url']:
-                    return submission['url']
-    return None
+    if isinstance(submission_json, dict):
+        return get_imgur_url_from_submission(submission_json, filter_moderated)
+    with open(submission_json, 'rb') as json_file:
+        return get_imgur_url_from_bytes(json_file.read(), filter_moderated)
 
 
 def get_imgur_urls_from_subreddit(subreddit_folder):
@@ -74,20 +93,76 @@ def get_imgur_urls_from_subreddit(subreddit_folder):
     json_files = [os.path.join(subreddit_folder, f) for f in os.listdir(subreddit_folder) if f.endswith('.json')]
     # Get all imgur urls from the json files
     imgur_urls = [get_imgur_url(json_file) for json_file in json_files]
+    # Get all imgur urls from the compressed archive segments
+    imgur_urls += [get_imgur_url(submission) for submission in archive_store.iter_submissions(subreddit_folder)]
     # Remove None values
     imgur_urls = [url for url in imgur_urls if url is not None]
     return imgur_urls
 
 
-def write_imgur_urls_from_subreddit_to_file(subreddit_folder_path,
-                                            output_folder=None,
-                                            output_file=None,
-                                            recreate_file=False):
+def get_extraction_shards(subreddit_folder_path, shard_size=EXTRACTION_SHARD_SIZE):
     """
-    Write all imgur urls from a subreddit folder to a file
+    Split the archive of a subreddit into shards that can be parsed independently
 
-    :param subreddit_folder: The folder containing the subreddit json files
+    The json files are sorted so the order of the extracted urls does not depend on the file system.
+    Each compressed archive segment is its own shard.
+
+    :param subreddit_folder_path: The folder containing the subreddit json files
+    :param shard_size: The maximum number of json files in a shard
+    :return: A list of ('files', [json file paths]) and ('segment', (segment path, start, end)) tuples
+    """
+    # Get a sorted list of all the '.json' files in the subreddit folder recursively
+    json_files = sorted(os.path.join(root, file) for root, dirs, files in os.walk(subreddit_folder_path)
+                        for file in files if file.endswith('.json'))
+    shards = [('files', json_files[i:i + shard_size]) for i in range(0, len(json_files), shard_size)]
+    shards += [('segment', (segment_path, 0, None))
+               for segment_path in archive_store.list_segments(subreddit_folder_path)]
+    return shards
+
+
+def get_shard_size(shard):
+    """
+    Get the number of files in a shard, used for progress reporting
+
+    :param shard: A shard returned by get_extraction_shards
+    :return: The number of files in the shard
+    """
+    kind, source = shard
+    return len(source) if kind == 'files' else 1
+
+
+def extract_imgur_urls_from_shard(shard):
+    """
+    Extract the imgur urls from a shard
+
+    This runs in the worker processes of the parallel extraction, so it only returns the urls and never
+    writes to the output file.
+
+    :param shard: A shard returned by get_extraction_shards
+    :return: A list with one list of imgur urls for each json file (or one for a segment), in archive order
+    """
+    kind, source = shard
+    if kind == 'files':
+        imgur_urls = [get_imgur_url(json_file) for json_file in source]
+        return [[url] if url is not None else [] for url in imgur_urls]
+    segment_path, start_offset, end_offset = source
+    imgur_urls = [get_imgur_url_from_bytes(line) for line in
+                  archive_store.iter_segment_lines(segment_path, start_offset=start_offset, end_offset=end_offset)]
+    return [[url for url in imgur_urls if url is not None]]
+
+
+def get_imgur_urls_output_path(subreddit_folder_path,
+                               output_folder=None,
+                               output_file=None,
+                               recreate_file=False):
+    """
+    Get the path of the file the imgur urls of a subreddit are written to
+
+    :param subreddit_folder_path: The folder containing the subreddit json files
+    :param output_folder: The folder to write the file to
     :param output_file: The file to write the imgur urls to
+    :param recreate_file: Delete the output file if it already exists
+    :return: The output file path
     """
     # If no output file is specified, use the subreddit folder name
     if output_file is None:
@@ -105,20 +180,337 @@ def write_imgur_urls_from_subreddit_to_file(subreddit_folder_path,
     # If the output file already exists, delete it if recreate_file is True
     if recreate_file and os.path.exists(output_file_path):
         os.remove(output_file_path)
+    return output_file_path
+
+
+def get_manifest_path(output_file_path):
+    """
+    Get the path of the extraction manifest of an output file
+
+    The manifests are kept in a '.manifests' folder next to the link files, so the link folder only contains links.
+
+    :param output_file_path: The file the imgur urls are written to
+    :return: The manifest file path
+    """
+    output_folder, output_file = os.path.split(output_file_path)
+    return os.path.join(output_folder, '.manifests', output_file + '.json')
+
+
+def load_extraction_manifest(manifest_path):
+    """
+    Load an extraction manifest
+
+    The manifest records what was already parsed:
+    - 'files': {relative path: [size, mtime_ns, [imgur urls]]}
+    - 'segments': {relative path: [parsed end offset, [imgur urls]]}
+
+    :param manifest_path: The manifest file path
+    :return: The manifest dictionary, or None if there is no manifest
+    """
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def save_extraction_manifest(manifest_path, manifest):
+    """
+    Atomically save an extraction manifest
+
+    :param manifest_path: The manifest file path
+    :param manifest: The manifest dictionary
+    :return: None
+    """
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def scan_json_files(folder_path):
+    """
+    Recursively get the size and modification time of all the '.json' files in a folder
+
+    :param folder_path: The folder to scan
+    :return: A dictionary {relative path: (size, mtime_ns)}
+    """
+    json_files = {}
+    folders = [folder_path]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    json_files[os.path.relpath(entry.path, folder_path)] = (stat.st_size, stat.st_mtime_ns)
+    return json_files
+
+
+def plan_imgur_url_extraction(subreddit_folder_path, output_file_path, incremental=False):
+    """
+    Decide which parts of a subreddit archive have to be parsed
+
+    Without incremental mode every json file and segment is parsed and the urls are appended to the output file.
+    In incremental mode the manifest of the previous run is compared with the archive:
+    - new json files, and the part of a segment appended since the last run, are parsed
+    - changed or deleted json files, and segments that shrank, make the output stale, so it is rewritten
+        from the manifest instead of appended to
+    - if the new entries do not sort after the existing ones the output is also rewritten, to keep the same
+        order as a full run
+
+    :param subreddit_folder_path: The folder containing the subreddit json files
+    :param output_file_path: The file the imgur urls are written to
+    The plan only keeps what changed, the manifest with the urls of every file is loaded again when the plan is
+    written, so the plans made ahead of their turn stay small.
+
+    :param incremental: Only parse what changed since the last run
+    :return: A plan dictionary used by finish_imgur_url_extraction
+    """
+    started = time.monotonic()
+    if not incremental:
+        plan = {'output_file_path': output_file_path,
+                'shards': get_extraction_shards(subreddit_folder_path),
+                'incremental': False}
+        METRICS.observe('extraction_stage_seconds', time.monotonic() - started, stage='plan')
+        return plan
+    manifest_path = get_manifest_path(output_file_path)
+    manifest = load_extraction_manifest(manifest_path) if os.path.exists(output_file_path) else None
+    # Without a manifest we do not know what is in the output file, so start from scratch
+    rewrite = manifest is None
+    if manifest is None:
+        manifest = {'files': {}, 'segments': {}}
+    known_files = manifest['files']
+    known_segments = manifest['segments']
+    # The manifest entries to drop when the plan is written
+    stale_files = []
+    stale_segments = []
+    new_keys = []
+    # Compare the json files with the manifest
+    json_files = scan_json_files(subreddit_folder_path) if os.path.isdir(subreddit_folder_path) else {}
+    new_files = []
+    for relative_path in sorted(json_files):
+        size, mtime_ns = json_files[relative_path]
+        entry = known_files.get(relative_path)
+        if entry is not None and entry[0] == size and entry[1] == mtime_ns:
+            continue
+        if entry is not None:
+            rewrite = True
+        new_files.append(relative_path)
+        new_keys.append((0, relative_path))
+    for relative_path in [path for path in known_files if path not in json_files]:
+        del known_files[relative_path]
+        stale_files.append(relative_path)
+        rewrite = True
+    # Compare the segments with the manifest
+    segment_ranges = []
+    segment_paths = archive_store.list_segments(subreddit_folder_path)
+    segment_names = {os.path.relpath(path, subreddit_folder_path) for path in segment_paths}
+    for segment_path in segment_paths:
+        relative_path = os.path.relpath(segment_path, subreddit_folder_path)
+        end_offset = archive_store.get_segment_end(segment_path)
+        entry = known_segments.get(relative_path)
+        start_offset = 0
+        if entry is not None and end_offset == entry[0]:
+            continue
+        if entry is not None and end_offset > entry[0]:
+            start_offset = entry[0]
+        elif entry is not None:
+            # The segment shrank, parse it again from the start
+            del known_segments[relative_path]
+            stale_segments.append(relative_path)
+            rewrite = True
+        segment_ranges.append((relative_path, start_offset, end_offset))
+        new_keys.append((1, relative_path))
+    for relative_path in [path for path in known_segments if path not in segment_names]:
+        del known_segments[relative_path]
+        stale_segments.append(relative_path)
+        rewrite = True
+    # Appending keeps the order of a full run only if every new entry sorts after the existing ones
+    existing_keys = [(0, path) for path in known_files if known_files[path][2]] + \
+                    [(1, path) for path in known_segments if known_segments[path][1]]
+    if new_keys and existing_keys and min(new_keys) <= max(existing_keys):
+        rewrite = True
+    shards = [('files', [os.path.join(subreddit_folder_path, path) for path in new_files[i:i + EXTRACTION_SHARD_SIZE]])
+              for i in range(0, len(new_files), EXTRACTION_SHARD_SIZE)]
+    shards += [('segment', (os.path.join(subreddit_folder_path, path), start_offset, end_offset))
+               for path, start_offset, end_offset in segment_ranges]
+    METRICS.observe('extraction_stage_seconds', time.monotonic() - started, stage='plan')
+    return {'output_file_path': output_file_path,
+            'shards': shards,
+            'incremental': True,
+            'manifest_path': manifest_path,
+            'stale_files': stale_files,
+            'stale_segments': stale_segments,
+            'subreddit_folder_path': subreddit_folder_path,
+            # Only the size and modification time of the files to parse
+            'json_files': {path: json_files[path] for path in new_files},
+            'rewrite': rewrite}
+
+
+def timed_url_batches(shards, url_batches, parse_seconds):
+    """
+    Count the parsed files and urls of the batches and time how long the writer waited for them
+
+    :param shards: The shards the batches are extracted from, in the same order
+    :param url_batches: An iterable with the result of extract_imgur_urls_from_shard for each shard
+    :param parse_seconds: A one item list the waiting time is added to
+    :return: A generator yielding the batches
+    """
+    url_batches = iter(url_batches)
+    for shard in shards:
+        started = time.monotonic()
+        try:
+            url_lists = next(url_batches)
+        except StopIteration:
+            return
+        parse_seconds[0] += time.monotonic() - started
+        METRICS.inc('extraction_files_total', get_shard_size(shard))
+        METRICS.inc('extraction_urls_total', sum(len(imgur_urls) for imgur_urls in url_lists))
+        yield url_lists
+
+
+def finish_imgur_url_extraction(plan, url_batches, desc, dedup_index=None, subreddit=None):
+    """
+    Write the urls extracted for a plan and update its manifest
+
+    The manifest always records every extracted url, the dedup index only filters what is written to the output.
+    The time spent waiting for the batches is recorded as the 'parse' stage and the rest as the 'write' stage.
+
+    :param plan: A plan returned by plan_imgur_url_extraction
+    :param url_batches: An iterable with the result of extract_imgur_urls_from_shard for each shard of the plan
+    :param desc: The description of the progress bar
+    :param dedup_index: An imgur_index.ImgurIdIndex, only the urls claimed by the subreddit are written
+    :param subreddit: The subreddit claiming the urls in the dedup index
+    :return: None
+    """
+    started = time.monotonic()
+    parse_seconds = [0.0]
+    url_batches = timed_url_batches(plan['shards'], url_batches, parse_seconds)
+    try:
+        write_extracted_imgur_urls(plan, url_batches, desc, dedup_index=dedup_index, subreddit=subreddit)
+    finally:
+        METRICS.observe('extraction_stage_seconds', parse_seconds[0], stage='parse')
+        METRICS.observe('extraction_stage_seconds', time.monotonic() - started - parse_seconds[0], stage='write')
+
+
+def write_extracted_imgur_urls(plan, url_batches, desc, dedup_index=None, subreddit=None):
+    """
+    Write the urls extracted for a plan and update its manifest, see finish_imgur_url_extraction
+    """
+    output_file_path = plan['output_file_path']
+    shards = plan['shards']
+    if not plan['incremental']:
+        write_imgur_url_batches(output_file_path, shards, url_batches, desc,
+                                dedup_index=dedup_index, subreddit=subreddit)
+        return
+    # A plan that rewrites the output from scratch starts from an empty manifest
+    manifest = load_extraction_manifest(plan['manifest_path']) if os.path.exists(output_file_path) else None
+    if manifest is None:
+        manifest = {'files': {}, 'segments': {}}
+    for relative_path in plan['stale_files']:
+        manifest['files'].pop(relative_path, None)
+    for relative_path in plan['stale_segments']:
+        manifest['segments'].pop(relative_path, None)
+    # Record the result of every parsed file in the manifest
+    appended = []
+    with tqdm_sync(total=sum(get_shard_size(shard) for shard in shards), desc=desc, unit='file') as progress:
+        for (kind, source), url_lists in zip(shards, url_batches):
+            if kind == 'files':
+                for json_file, imgur_urls in zip(source, url_lists):
+                    relative_path = os.path.relpath(json_file, plan['subreddit_folder_path'])
+                    size, mtime_ns = plan['json_files'][relative_path]
+                    manifest['files'][relative_path] = [size, mtime_ns, imgur_urls]
+                    appended += imgur_urls
+            else:
+                segment_path, start_offset, end_offset = source
+                relative_path = os.path.relpath(segment_path, plan['subreddit_folder_path'])
+                previous_urls = manifest['segments'][relative_path][1] if start_offset > 0 else []
+                manifest['segments'][relative_path] = [end_offset, previous_urls + url_lists[0]]
+                appended += url_lists[0]
+            progress.update(get_shard_size((kind, source)))
+    if plan['rewrite']:
+        # Rebuild the whole output file from the manifest in archive order
+        with open(output_file_path + '.tmp', 'w') as f:
+            for relative_path in sorted(manifest['files']):
+                f.writelines(imgur_url + '\n' for imgur_url in
+                             claim_imgur_urls(manifest['files'][relative_path][2], dedup_index, subreddit))
+            for relative_path in sorted(manifest['segments']):
+                f.writelines(imgur_url + '\n' for imgur_url in
+                             claim_imgur_urls(manifest['segments'][relative_path][1], dedup_index, subreddit))
+        os.replace(output_file_path + '.tmp', output_file_path)
+    elif appended:
+        with open(output_file_path, 'a') as f:
+            f.writelines(imgur_url + '\n' for imgur_url in claim_imgur_urls(appended, dedup_index, subreddit))
+    # Save the manifest after the output, so a crash in between only causes the delta to be parsed again
+    save_extraction_manifest(plan['manifest_path'], manifest)
+
+
+def write_imgur_url_batches(output_file_path, shards, url_batches, desc, dedup_index=None, subreddit=None):
+    """
+    Write batches of imgur urls to a file, keeping the file open for the whole subreddit
+
+    :param output_file_path: The file to write the imgur urls to
+    :param shards: The shards the batches were extracted from, in the same order
+    :param url_batches: An iterable with the result of extract_imgur_urls_from_shard for each shard
+    :param desc: The description of the progress bar
+    :param dedup_index: An imgur_index.ImgurIdIndex, only the urls claimed by the subreddit are written
+    :param subreddit: The subreddit claiming the urls in the dedup index
+    :return: The number of urls written
+    """
+    written = 0
+    with open(output_file_path, 'a') as f, \
+            tqdm_sync(total=sum(get_shard_size(shard) for shard in shards), desc=desc, unit='file') as progress:
+        for shard, url_lists in zip(shards, url_batches):
+            for imgur_urls in url_lists:
+                imgur_urls = list(claim_imgur_urls(imgur_urls, dedup_index, subreddit))
+                f.writelines(imgur_url + '\n' for imgur_url in imgur_urls)
+                written += len(imgur_urls)
+            progress.update(get_shard_size(shard))
+    return written
+
+
+def write_imgur_urls_from_subreddit_to_file(subreddit_folder_path,
+                                            output_folder=None,
+                                            output_file=None,
+                                            recreate_file=False,
+                                            workers=1,
+                                            executor=None,
+                                            incremental=False,
+                                            dedup_index=None):
+    """
+    Write all imgur urls from a subreddit folder to a file
+
+    With workers > 1 (or an existing executor) the json files are split into shards and parsed in a process pool.
+    The results are written in shard order, so the output is the same as with a single process.
+
+    With incremental=True a manifest of the parsed files is kept next to the output file, and later runs only
+    parse the files and segment data added since (see plan_imgur_url_extraction).
+
+    :param subreddit_folder: The folder containing the subreddit json files
+    :param output_file: The file to write the imgur urls to
+    :param workers: The number of processes used to parse the json files
+    :param executor: An existing concurrent.futures.ProcessPoolExecutor to use instead of creating one
+    :param incremental: Only parse the files that changed since the last run
+    :param dedup_index: An imgur_index.ImgurIdIndex, urls already claimed by another subreddit are not written
+    """
+    output_file_path = get_imgur_urls_output_path(subreddit_folder_path,
+                                                  output_folder=output_folder,
+                                                  output_file=output_file,
+                                                  recreate_file=recreate_file)
     # Get the subreddit name from the subreddit_folder_path
     subreddit_name = subreddit_folder_path.split('/')[-1]
-    # Get a list of all the '.json' files in the subreddit folder recursively
-    json_files = [os.path.join(root, file) for root, dirs, files in os.walk(subreddit_folder_path) for file in files if
-                  file.endswith('.json')]
-    for i in tqdm_sync(range(len(json_files)),
-                       desc=f'Parsing {subreddit_name} json files',
-                       unit='file'):
-        # Get the imgur url from the json file
-        imgur_url = get_imgur_url(json_files[i])
-        if imgur_url is not None:
-            # Write the imgur url to the output file
-            with open(output_file_path, 'a') as f:
-                f.write(imgur_url + '\n')
+    plan = plan_imgur_url_extraction(subreddit_folder_path, output_file_path, incremental=incremental)
+    shards = plan['shards']
+    desc = f'Parsing {subreddit_name} json files'
+    if executor is None and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            finish_imgur_url_extraction(plan, executor.map(extract_imgur_urls_from_shard, shards), desc,
+                                        dedup_index=dedup_index, subreddit=subreddit_name)
+    else:
+        mapper = executor.map if executor is not None else map
+        finish_imgur_url_extraction(plan, mapper(extract_imgur_urls_from_shard, shards), desc,
+                                    dedup_index=dedup_index, subreddit=subreddit_name)
     # # Traverse the subreddit folder recursively
     # for root, dirs, files in os.walk(subreddit_folder_path):
     #     for file in files:
@@ -131,255 +523,1199 @@ def write_imgur_urls_from_subreddit_to_file(subreddit_folder_path,
     #                     f.write(imgur_url + '\n')
 
 
-def transform_imgur_url_for_download(imgur_url):
+# Host and path of an absolute or scheme relative url, like urlparse(url).netloc and urlparse(url).path
+IMGUR_URL_PATTERN = re.compile(r'^(?:[A-Za-z][A-Za-z0-9+.-]*:)?//([^/?#]*)([^?#]*)')
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def classify_imgur_url(imgur_url):
+    """
+    Classify an imgur url and build its downloadable url
+
+    The result is memoized, so the urls repeated across link files are only classified once.
+
+    :param imgur_url: The imgur url
+    :return: A (downloadable url, None) tuple, or (None, reason) if the url is not supported
+    """
+    match = IMGUR_URL_PATTERN.match(imgur_url)
+    if match is None:
+        return None, 'NOT SUPPORTED'
+    host, path = match.groups()
+    if host == 'imgur.com':
+        if '.' in path:
+            download_url = f"https://{host}{path}"
+        elif '/a/' in path:
+            download_url = f"https://{host}{path}/zip"
+        elif '/gallery/' in path:
+            # Gallery ids are album ids, the album resolver also handles the galleries of a single image.
+            # New style gallery urls put a title before the id: /gallery/<title>-<id>
+            gallery_id = path.split('/gallery/', 1)[1].split('/')[0].rpartition('-')[2]
+            if not gallery_id:
+                return None, 'NOT SUPPORTED: Gallery'
+            download_url = f"https://{host}/a/{gallery_id}/zip"
+        else:
+            download_url = f"https://{host}{path}.png"
+    elif host == 'i.imgur.com':
+        download_url = f"https://{host}{path}"
+    elif host == 'm.imgur.com':
+        download_url = f"https://i.imgur.com{path}"
+    else:
+        return None, 'NOT SUPPORTED'
+    if download_url.endswith('.gifv'):
+        download_url = download_url.replace('.gifv', '.mp4')
+    return download_url, None
+
+
+def transform_imgur_url_for_download(imgur_url, verbose=True):
     """
     Transform an imgur url to a downloadable url
 
     :param imgur_url: The imgur url to transform
+    :param verbose: Print a warning for unsupported urls
     :return: The downloadable url
     """
-    url_components = urlparse(imgur_url)
-    return_val = ""
-    match url_components.netloc:
-        case 'imgur.com':
-            if '.' in url_components.path:
-                return_val = f"https://{url_components.netloc}{url_components.path}"
-            elif '/a/' in url_components.path:
-                return_val = f"https://{url_components.netloc}{url_components.path}/zip"
-            elif '/gallery/' in url_components.path:
-                print(f"WARNING NOT SUPPORTED: Gallery: {imgur_url}")
-                return None
+    download_url, reason = classify_imgur_url(imgur_url)
+    if download_url is None and verbose:
+        print(f"WARNING {reason}: {imgur_url}")
+    return download_url
+
+
+def get_download_filename(download_url):
+    """
+    Get the name of the file a downloadable url is saved to
+
+    If the url ends with /zip, the filename is the id.zip
+    If the url ends with .<ext>, the filename is the id.<ext>
+    If the url ends with nothing, the filename is the id.jpg
+
+    :param download_url: The url returned by transform_imgur_url_for_download
+    :return: The filename
+    """
+    head, _, name = download_url.rpartition('/')
+    if name == 'zip':
+        return head.rpartition('/')[2] + '.zip'
+    if '.' in name:
+        return name
+    return name + '.jpg'
+
+
+def get_imgur_asset_key(imgur_url):
+    """
+    Get the canonical (kind, imgur id) key of an imgur url
+
+    The url is normalized with transform_imgur_url_for_download, so all the forms of the same image
+    (imgur.com, i.imgur.com, m.imgur.com, .gifv and .mp4) get the same key.
+
+    :param imgur_url: The imgur url
+    :return: An ('image' or 'album', imgur id) tuple, or None if the url is not supported
+    """
+    download_url = transform_imgur_url_for_download(imgur_url.strip(), verbose=False)
+    if download_url is None:
+        return None
+    path_components = urlparse(download_url).path.split('/')
+    if download_url.endswith('/zip'):
+        return 'album', path_components[-2]
+    return 'image', path_components[-1].split('.')[0]
+
+
+def claim_imgur_urls(imgur_urls, dedup_index, subreddit):
+    """
+    Filter a list of imgur urls down to the ones claimed by a subreddit in a dedup index
+
+    Urls without a key (unsupported urls) are always kept.
+
+    :param imgur_urls: An iterable of imgur urls
+    :param dedup_index: An imgur_index.ImgurIdIndex, or None to keep every url
+    :param subreddit: The subreddit claiming the urls
+    :return: A generator of the claimed imgur urls
+    """
+    for imgur_url in imgur_urls:
+        if dedup_index is not None:
+            key = get_imgur_asset_key(imgur_url)
+            if key is not None and not dedup_index.claim(*key, subreddit):
+                continue
+        yield imgur_url
+
+
+def iter_links(lines, dedup_index=None, subreddit=None, link_status=None):
+    """
+    Lazily clean up the lines of a link file
+
+    :param lines: An iterable of lines, e.g. an open link file
+    :param dedup_index: An imgur_index.ImgurIdIndex, the urls claimed by another subreddit are left out
+    :param subreddit: The subreddit claiming the urls in the dedup index
+    :param link_status: A link_status.LinkStatusCache, the links it knows to be dead are left out
+    :return: A generator of the stripped, non empty links
+    """
+    imgur_urls = (line.strip() for line in lines)
+    imgur_urls = (imgur_url for imgur_url in imgur_urls if imgur_url)
+    # Skip the imgur assets already claimed by another subreddit
+    imgur_urls = claim_imgur_urls(imgur_urls, dedup_index, subreddit)
+    # Skip the links the validator found dead
+    if link_status is not None:
+        imgur_urls = (imgur_url for imgur_url in imgur_urls if not link_status.is_dead(imgur_url))
+    return imgur_urls
+
+
+def get_download_headers():
+    """
+    Get the headers used by the download engine for every request
+
+    The user agent can be overridden with the USER_AGENT environment variable
+
+    :return: A dictionary with the request headers
+    """
+    if "USER_AGENT" in os.environ:
+        user_agent = os.environ["USER_AGENT"]
+    else:
+        user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/112.0.0.0 Safari/537.36"
+    return {
+        "User-Agent": user_agent,
+        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
+        "Accept-Language": "en-US,en;q=0.5",
+        "Accept-Encoding": "gzip, deflate, br",
+        "Connection": "keep-alive",
+        "Upgrade-Insecure-Requests": "1",
+        "Sec-Fetch-Dest": "document",
+        "Sec-Fetch-Mode": "navigate",
+        "Sec-Fetch-Site": "none",
+        "Sec-Fetch-User": "?1",
+        "Sec-GPC": "1",
+        "TE": "trailers"
+    }
+
+
+def create_download_client(concurrency=8, http2=False, transport=None):
+    """
+    Create the pooled http client shared by all the download workers
+
+    The client keeps connections alive between requests, so consecutive downloads from the same host reuse the
+    same connection instead of doing a new TLS handshake every time.
+
+    :param concurrency: The maximum number of connections kept open at the same time
+    :param http2: Use HTTP/2 if the optional 'h2' package is installed
+    :param transport: An httpx transport replacing the network, e.g. standin.RewritingTransport
+    :return: An httpx.AsyncClient
+    """
+    if http2 and importlib.util.find_spec('h2') is None:
+        print("WARNING: http2 requested but the 'h2' package is not installed, falling back to HTTP/1.1")
+        http2 = False
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency,
+                          keepalive_expiry=30)
+    return httpx.AsyncClient(headers=get_download_headers(),
+                             limits=limits,
+                             http2=http2,
+                             transport=transport)
+
+
+def write_all(fd, data):
+    """
+    Write a whole buffer to a file descriptor, retrying on partial writes
+
+    :param fd: The file descriptor to write to
+    :param data: The bytes to write
+    :return: None
+    """
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+async def write_response_to_file(res,
+                                 file_path,
+                                 chunk_size=DOWNLOAD_CHUNK_SIZE,
+                                 progress=None,
+                                 blob_store=None,
+                                 url=None,
+                                 resume_from=0):
+    """
+    Stream a response body to a file in large chunks
+
+    The body is written to '<file_path>.part' and renamed to file_path only when the whole body was received,
+    so an interrupted download never leaves a truncated file under the final name.
+    If the response can be resumed the part is kept when the download is interrupted, with a metadata sidecar
+    the next attempt resumes it from (see partial_download.py).
+    With a blob store the body is hashed while it streams, stored once under its hash and file_path becomes a
+    hardlink to the stored blob.
+
+    :param res: The streamed httpx response
+    :param file_path: The path to write the file to
+    :param chunk_size: The number of bytes read from the response and written to disk at a time
+    :param progress: A shared tqdm progress bar updated with the number of bytes written
+    :param blob_store: A blob_store.BlobStore the content is stored in
+    :param url: The requested url, recorded to resume the download. Defaults to the url of the request.
+    :param resume_from: The number of bytes of the part the body continues, 0 to write the part from the start
+    :return: The number of bytes written
+    :raise blob_store.PlaceholderContent: If the content is a known placeholder image
+    """
+    part_path = partial_download.get_part_path(file_path)
+    written = 0
+    content_hash = new_hash() if blob_store is not None else None
+    metadata = partial_download.get_part_metadata(res, url if url is not None else str(res.request.url))
+    if metadata is not None:
+        partial_download.save_part_metadata(file_path, metadata)
+    if resume_from:
+        # The hash covers the bytes written before the interruption
+        if content_hash is not None:
+            with open(part_path, 'rb') as f:
+                for chunk in iter(functools.partial(f.read, chunk_size), b''):
+                    content_hash.update(chunk)
+        fd = os.open(part_path, os.O_WRONLY | os.O_APPEND)
+        METRICS.inc('download_resumed_total')
+    else:
+        fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        async for chunk in res.aiter_bytes(chunk_size):
+            write_all(fd, chunk)
+            written += len(chunk)
+            METRICS.inc('download_bytes_total', len(chunk))
+            if content_hash is not None:
+                content_hash.update(chunk)
+            if progress is not None:
+                progress.update(len(chunk))
+    except BaseException:
+        os.close(fd)
+        # Keep what was written if the next attempt can resume it
+        if metadata is None:
+            partial_download.remove_part(file_path)
+        raise
+    os.close(fd)
+    # The part is complete, its metadata is not needed anymore
+    partial_download.remove_part(file_path, keep_data=True)
+    if blob_store is not None:
+        blob_store.commit(part_path, content_hash.hexdigest(), file_path)
+    else:
+        # Atomically move the finished file to its final name
+        os.replace(part_path, file_path)
+    return written
+
+
+class DownloadJob:
+    """
+    State of one url in the download engine
+
+    The engine moves a job from request to request: redirects and the 'download' url rewrite change job.url,
+    retries are scheduled with an exponential backoff, until the job reaches one of the outcomes of
+    download_journal.
+    """
+
+    def __init__(self, url, file_path):
+        """
+        :param url: The url to download
+        :param file_path: The path to write the file to
+        """
+        self.original_url = url
+        self.url = url
+        self.file_path = file_path
+        # Number of redirects followed since the last retry
+        self.redirects = 0
+        # Number of retries after a transient failure
+        self.attempts = 0
+        self.rewrote_download_url = False
+        self.status_code = None
+        self.error = None
+        # Why an album is downloaded as a zip instead of being expanded into its images
+        self.zip_fallback = None
+        # The jobs for the same file waiting for this one to finish
+        self.duplicates = []
+
+    def backoff(self, base=1.0, cap=60.0):
+        """
+        Get the delay before the next retry, exponential with full jitter
+
+        :param base: The delay of the first retry
+        :param cap: The longest delay
+        :return: The number of seconds to wait
+        """
+        return random.uniform(0, min(cap, base * 2 ** self.attempts))
+
+    def restart(self):
+        """
+        Go back to the original url for a retry
+
+        :return: None
+        """
+        self.attempts += 1
+        self.redirects = 0
+        self.url = self.original_url
+        # The retry goes through the same redirects, and rewrites of the 'download' url, as the first attempt
+        self.rewrote_download_url = False
+
+
+# States returned by download() that are not a final outcome
+# REDIRECT requests job.url right away, RETRY requests the original url again after a backoff
+REDIRECT = 'redirect'
+RETRY = 'retry'
+MAX_REDIRECTS = 10
+MAX_ATTEMPTS = 6
+
+
+async def download(http,
+                   job,
+                   chunk_size=DOWNLOAD_CHUNK_SIZE,
+                   progress=None,
+                   download_index=None,
+                   throttle=None,
+                   blob_store=None
+                   ):
+    """
+    Send one request for a download job and return its next state
+
+    It treats the following status codes as valid:
+    200: OK
+    301: Moved Permanently
+    302: Found
+    303: See Other
+    307: Temporary Redirect
+    308: Permanent Redirect
+
+    It treats the following edge cases:
+    - If the request does not receive a valid status code it will treat it as a permanent failure
+    - If the request is redirtected to a url that contains the 'download' keyword it will redirect it to the
+        url 'https://i.imgur.com/<id>.png' where <id> is the id in the original url
+        We presume the original url is in the form of 'https://imgur.com/download/<id>/'
+        This is usually the case for albums that contain only one image and which we tried to download as a zip file
+    - If the server throttles the request (429 or 503) or answers with a server
+        error the job is retried from the original url, the token bucket of the host honors the Retry-After header
+    - If an earlier attempt on the same url was interrupted, only the rest of the file is requested with a Range
+        request and appended to the kept part (see partial_download.py). A server ignoring the range answers
+        with the whole file, which overwrites the part.
+
+    :param http: The shared http client created with create_download_client
+    :param job: The DownloadJob, its url is requested
+    :param chunk_size: The number of bytes read from the response and written to disk at a time
+    :param progress: A shared tqdm progress bar updated with the number of bytes written
+    :param download_index: A download_index.DownloadIndex the completed file is recorded in
+    :param throttle: A throttle.Throttle pacing the requests to each host, no pacing if None
+    :param blob_store: A blob_store.BlobStore the downloaded content is stored in
+    :return: REDIRECT to request job.url right away, RETRY to retry the job later, or one of the outcomes of
+        download_journal
+    """
+    download_url = job.url
+    file_path = job.file_path
+    if not job.rewrote_download_url and 'download' in download_url.lower():
+        print(f"WARNING: {download_url} contains download")
+        imgur_id = download_url.rstrip('/').split('/')[-1]
+        job.url = f"https://i.imgur.com/{imgur_id}.png"
+        job.rewrote_download_url = True
+        return REDIRECT
+    print(f"Downloading {download_url} to {file_path}")
+    # Wait for the token bucket of the host
+    if throttle is not None:
+        await throttle.before_request(download_url)
+    # Ask for the rest of an interrupted download of this url
+    resume_headers = partial_download.get_resume_headers(file_path, download_url)
+    started = time.monotonic()
+    async with http.stream(method='GET', url=download_url, headers=resume_headers) as res:
+        job.status_code = res.status_code
+        METRICS.inc('download_requests_total', status=str(res.status_code))
+        METRICS.observe('download_request_seconds', time.monotonic() - started)
+        throttled = False
+        if throttle is not None:
+            throttled = throttle.on_response(download_url, res.status_code, time.monotonic() - started,
+                                             headers=res.headers)
+        # Retry later if the server throttled the request or could not answer it
+        if throttled or res.status_code >= 500:
+            print(f"WARNING: {res.status_code} - {download_url}")
+            return RETRY
+        # Follow the redirect if the response is a redirect
+        if res.is_redirect:
+            # The Location may be relative to the url that was requested
+            new_download_url = urljoin(download_url, res.headers['Location'])
+            if 'removed' in new_download_url.lower():
+                print(f"ERROR: {res.status_code} - {download_url} => {new_download_url}")
+                return download_journal.REMOVED
+            if job.redirects >= MAX_REDIRECTS:
+                print(f"ERROR: MAX REDIRECTS {res.status_code} - {download_url} => {new_download_url}")
+                job.error = 'too many redirects'
+                return download_journal.FAILED
+            job.redirects += 1
+            job.url = new_download_url
+            return REDIRECT
+        # The part does not match the file anymore, download it again from the start
+        if resume_headers and res.status_code == 416:
+            print(f"WARNING: cannot resume {download_url}, starting over")
+            partial_download.remove_part(file_path)
+            return REDIRECT
+        # Check if the response is successful
+        if res.status_code not in (200, 206) or (res.status_code == 206 and not resume_headers):
+            print(f"ERROR: {res.status_code} - {download_url}")
+            return download_journal.FAILED
+        resume_from = 0
+        if res.status_code == 206:
+            resume_from = partial_download.get_resume_offset(res, file_path)
+            if resume_from is None:
+                print(f"WARNING: {download_url} answered a range that does not continue the part, starting over")
+                partial_download.remove_part(file_path)
+                return REDIRECT
+        elif resume_headers:
+            print(f"WARNING: {download_url} ignored the range request, starting over")
+        # Get the file size from the response headers, 0 if unknown
+        size = partial_download.get_total_length(res) or 0
+        name = file_path.split('/')[-1]
+        # Check if the file exists and if the file size is the same
+        # If the 'size' is 0, the file size is unknown and the file will be downloaded
+        if os.path.exists(file_path) and size != 0 and os.path.getsize(file_path) == size:
+            print(f"SKIP: {name}")
+            if download_index is not None:
+                download_index.add(file_path)
+            return download_journal.SKIPPED
+        if size == 0 \
+            and os.path.exists(file_path) \
+            and file_path.endswith('.zip') \
+            and zipfile.is_zipfile(file_path):
+            print(f"SKIP: {name}")
+            if download_index is not None:
+                download_index.add(file_path)
+            return download_journal.SKIPPED
+        # Write the response to a file
+        try:
+            await write_response_to_file(res, file_path, chunk_size=chunk_size, progress=progress,
+                                         blob_store=blob_store, url=download_url, resume_from=resume_from)
+        except PlaceholderContent:
+            print(f"ERROR: placeholder content - {download_url}")
+            return download_journal.REMOVED
+        if download_index is not None:
+            download_index.add(file_path)
+        return download_journal.DOWNLOADED
+
+
+async def run_download_engine(imgur_urls_and_filenames,
+                              concurrency=8,
+                              http2=False,
+                              chunk_size=DOWNLOAD_CHUNK_SIZE,
+                              download_index=None,
+                              throttle=None,
+                              journal=None,
+                              max_attempts=MAX_ATTEMPTS,
+                              blob_store=None,
+                              transport=None,
+                              resolver=None,
+                              work_queue=None):
+    """
+    Download an iterable of (url, file path) pairs with a bounded pool of workers inside a single event loop
+
+    All the workers share one pooled http client, so connections are reused between downloads.
+    The throttle paces the requests to each host and adjusts the number of transfers in flight between 1 and
+    'concurrency' to the latency, error rate and throttling of the server.
+    A job that has to be retried is put back in the queue after its backoff delay instead of keeping a worker
+    busy while it waits.
+    The pairs are pulled lazily into a bounded queue, so downloading starts right away and memory stays the same
+    whatever the number of urls.
+    With a resolver the album zip urls are expanded into one job per image, saved to '<album id>/<image name>'
+    next to where the zip would have been. The zip is only downloaded if the album cannot be resolved.
+    With a work queue the outcome of every job is recorded in it, and the images of the expanded albums are queued
+    in it as jobs leased to this worker. The pairs are then claimed, and the queue written, from a thread of its own
+    so the event loop never waits for the lock of the queue database. The transient failures are queued again.
+
+    :param imgur_urls_and_filenames: An iterable of (download url, file path) tuples, e.g. a generator
+    :param concurrency: The maximum number of downloads running at the same time
+    :param http2: Use HTTP/2 if the optional 'h2' package is installed
+    :param chunk_size: The number of bytes read from the response and written to disk at a time
+    :param download_index: A download_index.DownloadIndex the completed files are recorded in
+    :param throttle: A throttle.Throttle shared by the workers, a new one is created if None
+    :param journal: A download_journal.DownloadJournal the outcome of every url is recorded in
+    :param max_attempts: The number of retries before a transient failure is final
+    :param blob_store: A blob_store.BlobStore the downloaded content is stored in
+    :param transport: An httpx transport replacing the network, e.g. standin.RewritingTransport
+    :param resolver: An album_resolver.AlbumResolver expanding the albums into their images
+    :param work_queue: A work_queue.WorkQueue the pairs were claimed from
+    :return: A dictionary {outcome: number of urls}
+    """
+    loop = asyncio.get_running_loop()
+    start_exporters_from_environment()
+    # The feeder fills the bounded work queue, retried jobs are put back in it later
+    queue = asyncio.Queue(maxsize=concurrency * 4)
+    submitted_files = 0
+    finished_files = 0
+    feeding = True
+    outcomes = {}
+    all_finished = asyncio.Event()
+    # The errors that stopped a worker, raised once the engine stopped
+    errors = []
+    # The jobs downloading each file, a duplicate job for the same file waits for the first one instead of racing
+    # for the file, and finishes with its outcome
+    in_flight = {}
+    # The calls to the work queue, one at a time in the order they were made
+    queue_executor = ThreadPoolExecutor(max_workers=1) if work_queue is not None else None
+    queue_writes = set()
+    # The jobs waiting for room in the full queue, see requeue
+    requeues = set()
+    # One progress bar for the whole batch, showing the bytes written and the overall throughput
+    progress = tqdm_async(desc='Downloading', unit='iB', unit_scale=True, unit_divisor=1024)
+    if throttle is None:
+        throttle = Throttle(max_concurrency=concurrency)
+
+    def update_progress():
+        progress.set_postfix(files=f"{finished_files}/{submitted_files}{'+' if feeding else ''}",
+                             workers=throttle.concurrency.limit)
+
+    def update_gauges():
+        METRICS.set('downloads_in_flight', throttle.concurrency.active)
+        METRICS.set('download_queue_length', queue.qsize())
+        METRICS.set('download_concurrency_limit', throttle.concurrency.limit)
+
+    def queue_written(write):
+        queue_writes.discard(write)
+        if not write.cancelled() and write.exception() is not None:
+            # The queue cannot be written, stop the engine and raise the error
+            errors.append(write.exception())
+            all_finished.set()
+
+    def finish(job, outcome):
+        nonlocal finished_files
+        if in_flight.get(job.file_path) is job:
+            del in_flight[job.file_path]
+        if journal is not None:
+            journal.record(job, outcome, status_code=job.status_code, error=job.error)
+        if work_queue is not None:
+            write = loop.run_in_executor(queue_executor, functools.partial(
+                work_queue.complete, job.file_path, outcome, retry=outcome == download_journal.TRANSIENT))
+            queue_writes.add(write)
+            write.add_done_callback(queue_written)
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        METRICS.inc('download_outcomes_total', outcome=outcome)
+        METRICS.observe('download_redirect_depth', job.redirects)
+        finished_files += 1
+        update_progress()
+        update_gauges()
+        if not feeding and finished_files == submitted_files:
+            all_finished.set()
+        for duplicate in job.duplicates:
+            finish(duplicate, outcome)
+
+    async def feeder():
+        nonlocal submitted_files, feeding
+        try:
+            if work_queue is None:
+                for imgur_url, filename_with_path in imgur_urls_and_filenames:
+                    await queue.put(DownloadJob(imgur_url, filename_with_path))
+                    submitted_files += 1
             else:
-                return_val = f"https://{url_components.netloc}{url_components.path}.png"
-        case 'i.imgur.com':
-            return_val = f"https://{url_components.netloc}{url_components.path}"
-        case 'm.imgur.com':
-            return_val = f"https://i.imgur.com{url_components.path}"
-        case _:  # default
-            print(f"WARNING NOT SUPPORTED: {imgur_url}")
-            return None
-    url_components = urlparse(return_val)
-    if url_components.path.endswith('.gifv'):
-        return_val = return_val.replace('.gifv', '.mp4')
-    return return_val
-
-
-def download_imgur_url(file_with_imgur_urls, output_folder):
+                # Claiming the next batch blocks while another worker writes to the queue
+                pairs = iter(imgur_urls_and_filenames)
+                while True:
+                    pair = await loop.run_in_executor(queue_executor, next, pairs, None)
+                    if pair is None:
+                        break
+                    await queue.put(DownloadJob(*pair))
+                    submitted_files += 1
+        finally:
+            # Stop once the submitted jobs are finished, even if reading the input failed
+            feeding = False
+            update_progress()
+            if finished_files == submitted_files:
+                all_finished.set()
+
+    def requeued(task):
+        requeues.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            errors.append(task.exception())
+            all_finished.set()
+
+    def requeue(job):
+        if not queue.full():
+            queue.put_nowait(job)
+            return
+        # The loop only keeps weak references to its tasks, the set keeps the waiting ones alive
+        task = loop.create_task(queue.put(job))
+        requeues.add(task)
+        task.add_done_callback(requeued)
+
+    async def expand_album(http, job, album_id):
+        nonlocal submitted_files
+        image_urls = await resolver.resolve(http, album_id, throttle=throttle)
+        if image_urls is None:
+            # Fall back to the zip
+            return False
+        if not image_urls:
+            print(f"ERROR: album {album_id} does not exist anymore - {job.original_url}")
+            finish(job, download_journal.REMOVED)
+            return True
+        album_folder = os.path.join(os.path.dirname(job.file_path), album_id)
+        os.makedirs(album_folder, exist_ok=True)
+        image_urls_and_filenames = [(image_url, os.path.join(album_folder, get_download_filename(image_url)))
+                                    for image_url in image_urls]
+        image_urls_and_filenames = [(image_url, file_path) for image_url, file_path in image_urls_and_filenames
+                                    if download_index is None or file_path not in download_index]
+        if work_queue is not None:
+            # Another worker may already hold some of the images
+            image_urls_and_filenames = await loop.run_in_executor(queue_executor, work_queue.adopt,
+                                                                  image_urls_and_filenames)
+        for image_url, file_path in image_urls_and_filenames:
+            # The image jobs are put back in the queue without blocking, a full queue cannot stall the worker
+            requeue(DownloadJob(image_url, file_path))
+            submitted_files += 1
+        finish(job, download_journal.EXPANDED)
+        return True
+
+    def fall_back_to_zip(job, album_id, reason):
+        print(f"WARNING: album {album_id} is downloaded as a zip, {reason} - {job.original_url}")
+        job.zip_fallback = reason
+        METRICS.inc('album_zip_fallbacks_total')
+
+    async def handle(http, job):
+        if job.attempts == 0 and job.file_path in in_flight:
+            in_flight[job.file_path].duplicates.append(job)
+            return
+        # The duplicates of an album wait for its expansion as well, instead of resolving it again
+        in_flight[job.file_path] = job
+        album_id = get_album_id(job.url) if job.attempts == 0 else None
+        if album_id is not None and resolver is None:
+            fall_back_to_zip(job, album_id, 'no album resolver (IMGUR_CLIENT_ID is not set)')
+        elif album_id is not None:
+            try:
+                if await expand_album(http, job, album_id):
+                    return
+                fall_back_to_zip(job, album_id, 'the album could not be resolved')
+            except (httpx.HTTPError, ValueError, KeyError) as e:
+                fall_back_to_zip(job, album_id, f"resolving the album failed with {type(e).__name__}")
+        state = REDIRECT
+        # Only 'throttle.concurrency.limit' of the workers download at the same time
+        async with throttle.concurrency:
+            update_gauges()
+            # Follow the redirects right away, they do not count as retries
+            while state == REDIRECT:
+                try:
+                    job.status_code = None
+                    job.error = None
+                    state = await download(http,
+                                           job,
+                                           chunk_size=chunk_size,
+                                           progress=progress,
+                                           download_index=download_index,
+                                           throttle=throttle,
+                                           blob_store=blob_store)
+                except httpx.HTTPError as e:
+                    # A network error on one url should not stop the other workers
+                    print(f"ERROR: {type(e).__name__} - {job.url}")
+                    job.error = type(e).__name__
+                    METRICS.inc('download_requests_total', status='error')
+                    state = RETRY
+        if state != RETRY:
+            finish(job, state)
+        elif job.attempts >= max_attempts:
+            print(f"WARNING: {job.original_url} failed to download")
+            finish(job, download_journal.TRANSIENT)
+        else:
+            delay = job.backoff()
+            job.restart()
+            METRICS.inc('download_retries_total')
+            loop.call_later(delay, requeue, job)
+
+    async def worker(http):
+        try:
+            while True:
+                job = await queue.get()
+                try:
+                    await handle(http, job)
+                except Exception as e:
+                    # Any other error on one url (e.g. the file cannot be written) is a permanent failure of that url,
+                    # finishing it keeps the engine from waiting for it forever
+                    print(f"ERROR: {type(e).__name__}: {e} - {job.original_url}")
+                    job.error = type(e).__name__
+                    finish(job, download_journal.FAILED)
+        except Exception as e:
+            # finish() itself failed (e.g. the journal cannot be written), stop the engine and raise the error
+            errors.append(e)
+            all_finished.set()
+
+    async with create_download_client(concurrency=concurrency, http2=http2, transport=transport) as http:
+        workers = [asyncio.create_task(worker(http)) for _ in range(concurrency)]
+        feeder_task = asyncio.create_task(feeder())
+        tasks = workers + [feeder_task]
+        try:
+            await all_finished.wait()
+        finally:
+            for task in tasks + list(requeues):
+                task.cancel()
+            await asyncio.gather(*tasks, *requeues, return_exceptions=True)
+            if queue_executor is not None:
+                # The outcomes are all recorded in the queue before it is released
+                await asyncio.gather(*queue_writes, return_exceptions=True)
+                queue_executor.shutdown()
+        if not feeder_task.cancelled() and feeder_task.exception() is not None:
+            raise feeder_task.exception()
+        if errors:
+            raise errors[0]
+    progress.close()
+    return outcomes
+
+
+def iter_download_jobs(lines, output_folder, dedup_index=None, subreddit=None, link_status=None):
+    """
+    Get the download jobs of the links of a link file
+
+    :param lines: An iterable of lines with one link each, e.g. an open link file
+    :param output_folder: The folder the files are saved to
+    :param dedup_index: An imgur_index.ImgurIdIndex, see iter_links
+    :param subreddit: The subreddit the links belong to, see iter_links
+    :param link_status: A link_status.LinkStatusCache, see iter_links
+    :return: A generator of (download url, file path) tuples, the unsupported urls are left out
+    """
+    imgur_urls = iter_links(lines, dedup_index=dedup_index, subreddit=subreddit, link_status=link_status)
+    # Transform the imgur urls to downloadable urls, leaving out the unsupported ones
+    download_urls = (transform_imgur_url_for_download(imgur_url) for imgur_url in imgur_urls)
+    for download_url in download_urls:
+        if download_url is not None:
+            yield download_url, os.path.join(output_folder, get_download_filename(download_url))
+
+
+def download_imgur_url(file_with_imgur_urls,
+                       output_folder,
+                       concurrency=8,
+                       http2=False,
+                       chunk_size=DOWNLOAD_CHUNK_SIZE,
+                       dedup_index=None,
+                       rebuild_index=False,
+                       link_status=None,
+                       blob_folder=None,
+                       transport=None,
+                       throttle=None,
+                       resolver=None):
     """
     Download a list of imgur urls from a file
 
+    Completed downloads are recorded in a download_index.DownloadIndex in the output folder, so a restarted
+    job skips the finished files without walking the output folder or sending any request for them.
+    The outcome of every url is appended to a download_journal.DownloadJournal in the output folder,
+    retry_failed_downloads retries the transient failures it recorded.
+
     :param file_with_imgur_urls: The file containing the imgur urls
     :param output_folder: The folder to save the downloaded files to
+    :param concurrency: The number of downloads running at the same time
+    :param http2: Use HTTP/2 if the optional 'h2' package is installed
+    :param chunk_size: The number of bytes read from the response and written to disk at a time
+    :param dedup_index: An imgur_index.ImgurIdIndex, urls claimed by another link file are not downloaded.
+        The name of the link file without the extension is used as the subreddit.
+    :param rebuild_index: Rebuild the index of completed downloads from the files in the output folder
+    :param link_status: A link_status.LinkStatusCache, the links it knows to be dead are not downloaded
+    :param blob_folder: The folder of the content-addressed blobs the files are hardlinked to, defaults to
+        '<output_folder>/.blobs'. Share it between output folders on the same filesystem to store identical
+        files only once across them.
+    :param transport: An httpx transport replacing the network, e.g. standin.RewritingTransport
+    :param throttle: A throttle.Throttle with custom host rates, the default rates are used if None
+    :param resolver: An album_resolver.AlbumResolver expanding the albums into their images. If None and the
+        IMGUR_CLIENT_ID environment variable is set, one with the default manifest cache is used.
+    :return: A dictionary {outcome: number of urls}
     """
     # Create the output folder if it does not exist
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
-    # Read the imgur urls from the file
-    with open(file_with_imgur_urls, 'r') as f:
-        imgur_urls = f.readlines()
-    # Transform the imgur urls to downloadable urls
-    imgur_urls = [transform_imgur_url_for_download(imgur_url) for imgur_url in imgur_urls]
-    # Remove None values
-    imgur_urls = [url for url in imgur_urls if url is not None]
-    # Create a list of the filenames
-    # If the url ends with /zip, the filename is the id.zip
-    # If the url ends with .<ext>, the filename is the id.<ext>
-    # If the url ends with nothing, the filename is the id.jpg
-    filenames = []
-    for imgur_url in imgur_urls:
-        if imgur_url.endswith('/zip'):
-            filenames.append(imgur_url.split('/')[-2] + '.zip')
-        elif '.' in imgur_url.split('/')[-1]:
-            filenames.append(imgur_url.split('/')[-1])
-        else:
-            filenames.append(imgur_url.split('/')[-1] + '.jpg')
-    filenames_with_path = [os.path.join(output_folder, filename) for filename in filenames]
-    # Create a list of the imgur urls and filenames
-    imgur_urls_and_filenames = list(zip(imgur_urls, filenames_with_path))
-    # Recursively traverse the output folder and get all the files
-    existing_files = []
-    for root, dirs, files in os.walk(output_folder):
-        for file in files:
-            existing_files.append(file)
-    # Remove the existing files from the imgur urls and filenames list
-    imgur_urls_and_filenames = [imgur_url_and_filename for imgur_url_and_filename in imgur_urls_and_filenames if
-                                imgur_url_and_filename[1] not in existing_files]
-
-
-    async def download(download_url, 
-                       file_path, 
-                       recursive_step=0, 
-                       original_url=None, 
-                       write_failed_to_path=None,
-                       only_validate_url=False,
-                       validated_urls_path=None,
-                       sleep=1
-                       ):
-        """
-        Download a file from a url
-
-        The function can also only validate urls, without downloading them
-        The validation process checks if the url is redirected and can save the redirected url to a file
-        It treats the following status codes as valid:
-        200: OK
-        301: Moved Permanently
-        302: Found
-        303: See Other
-        307: Temporary Redirect
-        308: Permanent Redirect
-
-        It treats the following edge cases:
-        - If the request does not receive a valid status code it will treat it as invalid
-        - If the request is redirtected to a url that contains the 'download' keyword it will redirect it to the
-            url 'https://i.imgur.com/<id>.png' where <id> is the id in the original url
-            We presume the original url is in the form of 'https://imgur.com/download/<id>/'
-            This is usually the case for albums that contain only one image and which we tried to download as a zip file
-
-        :param download_url: The url to download the file from
-        :param file_path: The path to write the file to
-        :param recursive_step: The recursive step
-        :param original_url: The original url
-        :param write_failed_to_path: The path to write the failed urls to
-        :param only_validate_url: Only validate the url, do not download
-        :param validated_urls_path: The path to write the validated urls to
-        :return: None
-        """
+    if resolver is None and os.getenv('IMGUR_CLIENT_ID'):
+        with ManifestCache() as manifest_cache:
+            return download_imgur_url(file_with_imgur_urls, output_folder, concurrency=concurrency, http2=http2,
+                                      chunk_size=chunk_size, dedup_index=dedup_index, rebuild_index=rebuild_index,
+                                      link_status=link_status, blob_folder=blob_folder, transport=transport,
+                                      throttle=throttle, resolver=AlbumResolver(cache=manifest_cache))
+    subreddit = os.path.splitext(os.path.basename(file_with_imgur_urls))[0]
+    # Store every file once under its hash, the filenames are hardlinks to it
+    blob_store = BlobStore(blob_folder or os.path.join(output_folder, BLOB_FOLDER_NAME))
+    with open(file_with_imgur_urls, 'r') as f, \
+            DownloadIndex(output_folder, rebuild=rebuild_index) as download_index, \
+            download_journal.DownloadJournal(output_folder) as journal:
+        # Each step is a generator, the urls flow one at a time from the file to the download queue
+        imgur_urls_and_filenames = iter_download_jobs(f, output_folder, dedup_index=dedup_index, subreddit=subreddit,
+                                                      link_status=link_status)
+        # Skip the files that were already downloaded
+        imgur_urls_and_filenames = (imgur_url_and_filename for imgur_url_and_filename in imgur_urls_and_filenames
+                                    if imgur_url_and_filename[1] not in download_index)
+        # Download the imgur urls with a pool of workers sharing one http client
+        return asyncio.run(run_download_engine(imgur_urls_and_filenames,
+                                               concurrency=concurrency,
+                                               http2=http2,
+                                               chunk_size=chunk_size,
+                                               download_index=download_index,
+                                               journal=journal,
+                                               blob_store=blob_store,
+                                               transport=transport,
+                                               throttle=throttle,
+                                               resolver=resolver))
+
+
+def retry_failed_downloads(output_folder, concurrency=8, http2=False, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                           blob_folder=None):
+    """
+    Retry the urls whose last outcome in the journal of an output folder is a transient failure
 
-        if "USER_AGENT" in os.environ:
-            user_agent = os.environ["USER_AGENT"]
+    :param output_folder: The folder the files were downloaded to
+    :param concurrency: The number of downloads running at the same time
+    :param http2: Use HTTP/2 if the optional 'h2' package is installed
+    :param chunk_size: The number of bytes read from the response and written to disk at a time
+    :param blob_folder: The folder of the content-addressed blobs, defaults to '<output_folder>/.blobs'
+    :return: A dictionary {outcome: number of urls}
+    """
+    imgur_urls_and_filenames = download_journal.get_transient_failures(output_folder)
+    print(f"Retrying {len(imgur_urls_and_filenames)} failed downloads in {output_folder}")
+    blob_store = BlobStore(blob_folder or os.path.join(output_folder, BLOB_FOLDER_NAME))
+    with DownloadIndex(output_folder) as download_index, download_journal.DownloadJournal(output_folder) as journal:
+        return asyncio.run(run_download_engine(imgur_urls_and_filenames,
+                                               concurrency=concurrency,
+                                               http2=http2,
+                                               chunk_size=chunk_size,
+                                               download_index=download_index,
+                                               journal=journal,
+                                               blob_store=blob_store))
+
+
+def enqueue_imgur_urls(work_queue, links, output_folder, dedup_index=None, subreddit=None, link_status=None):
+    """
+    Queue the downloads of a list of imgur links in a shared work queue
+
+    Queuing is idempotent, the files already queued or downloaded by any worker are not queued again.
+
+    :param work_queue: A work_queue.WorkQueue
+    :param links: An iterable of lines with one link each, e.g. an open link file
+    :param output_folder: The folder the files are saved to. It must be inside the output folder of the workers and
+        have the same path in every container.
+    :param dedup_index: An imgur_index.ImgurIdIndex, see iter_links
+    :param subreddit: The subreddit the links belong to, see iter_links
+    :param link_status: A link_status.LinkStatusCache, see iter_links
+    :return: The number of files queued
+    """
+    return work_queue.add(iter_download_jobs(links, output_folder, dedup_index=dedup_index, subreddit=subreddit,
+                                             link_status=link_status))
+
+
+def download_from_work_queue(work_queue,
+                             output_folder,
+                             concurrency=8,
+                             http2=False,
+                             chunk_size=DOWNLOAD_CHUNK_SIZE,
+                             batch_size=100,
+                             rebuild_index=False,
+                             blob_folder=None,
+                             transport=None,
+                             throttle=None,
+                             resolver=None):
+    """
+    Download the jobs of a shared work queue until it is drained
+
+    Several processes, e.g. one per container, can run this on the same queue: each claims batches of jobs with a
+    lease renewed by a heartbeat while it works on them, so every file is downloaded by one worker only. The jobs
+    of a worker that crashed are claimed again by the others once their lease expires.
+    The workers share the download index, journal and blob store of the output folder.
+
+    :param work_queue: A work_queue.WorkQueue filled with enqueue_imgur_urls
+    :param output_folder: The folder containing the queued file paths
+    :param concurrency: The number of downloads running at the same time
+    :param http2: Use HTTP/2 if the optional 'h2' package is installed
+    :param chunk_size: The number of bytes read from the response and written to disk at a time
+    :param batch_size: The number of jobs claimed at a time
+    :param rebuild_index: Rebuild the index of completed downloads from the files in the output folder
+    :param blob_folder: The folder of the content-addressed blobs, defaults to '<output_folder>/.blobs'
+    :param transport: An httpx transport replacing the network, e.g. standin.RewritingTransport
+    :param throttle: A throttle.Throttle with custom host rates, the default rates are used if None
+    :param resolver: An album_resolver.AlbumResolver expanding the albums into their images. If None and the
+        IMGUR_CLIENT_ID environment variable is set, one with the default manifest cache is used.
+    :return: A dictionary {outcome: number of urls}
+    """
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    if resolver is None and os.getenv('IMGUR_CLIENT_ID'):
+        with ManifestCache() as manifest_cache:
+            return download_from_work_queue(work_queue, output_folder, concurrency=concurrency, http2=http2,
+                                            chunk_size=chunk_size, batch_size=batch_size,
+                                            rebuild_index=rebuild_index, blob_folder=blob_folder,
+                                            transport=transport, throttle=throttle,
+                                            resolver=AlbumResolver(cache=manifest_cache))
+    blob_store = BlobStore(blob_folder or os.path.join(output_folder, BLOB_FOLDER_NAME))
+    with DownloadIndex(output_folder, rebuild=rebuild_index) as download_index, \
+            download_journal.DownloadJournal(output_folder) as journal:
+
+        def claimed_jobs():
+            for imgur_url, filename_with_path in work_queue.iter_claims(batch_size):
+                # A file downloaded before it was queued only needs its job closed
+                if filename_with_path in download_index:
+                    work_queue.complete(filename_with_path, download_journal.SKIPPED)
+                    continue
+                # The queued files are spread over the subfolders of the output folder
+                os.makedirs(os.path.dirname(filename_with_path), exist_ok=True)
+                yield imgur_url, filename_with_path
+
+        print(f"Worker {work_queue.worker_id} starting on {work_queue.queue_path} - {work_queue.counts()}")
+        work_queue.start_heartbeat()
+        try:
+            return asyncio.run(run_download_engine(claimed_jobs(),
+                                                   concurrency=concurrency,
+                                                   http2=http2,
+                                                   chunk_size=chunk_size,
+                                                   download_index=download_index,
+                                                   journal=journal,
+                                                   blob_store=blob_store,
+                                                   transport=transport,
+                                                   throttle=throttle,
+                                                   resolver=resolver,
+                                                   work_queue=work_queue))
+        finally:
+            work_queue.stop_heartbeat()
+            # Hand the unfinished jobs to the other workers right away instead of waiting for the lease to expire
+            work_queue.release()
+
+
+async def validate_url(http, url, throttle=None):
+    """
+    Check a url without downloading it
+
+    HEAD requests follow the redirects by hand, a 0 byte range request is sent instead when the server does not
+    allow HEAD. The 'download' urls are rewritten to 'https://i.imgur.com/<id>.png' like download() does.
+
+    :param http: The shared http client created with create_download_client
+    :param url: The url to check
+    :param throttle: A throttle.Throttle pacing the requests to each host, no pacing if None
+    :return: A (status code, final url, content length, removed) tuple, the status code is None if the
+        redirects did not end
+    """
+    rewrote_download_url = False
+    for _ in range(MAX_REDIRECTS + 1):
+        if not rewrote_download_url and 'download' in url.lower():
+            url = f"https://i.imgur.com/{url.rstrip('/').split('/')[-1]}.png"
+            rewrote_download_url = True
+        if throttle is not None:
+            await throttle.before_request(url)
+        started = time.monotonic()
+        res = await http.head(url)
+        if res.status_code == 405:
+            res = await http.get(url, headers={'Range': 'bytes=0-0'})
+        if throttle is not None:
+            throttle.on_response(url, res.status_code, time.monotonic() - started, headers=res.headers)
+        if res.is_redirect:
+            location = urljoin(url, res.headers['Location'])
+            if 'removed' in location.lower():
+                return res.status_code, location, None, True
+            url = location
+            continue
+        # The total length of a range response is after the '/' of the Content-Range header
+        if 'Content-Range' in res.headers and '/' in res.headers['Content-Range']:
+            length = res.headers['Content-Range'].split('/')[-1]
         else:
-            user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/112.0.0.0 Safari/537.36"
-        headers = {
-            "User-Agent": user_agent,
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
-            "Accept-Language": "en-US,en;q=0.5",
-            "Accept-Encoding": "gzip, deflate, br",
-            "Connection": "keep-alive",
-            "Upgrade-Insecure-Requests": "1",
-            "Sec-Fetch-Dest": "document",
-            "Sec-Fetch-Mode": "navigate",
-            "Sec-Fetch-Site": "none",
-            "Sec-Fetch-User": "?1",
-            "Sec-GPC": "1",
-            "TE": "trailers"
-        }
-        MAX_RECURSIVE_STEP = 10
-        SLEEP_TIME = sleep if sleep is not None else 1
-        if recursive_step >= MAX_RECURSIVE_STEP - 1:
-            if write_failed_to_path is not None:
-                # Add the original_url and file_path to a file with a list of imgur urls and filenames failed downloads
-                with open(write_failed_to_path, 'a') as f:
-                    f.write(f"{original_url},{file_path}\n")
-            print(f"WARNING: {original_url} failed to download")
-            return
-        if recursive_step in range(0, 3) and 'download' in download_url.lower():
-            print(f"WARNING: {download_url} contains download")
-            imgur_id = download_url.split('/')[-1]
-            new_download_url = f"https://i.imgur.com/{imgur_id}.png"
-            return await download(new_download_url, file_path, recursive_step + 1, original_url=original_url)
-        print(f"Downloading {download_url} to {file_path}")
-        # Create a http client session
-        async with httpx.AsyncClient(headers=headers) as http:
-            async with http.stream(method='GET', url=download_url) as res:
-                # If response is 403 and the url contains 'download' wait and try again with the original url
-                if res.status_code == 403 and 'download' in download_url.lower():
-                    print(f"WARNING: {res.status_code} - {download_url}")
-                    await asyncio.sleep(SLEEP_TIME)
-                    return await download(original_url, file_path, recursive_step + 1)
-                # Follow the redirect if the response is a redirect
-                if res.is_redirect:
-                    new_download_url = res.headers['Location']
-                    if 'removed' in new_download_url.lower():
-                        print(f"ERROR: {res.status_code} - {download_url} => {new_download_url}")
-                        return None
-                    if recursive_step < MAX_RECURSIVE_STEP:
-                        return await download(new_download_url,
-                                              file_path,
-                                              recursive_step + 1,
-                                              original_url=download_url)  # Recursively call the download function
-                    else:
-                        print(f"ERROR: MAX RECURSION {res.status_code} - {download_url} => {new_download_url}")
-                        return None
-                # Check if the response is successful
-                if res.status_code != 200:
-                    print(f"ERROR: {res.status_code} - {download_url}")
-                    # If the response url contains 'download' wait and try again after 1s
-                    if ('download' in res.url.path) and (recursive_step < MAX_RECURSIVE_STEP):
-                        await asyncio.sleep(3)
-                        return await download(download_url, file_path, recursive_step + 1)
-                    return None
-                # Get the file size from the response headers
-                if 'Content-Length' in res.headers:
-                    size = int(res.headers['Content-Length'])
-                else:
-                    size = 0
-                name = file_path.split('/')[-1]
-                # Check if the file exists and if the file size is the same
-                # If the 'size' is 0, the file size is unknown and the file will be downloaded
-                if os.path.exists(file_path) and size != 0 and os.path.getsize(file_path) == size:
-                    print(f"SKIP: {name}")
-                    return None
-                if size == 0 \
-                    and os.path.exists(file_path) \
-                    and file_path.endswith('.zip') \
-                    and zipfile.is_zipfile(file_path):
-                    print(f"SKIP: {name}")
-                    return None
-                # Rate limit the downloads to 1 per second
-                await asyncio.sleep(SLEEP_TIME)
-                # Write the response to a file
-                if not only_validate_url:
-                    file_out = open(file_path, 'wb')
-                    async for chunk in tqdm_async(iterable=res.aiter_bytes(1),
-                                                desc=name, unit='iB',
-                                                unit_scale=True,
-                                                unit_divisor=1024,
-                                                total=size):
-                        file_out.write(chunk)
-                    file_out.close()
-                elif validated_urls_path is not None:
-                    with open(validated_urls_path, 'a') as f:
-                        f.write(f"{original_url}\n")
-
-    # Download the imgur urls and show a progress bar using tqdm
-    for i in tqdm_sync(range(len(imgur_urls_and_filenames)), desc='Downloading', unit='file'):
-        imgur_url, filename_with_path = imgur_urls_and_filenames[i]
-        # Download the imgur url and show a progress bar using tqdm.asyncio
-        asyncio.run(download(imgur_url, filename_with_path))
-
-
-def get_urls_from_folders(folder_path):
+            length = res.headers.get('Content-Length')
+        length = int(length) if length is not None and length.isdigit() else None
+        return res.status_code, url, length, False
+    return None, url, None, False
+
+
+async def run_validation_engine(links_and_urls, link_status, concurrency=32, http2=False, throttle=None,
+                                batch_size=500, transport=None):
+    """
+    Check a list of links with a pool of workers and store their status in the link status cache
+
+    Throttled requests and network errors are not stored, so the next run checks the link again.
+
+    :param links_and_urls: A list of (link, url to check) tuples, the status is stored under the link
+    :param link_status: The link_status.LinkStatusCache to store the results in
+    :param concurrency: The maximum number of requests running at the same time
+    :param http2: Use HTTP/2 if the optional 'h2' package is installed
+    :param throttle: A throttle.Throttle shared by the workers, a new one is created if None
+    :param batch_size: The number of results stored in the cache at a time
+    :param transport: An httpx transport replacing the network, e.g. standin.RewritingTransport
+    :return: A dictionary {'alive': count, 'dead': count, 'error': count}
+    """
+    queue = asyncio.Queue()
+    for link_and_url in links_and_urls:
+        queue.put_nowait(link_and_url)
+    results = []
+    counts = {'alive': 0, 'dead': 0, 'error': 0}
+    progress = tqdm_async(total=queue.qsize(), desc='Validating', unit='link')
+    if throttle is None:
+        throttle = Throttle(max_concurrency=concurrency, initial_concurrency=concurrency)
+
+    async def worker(http):
+        while True:
+            try:
+                link, url = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                async with throttle.concurrency:
+                    status, final_url, length, removed = await validate_url(http, url, throttle=throttle)
+            except httpx.HTTPError as e:
+                print(f"ERROR: {type(e).__name__} - {url}")
+                status, final_url, length, removed = None, url, None, False
+            if removed or status in DEAD_STATUS_CODES:
+                counts['dead'] += 1
+            elif status == 200 or status == 206:
+                counts['alive'] += 1
+            else:
+                counts['error'] += 1
+            if removed or (status is not None and status < 500 and status not in THROTTLE_STATUS_CODES):
+                results.append((link, 200 if status == 206 else status, final_url, length, removed))
+            if len(results) >= batch_size:
+                link_status.set_many(results)
+                results.clear()
+            progress.update(1)
+
+    async with create_download_client(concurrency=concurrency, http2=http2, transport=transport) as http:
+        await asyncio.gather(*[worker(http) for _ in range(concurrency)])
+    link_status.set_many(results)
+    progress.close()
+    return counts
+
+
+def validate_imgur_urls(file_with_imgur_urls, link_status, concurrency=32, http2=False, refresh=False):
+    """
+    Check all the links of a link file and store their status in the link status cache
+
+    :param file_with_imgur_urls: The file containing the imgur urls
+    :param link_status: The link_status.LinkStatusCache to store the results in
+    :param concurrency: The maximum number of requests running at the same time
+    :param http2: Use HTTP/2 if the optional 'h2' package is installed
+    :param refresh: Check the links that already have an unexpired entry in the cache as well
+    :return: A dictionary {'alive': count, 'dead': count, 'error': count} of the checked links
+    """
+    with open(file_with_imgur_urls, 'r') as f:
+        links = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+    links_and_urls = []
+    for link in links:
+        if not refresh and link_status.get(link) is not None:
+            continue
+        url = transform_imgur_url_for_download(link, verbose=False)
+        if url is not None:
+            links_and_urls.append((link, url))
+    print(f"Validating {len(links_and_urls)} of {len(links)} links from {file_with_imgur_urls}")
+    return asyncio.run(run_validation_engine(links_and_urls, link_status, concurrency=concurrency, http2=http2))
+
+
+def notify_apprise(body, title="Imgur Downloader", body_format=NotifyFormat.HTML):
+    """
+    Send a notification to the Discord webhook of the DISCORD_WEBHOOK_URL environment variable, if it is set
+
+    :param body: The text of the notification
+    :param title: The title of the notification
+    :param body_format: The apprise NotifyFormat of the body
+    :return: None
+    """
+    if 'DISCORD_WEBHOOK_URL' not in os.environ:
+        return
+    apprise_url = os.environ['DISCORD_WEBHOOK_URL']
+    apprise = Apprise()
+    apprise.add(AppriseAsset())
+    apprise.add(AppriseConfig())
+    apprise.add(AppriseConfig(config={'url': apprise_url}))
+    apprise.notify(
+        body=body,
+        title=title,
+        notify_type=NotifyType.INFO,
+        body_format=body_format,
+        tag="imgur",
+        attach=None,
+        interpret_escapes=False,
+        config=None,
+    )
+
+
+def write_imgur_urls_from_archive_index(archive_index, subreddit, output_file_path, dedup_index=None):
+    """
+    Write the imgur urls of a subreddit to a file with a query of the archive index instead of parsing the archive
+
+    The file is rewritten with the same urls, in the same order, as a full extraction of the subreddit folder.
+
+    :param archive_index: An archive_index.ArchiveIndex up to date with the archive
+    :param subreddit: The subreddit
+    :param output_file_path: The file the imgur urls are written to
+    :param dedup_index: An imgur_index.ImgurIdIndex, only the urls claimed by the subreddit are written
+    :return: The number of urls written
+    """
+    written = 0
+    with open(output_file_path + '.tmp', 'w') as f:
+        for imgur_url in claim_imgur_urls(archive_index.iter_imgur_urls(subreddit), dedup_index, subreddit):
+            f.write(imgur_url + '\n')
+            written += 1
+    os.replace(output_file_path + '.tmp', output_file_path)
+    METRICS.inc('extraction_urls_total', written)
+    return written
+
+
+def get_urls_from_folders(folder_path,
+                          workers=1,
+                          incremental=False,
+                          dedup_index=None,
+                          summary_interval=None,
+                          archive_index=None,
+                          lookahead=1):
     """
     Get a list of all the imgur urls from the subfolders in the folder_path
 
+    With workers > 1 the shards of the subfolders are parsed on one process pool, and the next 'lookahead'
+    subfolders are already being parsed while the results of the current one are written.
+
     :param folder_path: The path to the folder containing the subfolders
+    :param workers: The number of processes used to parse the json files
+    :param incremental: Only parse the files that changed since the last run
+    :param dedup_index: An imgur_index.ImgurIdIndex, each imgur asset is only written for the first subreddit
+    :param summary_interval: The number of seconds between two notifications with a summary of the metrics,
+        defaults to the SUMMARY_INTERVAL environment variable. No summary if 0 or DISCORD_WEBHOOK_URL is not set.
+    :param archive_index: An archive_index.ArchiveIndex, it is updated with the changes of the archive and the
+        link files are written from it instead of parsing the archive
+    :param lookahead: The number of subfolders parsed ahead of the one being written when workers > 1
     :return: A list of all the imgur urls from the subfolders in the folder_path
     """
     # Get a list of all the subfolders in the folder_path
-    subfolders = [f.path for f in os.scandir(folder_path) if f.is_dir()]
-    # write the imgur urls from each subfolder to a file
-    for subfolder in tqdm_sync(subfolders, desc='Subfolders', unit='folder'):
-        # print(f"Getting imgur urls from {subfolder}")
-        write_imgur_urls_from_subreddit_to_file(subfolder,
-                                                output_folder='./data/subreddit_links',
-                                                recreate_file=False)
+    subfolders = sorted(f.path for f in os.scandir(folder_path) if f.is_dir())
+    start_exporters_from_environment()
+    if summary_interval is None:
+        summary_interval = float(os.getenv('SUMMARY_INTERVAL', 0))
+    # Send a summary of the metrics every summary_interval seconds while the subfolders are parsed
+    if summary_interval and 'DISCORD_WEBHOOK_URL' in os.environ:
+        summary = PeriodicSummary(functools.partial(notify_apprise, body_format=NotifyFormat.TEXT), summary_interval)
+    else:
+        summary = contextlib.nullcontext()
+    with summary:
+        if archive_index is not None:
+            # Only parse what changed since the last update, then query the index for the links
+            started = time.monotonic()
+            archive_index.update(folder_path, subreddits=[os.path.basename(subfolder) for subfolder in subfolders])
+            METRICS.observe('extraction_stage_seconds', time.monotonic() - started, stage='index')
+            for subfolder in tqdm_sync(subfolders, desc='Subfolders', unit='folder'):
+                started = time.monotonic()
+                output_file_path = get_imgur_urls_output_path(subfolder, output_folder='./data/subreddit_links')
+                write_imgur_urls_from_archive_index(archive_index, os.path.basename(subfolder), output_file_path,
+                                                    dedup_index=dedup_index)
+                METRICS.observe('extraction_stage_seconds', time.monotonic() - started, stage='write')
+        elif workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # The subfolder being written and the next 'lookahead' ones are planned and submitted, the others
+                # wait for their turn, so only the results of a few subreddits are held in memory at a time
+                next_subfolders = iter(subfolders)
+                pending = []
+
+                def submit_next_subfolder():
+                    subfolder = next(next_subfolders, None)
+                    if subfolder is None:
+                        return
+                    output_file_path = get_imgur_urls_output_path(subfolder,
+                                                                  output_folder='./data/subreddit_links',
+                                                                  recreate_file=False)
+                    plan = plan_imgur_url_extraction(subfolder, output_file_path, incremental=incremental)
+                    futures = [executor.submit(extract_imgur_urls_from_shard, shard) for shard in plan['shards']]
+                    pending.append((subfolder, plan, futures))
+
+                for _ in range(1 + lookahead):
+                    submit_next_subfolder()
+                with tqdm_sync(total=len(subfolders), desc='Subfolders', unit='folder') as progress:
+                    while pending:
+                        subfolder, plan, futures = pending.pop(0)
+                        # Keep the pool busy with the next subfolder while this one is written
+                        submit_next_subfolder()
+                        finish_imgur_url_extraction(plan,
+                                                    (future.result() for future in futures),
+                                                    desc=f"Parsing {subfolder.split('/')[-1]} json files",
+                                                    dedup_index=dedup_index,
+                                                    subreddit=subfolder.split('/')[-1])
+                        progress.update()
+        else:
+            # write the imgur urls from each subfolder to a file
+            for subfolder in tqdm_sync(subfolders, desc='Subfolders', unit='folder'):
+                # print(f"Getting imgur urls from {subfolder}")
+                write_imgur_urls_from_subreddit_to_file(subfolder,
+                                                        output_folder='./data/subreddit_links',
+                                                        recreate_file=False,
+                                                        incremental=incremental,
+                                                        dedup_index=dedup_index)
     # Notify the user when the script is finished using apprise and Discord webhook from the environment variable DISCORD_WEBHOOK_URL
-    if 'DISCORD_WEBHOOK_URL' in os.environ:
-        apprise_url = os.environ['DISCORD_WEBHOOK_URL']
-        apprise = Apprise()
-        apprise.add(AppriseAsset())
-        apprise.add(AppriseConfig())
-        apprise.add(AppriseConfig(config={'url': apprise_url}))
-        apprise.notify(
-            body="Finished parsing imgur urls",
-            title="Imgur Downloader",
-            notify_type=NotifyType.INFO,
-            body_format=NotifyFormat.HTML,
-            tag="imgur",
-            attach=None,
-            interpret_escapes=False,
-            config=None,
-        )
+    notify_apprise("Finished parsing imgur urls")
 
 
 # Wastebin post
@@ -392,7 +1728,8 @@ def get_urls_from_folders(folder_path):
 def create_wastebin_post(text,
                          extension=None,
                          expires=None,
-                         burn_after_reading=False):
+                         burn_after_reading=False,
+                         session=None):
     """
     Create a post on wastebin
 
@@ -400,6 +1737,7 @@ def create_wastebin_post(text,
     :param extension: The file extension of the text
     :param expires: The number of seconds from now the post will expire
     :param burn_after_reading: If the post should be deleted after reading
+    :param session: A pooled requests.Session created with wastebin.create_session
     :return: The url to the post
     """
     # Create the post data
@@ -414,7 +1752,7 @@ def create_wastebin_post(text,
     else:
         print(f"ERROR: WASTEBIN_URL environment variable not set")
     # Create the post request
-    r = requests.post(wastebin_url, json=post_data)
+    r = (session or requests).post(wastebin_url, json=post_data)
     # Check if the post was successful
     if r.status_code == 200:
         return f"{wastebin_url}{r.json()['path']}?fmt=raw"
@@ -422,6 +1760,49 @@ def create_wastebin_post(text,
         return None
 
 
+def create_wastebin_posts(texts,
+                          extension=None,
+                          expires=86400,
+                          session=None,
+                          paste_cache=None,
+                          min_ttl=None,
+                          workers=4):
+    """
+    Create a post on wastebin for each text, uploading them concurrently
+
+    Texts with a cached paste that stays available for at least min_ttl seconds reuse it instead of being
+    uploaded again.
+
+    :param texts: An iterable of the texts to post
+    :param extension: The file extension of the texts
+    :param expires: The number of seconds from now the posts will expire
+    :param session: A pooled requests.Session, one is created with wastebin.create_session if None
+    :param paste_cache: A wastebin.PasteCache the pastes are looked up in and added to
+    :param min_ttl: The number of seconds a cached paste must still be available for, defaults to half of expires
+    :param workers: The number of uploads running at the same time
+    :return: A list with the url of the post of each text, in order, None for the failed uploads
+    """
+    if session is None:
+        session = wastebin.create_session(pool_size=workers)
+    if min_ttl is None:
+        min_ttl = expires / 2 if expires else 0
+    urls = []
+    uploads = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i, text in enumerate(texts):
+            text_hash = wastebin.get_text_hash(text, extension)
+            cached_url = paste_cache.get(text_hash, min_ttl) if paste_cache is not None else None
+            urls.append(cached_url)
+            if cached_url is None:
+                uploads[i] = (text_hash, executor.submit(create_wastebin_post, text, extension=extension,
+                                                         expires=expires, session=session))
+        for i, (text_hash, future) in uploads.items():
+            urls[i] = future.result()
+            if urls[i] is not None and paste_cache is not None:
+                paste_cache.add(text_hash, urls[i], expires)
+    return urls
+
+
 # Function to create jDownloader2 .crawljob files from a list of imgur urls
 # Function first posts a list of max 10000 urls to wastebin and then creates a .crawljob file
 # .crawljob json file format:
@@ -445,7 +1826,11 @@ def create_crawljob_file_from_imgur_urls(imgur_urls,
                                          limit=10000,
                                          output_folder='./data/crawljobs',
                                          download_folder=None,
-                                         recreate_file=False):
+                                         recreate_file=False,
+                                         dedup_index=None,
+                                         link_status=None,
+                                         session=None,
+                                         paste_cache=None):
     """
     Create a jDownloader2 .crawljob file from a list of imgur urls
 
@@ -455,39 +1840,40 @@ def create_crawljob_file_from_imgur_urls(imgur_urls,
     :param output_folder: The folder to save the .crawljob file
     :param download_folder: The download folder to be specified in the .crawljob file and used by jDownloader2
     :param recreate_file: If the .crawljob file should be recreated if it already exists
+    :param dedup_index: An imgur_index.ImgurIdIndex, urls claimed by another crawljob name are left out
+    :param link_status: A link_status.LinkStatusCache, the links it knows to be dead are left out
+    :param session: A pooled requests.Session shared by the uploads, see wastebin.create_session
+    :param paste_cache: A wastebin.PasteCache, the chunks of urls that were already posted reuse their paste
     :return: None
     """
     # Create the output folder if it doesn't exist
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
-    # Create the wastebin post with .txt extension and 1 day expiration
-    # The wastebin post will contain the imgur urls separated by a new line
-    # If the imgur urls are more than the limit, multiple wastebin posts will be created
-    wastebin_urls = []
-    for i in range(0, len(imgur_urls), limit):
-        wastebin_urls.append(create_wastebin_post('\n'.join(imgur_urls[i:i + limit]),
-                                                  expires=86400))
-    # Create the .crawljob file
     crawljob_file_path = os.path.join(output_folder, f'{crawljob_name}.crawljob')
-    # Check if the file exists and if the file should be recreated
+    # Check if the file exists and if the file should be recreated before uploading anything
     if os.path.exists(crawljob_file_path) and not recreate_file:
         return None
+    # Leave out the imgur assets already claimed by another subreddit
+    imgur_urls = list(claim_imgur_urls(imgur_urls, dedup_index, crawljob_name))
+    # Leave out the links the validator found dead
+    if link_status is not None:
+        imgur_urls = [imgur_url for imgur_url in imgur_urls if not link_status.is_dead(imgur_url.strip())]
+    # Create the wastebin posts with 1 day expiration
+    # Each wastebin post will contain up to 'limit' imgur urls separated by a new line
+    # The unchanged chunks reuse their cached post, the others are uploaded concurrently
+    chunks = ('\n'.join(imgur_urls[i:i + limit]) for i in range(0, len(imgur_urls), limit))
+    wastebin_urls = create_wastebin_posts(chunks, expires=86400, session=session, paste_cache=paste_cache)
+    # Do not write a crawljob with missing parts, the next run uploads the failed chunks again
+    if None in wastebin_urls:
+        print(f"ERROR: {wastebin_urls.count(None)} of {len(wastebin_urls)} wastebin posts failed for {crawljob_name}")
+        return None
     # Define a dictionary with the crawljob file data for each wastebin url
     crawljob_data = []
-    for wastebin_url in wastebin_urls:
-        data_item = {
-            "text": wastebin_url,
-            "packageName": crawljob_name,
-            "comment": f"Created by Imgur Downloader. Part {wastebin_urls.index(wastebin_url) + 1} of {len(wastebin_urls)}",
-            "autoConfirm": "TRUE",
-            "autoStart": "TRUE",
-            "extractAfterDownload": "FALSE",
-            "overwritePackagizerEnabled": True,
-            "downloadFolder": download_folder if download_folder else "/output/imgur/<jd:packagename>",
-            "deepAnalyseEnabled": True,
-            "addOfflineLink": False
-        }
-        crawljob_data.append(data_item)
+    for part, wastebin_url in enumerate(wastebin_urls, start=1):
+        crawljob_data.append(create_crawljob_entry(wastebin_url,
+                                                   crawljob_name,
+                                                   f"Created by Imgur Downloader. Part {part} of {len(wastebin_urls)}",
+                                                   download_folder=download_folder))
     # Create the .crawljob file
     with open(crawljob_file_path, 'w') as f:
         f.write(json.dumps(crawljob_data, indent=2))
@@ -495,13 +1881,21 @@ def create_crawljob_file_from_imgur_urls(imgur_urls,
 
 def create_crawlfile_from_text_file(file_name,
                                     output_folder='./data/crawljobs',
-                                    recreate_file=False):
+                                    recreate_file=False,
+                                    dedup_index=None,
+                                    link_status=None,
+                                    session=None,
+                                    paste_cache=None):
     """
     Create a jDownloader2 .crawljob file from a text file containing imgur urls
 
     :param file_name: The name of the text file containing imgur urls
     :param output_folder: The folder to save the .crawljob file
     :param recreate_file: If the .crawljob file should be recreated if it already exists
+    :param dedup_index: An imgur_index.ImgurIdIndex, urls claimed by another link file are left out
+    :param link_status: A link_status.LinkStatusCache, the links it knows to be dead are left out
+    :param session: A pooled requests.Session shared by the uploads, see wastebin.create_session
+    :param paste_cache: A wastebin.PasteCache, the chunks of urls that were already posted reuse their paste
     :return: None
     """
     # Read the file with combined file name and extension 
@@ -516,17 +1910,91 @@ def create_crawlfile_from_text_file(file_name,
     create_crawljob_file_from_imgur_urls(imgur_urls,
                                          crawljob_name=crawljob_name,
                                          output_folder=output_folder,
-                                         recreate_file=recreate_file)
+                                         recreate_file=recreate_file,
+                                         dedup_index=dedup_index,
+                                         link_status=link_status,
+                                         session=session,
+                                         paste_cache=paste_cache)
+
+
+def create_folderwatch_crawljobs_from_text_file(file_name, writer, dedup_index=None, link_status=None):
+    """
+    Write self-contained crawljobs for a text file containing imgur urls into the JDownloader2 watched folder
+
+    No Wastebin post is needed: the links are inlined in the crawljobs or written to local link lists,
+    see folderwatch.FolderwatchWriter. The call blocks while the watched folder is full.
+
+    :param file_name: The name of the text file containing imgur urls
+    :param writer: The folderwatch.FolderwatchWriter of the watched folder
+    :param dedup_index: An imgur_index.ImgurIdIndex, urls claimed by another link file are left out
+    :param link_status: A link_status.LinkStatusCache, the links it knows to be dead are left out
+    :return: The number of crawljobs written
+    """
+    # The package is named after the file name without the extension
+    package_name = os.path.splitext(os.path.basename(file_name))[0]
+    with open(file_name, 'r') as f:
+        return writer.write_package(package_name,
+                                    iter_links(f, dedup_index=dedup_index, subreddit=package_name,
+                                               link_status=link_status))
+
+
+def iter_link_sources(url_source_folder, archive_index=None):
+    """
+    Get the links of every subreddit, from the archive index or from the link files
+
+    :param url_source_folder: The folder containing the link files
+    :param archive_index: An archive_index.ArchiveIndex, the links are queried from it instead of the link files
+    :return: A generator of (subreddit, iterable of links) tuples
+    """
+    if archive_index is not None:
+        for subreddit in archive_index.subreddits(imgur_only=True):
+            yield subreddit, archive_index.iter_imgur_urls(subreddit)
+        return
+    for file_name in sorted(os.listdir(url_source_folder)):
+        # Skip the extraction manifests and anything else that is not a link file
+        if not file_name.endswith('.txt'):
+            continue
+        with open(os.path.join(url_source_folder, file_name), 'r') as f:
+            yield os.path.splitext(file_name)[0], f
 
 
 def execute_from_command_line():
     ### Use this function to define what you want to do when you run this particular file 
     ### from the command line. This is not good practice, but I don't have time to make it better.
     url_source_folder = "/data/subreddit_links"
-    for file_name in os.listdir(url_source_folder):
-        create_crawlfile_from_text_file(os.path.join(url_source_folder, file_name),
-                                        output_folder='./data/crawljobs',
-                                        recreate_file=True)
+    # ARCHIVE_INDEX=<path of the archive index> queries the links from the index instead of reading the link files
+    archive_index = ArchiveIndex(os.environ['ARCHIVE_INDEX']) if os.getenv('ARCHIVE_INDEX') else None
+    # WORK_QUEUE=<path of the queue on the shared volume> downloads the links in this container, sharing the work
+    # with the other containers running with the same queue. WORK_QUEUE_ENQUEUE=0 skips queuing the links, e.g. for
+    # the additional workers of a queue that is already filled.
+    if os.getenv('WORK_QUEUE'):
+        output_folder = os.getenv('DOWNLOAD_FOLDER', '/output/imgur')
+        with WorkQueue(os.environ['WORK_QUEUE'], lease_seconds=float(os.getenv('WORK_QUEUE_LEASE', 300))) as queue:
+            if os.getenv('WORK_QUEUE_ENQUEUE', '1') == '1':
+                for subreddit, links in iter_link_sources(url_source_folder, archive_index=archive_index):
+                    enqueue_imgur_urls(queue, links, os.path.join(output_folder, subreddit), subreddit=subreddit)
+            download_from_work_queue(queue, output_folder,
+                                     concurrency=int(os.getenv('DOWNLOAD_CONCURRENCY', 8)),
+                                     batch_size=int(os.getenv('WORK_QUEUE_BATCH', 100)))
+        return
+    # CRAWLJOB_MODE=folderwatch writes the crawljobs straight into the folder watched by JDownloader2
+    if os.getenv('CRAWLJOB_MODE') == 'folderwatch':
+        writer = FolderwatchWriter(folder=os.getenv('FOLDERWATCH_PATH', DEFAULT_FOLDERWATCH_PATH),
+                                   link_budget=int(os.getenv('CRAWLJOB_LINK_BUDGET', 5000)),
+                                   max_pending=int(os.getenv('CRAWLJOB_MAX_PENDING', 2)))
+        for subreddit, links in iter_link_sources(url_source_folder, archive_index=archive_index):
+            writer.write_package(subreddit, iter_links(links))
+        return
+    # Share the upload connections and the cached pastes between all the crawljobs
+    session = wastebin.create_session()
+    with wastebin.PasteCache() as paste_cache:
+        for subreddit, links in iter_link_sources(url_source_folder, archive_index=archive_index):
+            create_crawljob_file_from_imgur_urls(list(iter_links(links)),
+                                                 crawljob_name=subreddit,
+                                                 output_folder='./data/crawljobs',
+                                                 recreate_file=True,
+                                                 session=session,
+                                                 paste_cache=paste_cache)
     pass
 
 
@@ -0,0 +1,303 @@
+# Global index of the imgur images and albums that were already claimed by a subreddit.
+# The same asset is often cross-posted to many subreddits; the index makes sure it ends up in only one
+# link file, crawljob and download, while remembering every subreddit that referenced it.
+#
+# Each asset is packed into a single 64 bit integer: the base62 id, its length and whether it is an album.
+# The keys are kept in a sorted array with a parallel array of owners, so tens of millions of assets
+# fit in a few hundred MB of RAM. New assets are collected in a small dictionary that is merged into sorted
+# staging arrays every PENDING_LIMIT assets, and the staging arrays are merged into the main arrays once they
+# reach a quarter of their size, so a first build never holds more than PENDING_LIMIT assets in Python objects.
+# The other subreddits referencing an asset are kept the same way, as sorted (key, subreddit number) pairs that
+# are stored once whatever the number of runs finding them.
+#
+# Files in the index folder:
+#   keys.bin            - sorted unsigned 64 bit keys
+#   owners.bin          - unsigned 32 bit subreddit number of the owner of each key
+#   subreddits.txt      - the subreddit names, the line number is the subreddit number
+#   ref_keys.bin        - sorted unsigned 64 bit keys of the assets referenced by other subreddits, one per reference
+#   ref_subreddits.bin  - unsigned 32 bit subreddit number of each reference
+# A 'refs.tsv' log of '<key>\t<subreddit number>' lines written by older versions is converted on load.
+
+import array
+import bisect
+import os
+
+
+BASE62_ALPHABET = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+BASE62_VALUES = {character: value for value, character in enumerate(BASE62_ALPHABET)}
+# 62 ** 9 * 16 * 2 still fits in 64 bits
+MAX_ID_LENGTH = 9
+KINDS = ('image', 'album')
+# Number of new assets kept in a dictionary before they are merged into the sorted staging arrays
+PENDING_LIMIT = 65536
+# Minimum number of staged assets before they are merged into the main arrays
+STAGED_MINIMUM = 1 << 20
+
+
+def pack_key(kind, imgur_id):
+    """
+    Pack an imgur asset into a 64 bit integer
+
+    :param kind: Either 'image' or 'album'
+    :param imgur_id: The base62 imgur id
+    :return: The packed key, or None if the id cannot be packed
+    """
+    if not imgur_id or len(imgur_id) > MAX_ID_LENGTH:
+        return None
+    value = 0
+    for character in imgur_id:
+        if character not in BASE62_VALUES:
+            return None
+        value = value * 62 + BASE62_VALUES[character]
+    return ((value << 4 | len(imgur_id)) << 1) | KINDS.index(kind)
+
+
+def merge_sorted(keys, owners, new_keys, new_owners):
+    """
+    Merge sorted keys and their owners into sorted arrays of keys and owners
+
+    The runs of existing keys between two new keys are copied as slices. A key may repeat, e.g. the references
+    of an asset, the merged keys are still sorted.
+
+    :param keys: The sorted array('Q') of keys
+    :param owners: The array('I') of the owners of the keys
+    :param new_keys: The sorted new keys
+    :param new_owners: The owners of the new keys
+    :return: A (keys, owners) tuple of new arrays
+    """
+    merged_keys = array.array('Q')
+    merged_owners = array.array('I')
+    start = 0
+    # Without existing keys after them, e.g. into empty arrays, the new keys are appended at C speed
+    end = bisect.bisect_left(new_keys, keys[-1]) if keys else 0
+    for key, owner in zip(new_keys[:end], new_owners[:end]):
+        position = bisect.bisect_left(keys, key, start)
+        if position > start:
+            merged_keys.extend(keys[start:position])
+            merged_owners.extend(owners[start:position])
+            start = position
+        merged_keys.append(key)
+        merged_owners.append(owner)
+    merged_keys.extend(keys[start:])
+    merged_owners.extend(owners[start:])
+    merged_keys.extend(new_keys[end:])
+    merged_owners.extend(new_owners[end:])
+    return merged_keys, merged_owners
+
+
+def unpack_key(key):
+    """
+    Unpack a key created by pack_key
+
+    :param key: The packed key
+    :return: A (kind, imgur id) tuple
+    """
+    kind = KINDS[key & 1]
+    length = (key >> 1) & 0xF
+    value = key >> 5
+    imgur_id = ''
+    for _ in range(length):
+        value, remainder = divmod(value, 62)
+        imgur_id = BASE62_ALPHABET[remainder] + imgur_id
+    return kind, imgur_id
+
+
+class ImgurIdIndex:
+    """
+    Persistent set of imgur assets and the subreddit that claimed each of them
+
+    Use it as a context manager, or call save() when done, to write the new assets to disk.
+    """
+
+    def __init__(self, index_folder='./data/imgur_index'):
+        """
+        :param index_folder: The folder the index is stored in
+        """
+        self.index_folder = index_folder
+        os.makedirs(index_folder, exist_ok=True)
+        self._keys = array.array('Q')
+        self._owners = array.array('I')
+        # The new assets, sorted in the staging arrays and the most recent ones in a dictionary
+        self._staged_keys = array.array('Q')
+        self._staged_owners = array.array('I')
+        self._new = {}
+        self._subreddits = []
+        self._subreddit_numbers = {}
+        # The references, sorted in the arrays and the new ones in a dictionary {key: set of subreddit numbers}
+        self._ref_keys = array.array('Q')
+        self._ref_subreddits = array.array('I')
+        self._new_refs = {}
+        self._new_ref_count = 0
+        self._load()
+
+    def _path(self, name):
+        return os.path.join(self.index_folder, name)
+
+    def _load(self):
+        if os.path.exists(self._path('keys.bin')):
+            with open(self._path('keys.bin'), 'rb') as f:
+                self._keys.frombytes(f.read())
+            with open(self._path('owners.bin'), 'rb') as f:
+                self._owners.frombytes(f.read())
+        if os.path.exists(self._path('subreddits.txt')):
+            with open(self._path('subreddits.txt'), 'r') as f:
+                self._subreddits = f.read().splitlines()
+        self._subreddit_numbers = {subreddit: number for number, subreddit in enumerate(self._subreddits)}
+        if os.path.exists(self._path('ref_keys.bin')):
+            with open(self._path('ref_keys.bin'), 'rb') as f:
+                self._ref_keys.frombytes(f.read())
+            with open(self._path('ref_subreddits.bin'), 'rb') as f:
+                self._ref_subreddits.frombytes(f.read())
+        if os.path.exists(self._path('refs.tsv')):
+            # Older log of references, with a line per reference and run, it is replaced by the arrays on save
+            with open(self._path('refs.tsv'), 'r') as f:
+                for line in f:
+                    key, number = line.split('\t')
+                    self._add_ref(int(key), int(number))
+
+    def _subreddit_number(self, subreddit):
+        if subreddit not in self._subreddit_numbers:
+            self._subreddit_numbers[subreddit] = len(self._subreddits)
+            self._subreddits.append(subreddit)
+        return self._subreddit_numbers[subreddit]
+
+    def _owner_number(self, key):
+        if key in self._new:
+            return self._new[key]
+        for keys, owners in ((self._staged_keys, self._staged_owners), (self._keys, self._owners)):
+            position = bisect.bisect_left(keys, key)
+            if position < len(keys) and keys[position] == key:
+                return owners[position]
+        return None
+
+    def _merge_new(self, force=False):
+        # Move the dictionary to the staging arrays, and the staging arrays to the main arrays when they grew
+        if self._new:
+            new_keys = sorted(self._new)
+            self._staged_keys, self._staged_owners = merge_sorted(self._staged_keys, self._staged_owners, new_keys,
+                                                                  [self._new[key] for key in new_keys])
+            self._new = {}
+        if self._staged_keys and (force or len(self._staged_keys) >= max(STAGED_MINIMUM, len(self._keys) // 4)):
+            self._keys, self._owners = merge_sorted(self._keys, self._owners, self._staged_keys, self._staged_owners)
+            self._staged_keys = array.array('Q')
+            self._staged_owners = array.array('I')
+
+    def _ref_numbers(self, key):
+        # The subreddit numbers referencing a key, in the arrays and the dictionary
+        start = bisect.bisect_left(self._ref_keys, key)
+        end = bisect.bisect_right(self._ref_keys, key, start)
+        numbers = set(self._ref_subreddits[start:end])
+        numbers.update(self._new_refs.get(key, ()))
+        return numbers
+
+    def _add_ref(self, key, number):
+        if number in self._ref_numbers(key):
+            return
+        self._new_refs.setdefault(key, set()).add(number)
+        self._new_ref_count += 1
+        if self._new_ref_count >= max(PENDING_LIMIT, len(self._ref_keys) // 4):
+            self._merge_refs()
+
+    def _merge_refs(self):
+        # Move the dictionary of new references to the sorted arrays
+        if not self._new_refs:
+            return
+        new_keys = []
+        new_numbers = []
+        for key in sorted(self._new_refs):
+            for number in sorted(self._new_refs[key]):
+                new_keys.append(key)
+                new_numbers.append(number)
+        self._ref_keys, self._ref_subreddits = merge_sorted(self._ref_keys, self._ref_subreddits, new_keys,
+                                                            new_numbers)
+        self._new_refs = {}
+        self._new_ref_count = 0
+
+    def __len__(self):
+        return len(self._keys) + len(self._staged_keys) + len(self._new)
+
+    def __contains__(self, asset):
+        key = pack_key(*asset)
+        return key is not None and self._owner_number(key) is not None
+
+    def owner(self, kind, imgur_id):
+        """
+        Get the subreddit that claimed an asset
+
+        :param kind: Either 'image' or 'album'
+        :param imgur_id: The imgur id
+        :return: The subreddit name, or None if the asset is not in the index
+        """
+        key = pack_key(kind, imgur_id)
+        number = self._owner_number(key) if key is not None else None
+        return self._subreddits[number] if number is not None else None
+
+    def claim(self, kind, imgur_id, subreddit):
+        """
+        Claim an asset for a subreddit
+
+        The first subreddit to claim an asset owns it. Later claims from other subreddits are recorded as
+        references and rejected, so only the owner writes, crawls and downloads the asset.
+        Ids that cannot be packed are never deduplicated.
+
+        :param kind: Either 'image' or 'album'
+        :param imgur_id: The imgur id
+        :param subreddit: The subreddit claiming the asset
+        :return: True if the subreddit owns the asset
+        """
+        key = pack_key(kind, imgur_id)
+        if key is None:
+            return True
+        number = self._subreddit_number(subreddit)
+        owner_number = self._owner_number(key)
+        if owner_number is None:
+            self._new[key] = number
+            if len(self._new) >= PENDING_LIMIT:
+                self._merge_new()
+            return True
+        if owner_number == number:
+            return True
+        self._add_ref(key, number)
+        return False
+
+    def subreddits(self, kind, imgur_id):
+        """
+        Get all the subreddits that referenced an asset
+
+        :param kind: Either 'image' or 'album'
+        :param imgur_id: The imgur id
+        :return: A sorted list of subreddit names, the owner included
+        """
+        key = pack_key(kind, imgur_id)
+        owner_number = self._owner_number(key) if key is not None else None
+        if owner_number is None:
+            return []
+        numbers = self._ref_numbers(key)
+        numbers.add(owner_number)
+        return sorted(self._subreddits[number] for number in numbers)
+
+    def save(self):
+        """
+        Merge the new assets into the sorted arrays and write the index to disk
+
+        :return: None
+        """
+        self._merge_new(force=True)
+        self._merge_refs()
+        for name, data in (('keys.bin', self._keys), ('owners.bin', self._owners),
+                           ('ref_keys.bin', self._ref_keys), ('ref_subreddits.bin', self._ref_subreddits)):
+            with open(self._path(name + '.tmp'), 'wb') as f:
+                data.tofile(f)
+            os.replace(self._path(name + '.tmp'), self._path(name))
+        with open(self._path('subreddits.txt.tmp'), 'w') as f:
+            f.writelines(subreddit + '\n' for subreddit in self._subreddits)
+        os.replace(self._path('subreddits.txt.tmp'), self._path('subreddits.txt'))
+        # The references of the older log are in the arrays now
+        if os.path.exists(self._path('refs.tsv')):
+            os.remove(self._path('refs.tsv'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.save()
@@ -0,0 +1,118 @@
+# Persistent cache of the status of imgur links, filled by the bulk validator in imgur.py.
+# The downloader and the crawljob creator look links up here to skip the ones known to be dead
+# instead of rediscovering it with a chain of requests on every run.
+#
+# Each entry expires after a time to live that depends on the verdict: a removed image stays removed,
+# while a link that was alive or failed for another reason is checked again sooner.
+
+import os
+import sqlite3
+import time
+
+
+DEFAULT_CACHE_PATH = './data/link_status.sqlite'
+# Time to live of the entries, in seconds
+ALIVE_TTL = 30 * 86400
+DEAD_TTL = 365 * 86400
+ERROR_TTL = 86400
+# Status codes that mean the link will not come back
+DEAD_STATUS_CODES = (404, 410)
+
+
+class LinkStatusCache:
+    """
+    SQLite table {link: final status, redirect target, content length, removed verdict, check time}
+    """
+
+    def __init__(self, cache_path=DEFAULT_CACHE_PATH, alive_ttl=ALIVE_TTL, dead_ttl=DEAD_TTL, error_ttl=ERROR_TTL):
+        """
+        :param cache_path: The path of the SQLite database
+        :param alive_ttl: The number of seconds an alive link is trusted
+        :param dead_ttl: The number of seconds a removed or missing link is trusted
+        :param error_ttl: The number of seconds any other status is trusted
+        """
+        self.cache_path = cache_path
+        self.alive_ttl = alive_ttl
+        self.dead_ttl = dead_ttl
+        self.error_ttl = error_ttl
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(cache_path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS links ('
+                         'url TEXT PRIMARY KEY, status INTEGER, final_url TEXT, length INTEGER, '
+                         'removed INTEGER NOT NULL, checked INTEGER NOT NULL)')
+        self._db.commit()
+
+    def _ttl(self, status, removed):
+        if removed or status in DEAD_STATUS_CODES:
+            return self.dead_ttl
+        if status == 200:
+            return self.alive_ttl
+        return self.error_ttl
+
+    def get(self, url):
+        """
+        Get the cached status of a link
+
+        :param url: The link
+        :return: A dictionary with the status, final_url, length, removed and checked keys,
+            or None if the link is not cached or its entry expired
+        """
+        row = self._db.execute('SELECT status, final_url, length, removed, checked FROM links WHERE url = ?',
+                               (url,)).fetchone()
+        if row is None:
+            return None
+        status, final_url, length, removed, checked = row
+        if checked + self._ttl(status, removed) < time.time():
+            return None
+        return {'status': status, 'final_url': final_url, 'length': length, 'removed': bool(removed),
+                'checked': checked}
+
+    def is_dead(self, url):
+        """
+        Check if a link is known to be removed or missing
+
+        :param url: The link
+        :return: True if an unexpired entry says the link is dead
+        """
+        entry = self.get(url)
+        return entry is not None and (entry['removed'] or entry['status'] in DEAD_STATUS_CODES)
+
+    def set_many(self, entries):
+        """
+        Store the status of several links in one transaction
+
+        :param entries: An iterable of (url, status, final url, content length, removed) tuples
+        :return: None
+        """
+        checked = int(time.time())
+        self._db.executemany('INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?, ?, ?)',
+                             [(url, status, final_url, length, int(removed), checked)
+                              for url, status, final_url, length, removed in entries])
+        self._db.commit()
+
+    def set(self, url, status, final_url=None, length=None, removed=False):
+        """
+        Store the status of a link
+
+        :param url: The link
+        :param status: The final status code, None if no response was received
+        :param final_url: The url the link redirects to
+        :param length: The content length
+        :param removed: Whether imgur redirects the link to its 'removed' image
+        :return: None
+        """
+        self.set_many([(url, status, final_url, length, removed)])
+
+    def close(self):
+        """
+        Close the database
+
+        :return: None
+        """
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,359 @@
+# Process wide counters, gauges and histograms of the download and extraction pipelines.
+#
+# The pipelines record into the module level METRICS registry. The values can be exposed with:
+#   - a file rewritten every few seconds, Prometheus text format if the name ends with '.prom', json otherwise
+#     (METRICS_FILE and METRICS_INTERVAL environment variables)
+#   - a local http endpoint serving '/metrics' (Prometheus) and '/metrics.json' (METRICS_PORT environment variable)
+# start_exporters_from_environment() starts the ones configured in the environment.
+
+import atexit
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10)
+
+
+class Metrics:
+    """
+    Thread safe registry of labelled counters, gauges and histograms
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._buckets = {}
+
+    def describe(self, name, help_text, buckets=None):
+        """
+        Set the help text of a metric, and the buckets of a histogram
+
+        :param name: The metric name
+        :param help_text: The description of the metric
+        :param buckets: The upper bounds of the buckets of a histogram
+        :return: None
+        """
+        self._help[name] = help_text
+        if buckets is not None:
+            self._buckets[name] = tuple(buckets)
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increase a counter
+
+        :param name: The metric name
+        :param value: The amount to add
+        :param labels: The labels of the counter
+        :return: None
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """
+        Set a gauge
+
+        :param name: The metric name
+        :param value: The current value
+        :param labels: The labels of the gauge
+        :return: None
+        """
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        """
+        Record a value in a histogram
+
+        :param name: The metric name
+        :param value: The observed value
+        :param labels: The labels of the histogram
+        :return: None
+        """
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._buckets.get(name, SECONDS_BUCKETS)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def get(self, name, **labels):
+        """
+        Get the value of a counter or a gauge
+
+        :param name: The metric name
+        :param labels: The labels of the metric
+        :return: The value, 0 if it was never recorded
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            return self._counters.get(key, self._gauges.get(key, 0))
+
+    def total(self, name):
+        """
+        Get the sum of a counter over all its labels
+
+        :param name: The metric name
+        :return: The sum
+        """
+        with self._lock:
+            return sum(value for (key_name, _), value in self._counters.items() if key_name == name)
+
+    def snapshot(self):
+        """
+        Get a json serializable copy of all the metrics
+
+        :return: A dictionary {'uptime_seconds', 'counters', 'gauges', 'histograms'}, each metric is a list of
+            {'labels': {...}, ...} entries
+        """
+        with self._lock:
+            snapshot = {'uptime_seconds': time.time() - self.started, 'counters': {}, 'gauges': {}, 'histograms': {}}
+            for kind, values in (('counters', self._counters), ('gauges', self._gauges)):
+                for (name, labels), value in sorted(values.items()):
+                    snapshot[kind].setdefault(name, []).append({'labels': dict(labels), 'value': value})
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                snapshot['histograms'].setdefault(name, []).append({
+                    'labels': dict(labels),
+                    'buckets': dict(zip(self._buckets.get(name, SECONDS_BUCKETS), histogram['buckets'])),
+                    'sum': histogram['sum'],
+                    'count': histogram['count'],
+                })
+        return snapshot
+
+    def to_json(self):
+        """
+        :return: The snapshot as a json string
+        """
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        """
+        :return: The metrics in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def format_labels(labels, extra=None):
+            items = list(labels.items()) + (list(extra.items()) if extra else [])
+            if not items:
+                return ''
+            return '{' + ','.join(f'{key}="{value}"' for key, value in items) + '}'
+
+        for kind, prometheus_type in (('counters', 'counter'), ('gauges', 'gauge')):
+            for name, entries in snapshot[kind].items():
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {prometheus_type}")
+                lines.extend(f"{name}{format_labels(entry['labels'])} {entry['value']}" for entry in entries)
+        for name, entries in snapshot['histograms'].items():
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            for entry in entries:
+                for bound, count in entry['buckets'].items():
+                    lines.append(f"{name}_bucket{format_labels(entry['labels'], {'le': bound})} {count}")
+                lines.append(f"{name}_bucket{format_labels(entry['labels'], {'le': '+Inf'})} {entry['count']}")
+                lines.append(f"{name}_sum{format_labels(entry['labels'])} {entry['sum']}")
+                lines.append(f"{name}_count{format_labels(entry['labels'])} {entry['count']}")
+        lines.append(f"process_uptime_seconds {snapshot['uptime_seconds']:.0f}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        Get a short human readable summary, e.g. for a notification
+
+        :return: The summary text
+        """
+        uptime = max(1.0, time.time() - self.started)
+        downloaded_bytes = self.total('download_bytes_total')
+        outcomes = ', '.join(f"{entry['labels']['outcome']}: {entry['value']}"
+                             for entry in self.snapshot()['counters'].get('download_outcomes_total', []))
+        statuses = ', '.join(f"{entry['labels']['status']}: {entry['value']}"
+                             for entry in self.snapshot()['counters'].get('download_requests_total', []))
+        return '\n'.join([
+            f"Uptime: {uptime / 3600:.1f} h",
+            f"Extraction: {self.total('extraction_files_total')} files, {self.total('extraction_urls_total')} urls",
+            f"Downloads: {downloaded_bytes / 1024 / 1024:.1f} MB at {downloaded_bytes / uptime / 1024:.1f} kB/s",
+            f"Outcomes: {outcomes or 'none'}",
+            f"Requests by status: {statuses or 'none'}",
+            f"In flight: {self.get('downloads_in_flight')}, queued: {self.get('download_queue_length')}",
+        ])
+
+
+METRICS = Metrics()
+METRICS.describe('download_bytes_total', 'Bytes written by the download engine')
+METRICS.describe('download_requests_total', 'Download requests by status code')
+METRICS.describe('download_outcomes_total', 'Urls handled by the download engine by outcome')
+METRICS.describe('download_retries_total', 'Download retries after a transient failure')
+METRICS.describe('download_resumed_total', 'Interrupted downloads resumed with a range request')
+METRICS.describe('album_zip_fallbacks_total', 'Albums downloaded as a zip instead of being expanded into images')
+METRICS.describe('download_redirect_depth', 'Number of redirects followed per url', buckets=COUNT_BUCKETS)
+METRICS.describe('download_request_seconds', 'Time until the response headers of a download request arrived')
+METRICS.describe('downloads_in_flight', 'Downloads running')
+METRICS.describe('download_queue_length', 'Download jobs waiting in the queue')
+METRICS.describe('download_concurrency_limit', 'Current adaptive concurrency limit of the download engine')
+METRICS.describe('extraction_files_total', 'Archived submission files parsed by the extraction')
+METRICS.describe('extraction_urls_total', 'Imgur urls written by the extraction')
+METRICS.describe('extraction_stage_seconds', 'Time spent in each stage of the extraction of a subreddit')
+
+
+class MetricsFileWriter:
+    """
+    Background thread rewriting a metrics file every few seconds
+    """
+
+    def __init__(self, path, interval=15, metrics=METRICS):
+        """
+        :param path: The file to write, Prometheus text format if it ends with '.prom', json otherwise
+        :param interval: The number of seconds between two writes
+        :param metrics: The registry to write
+        """
+        self.path = path
+        self.interval = interval
+        self.metrics = metrics
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def write(self):
+        """
+        Atomically write the current metrics
+
+        :return: None
+        """
+        data = self.metrics.to_prometheus() if self.path.endswith('.prom') else self.metrics.to_json()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(data)
+        os.replace(self.path + '.tmp', self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the thread and write the final metrics
+
+        :return: None
+        """
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+
+class PeriodicSummary:
+    """
+    Background thread passing the summary of the metrics to a callback every 'interval' seconds
+    """
+
+    def __init__(self, notify, interval, metrics=METRICS):
+        """
+        :param notify: A function called with the summary text
+        :param interval: The number of seconds between two summaries
+        :param metrics: The registry to summarize
+        """
+        self.notify = notify
+        self.interval = interval
+        self.metrics = metrics
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.notify(self.metrics.summary())
+            except Exception as e:
+                # A failed notification should not stop the pipeline or the next summaries
+                print(f"WARNING: could not send the metrics summary - {e}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves '/metrics' in the Prometheus text format and '/metrics.json'
+    """
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = self.server.metrics.to_prometheus(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = self.server.metrics.to_json(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port, host='127.0.0.1', metrics=METRICS):
+    """
+    Serve the metrics over http from a background thread
+
+    :param port: The port to listen on
+    :param host: The address to listen on
+    :param metrics: The registry to serve
+    :return: The ThreadingHTTPServer, call shutdown() to stop it
+    """
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+_exporters = None
+
+
+def start_exporters_from_environment():
+    """
+    Start the exporters configured with the METRICS_FILE, METRICS_INTERVAL, METRICS_PORT and METRICS_HOST
+    environment variables, once per process
+
+    :return: The list of started exporters
+    """
+    global _exporters
+    if _exporters is not None:
+        return _exporters
+    _exporters = []
+    if os.getenv('METRICS_FILE'):
+        writer = MetricsFileWriter(os.environ['METRICS_FILE'],
+                                   interval=float(os.getenv('METRICS_INTERVAL', 15))).start()
+        # Write the final metrics before exiting, the last interval would be lost otherwise
+        atexit.register(writer.stop)
+        _exporters.append(writer)
+    if os.getenv('METRICS_PORT'):
+        _exporters.append(serve_metrics(int(os.environ['METRICS_PORT']), host=os.getenv('METRICS_HOST', '127.0.0.1')))
+    return _exporters
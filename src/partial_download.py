@@ -0,0 +1,161 @@
+# Resumable partial downloads.
+#
+# While a file downloads, its body is written to '<file>.part' and a '<file>.part.json' sidecar records the url,
+# the validator (ETag or Last-Modified) and the expected length of the body. When the download is interrupted both
+# are kept, and the next attempt on the same url sends 'Range: bytes=<part size>-' with an 'If-Range' validator:
+# - 206 Partial Content starting at the part size: the body is appended to the part
+# - 200 OK: the server ignores ranges or the file changed, the part is overwritten from the start
+# - 416 Range Not Satisfiable: the part does not match the file anymore, it is dropped
+# Responses without a validator, or with 'Accept-Ranges: none', are not resumable and their part is removed on failure.
+
+import json
+import os
+import re
+
+
+PART_EXTENSION = '.part'
+PART_METADATA_EXTENSION = '.part.json'
+CONTENT_RANGE_PATTERN = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+def get_part_path(file_path):
+    """
+    :param file_path: The final path of the file
+    :return: The path the body is written to while it downloads
+    """
+    return file_path + PART_EXTENSION
+
+
+def get_metadata_path(file_path):
+    """
+    :param file_path: The final path of the file
+    :return: The path of the metadata sidecar of the part
+    """
+    return file_path + PART_METADATA_EXTENSION
+
+
+def load_part_metadata(file_path):
+    """
+    Load the metadata of the part of a file
+
+    :param file_path: The final path of the file
+    :return: The metadata dictionary, or None if there is no usable part
+    """
+    metadata_path = get_metadata_path(file_path)
+    if not os.path.exists(metadata_path) or not os.path.exists(get_part_path(file_path)):
+        return None
+    try:
+        with open(metadata_path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        # A sidecar cut short by a crash
+        return None
+
+
+def save_part_metadata(file_path, metadata):
+    """
+    Atomically save the metadata of the part of a file
+
+    :param file_path: The final path of the file
+    :param metadata: The metadata dictionary
+    :return: None
+    """
+    metadata_path = get_metadata_path(file_path)
+    with open(metadata_path + '.tmp', 'w') as f:
+        json.dump(metadata, f)
+    os.replace(metadata_path + '.tmp', metadata_path)
+
+
+def remove_part(file_path, keep_data=False):
+    """
+    Remove the part of a file and its metadata
+
+    :param file_path: The final path of the file
+    :param keep_data: Only remove the metadata, e.g. when the part was already moved
+    :return: None
+    """
+    paths = [get_metadata_path(file_path)] if keep_data else [get_part_path(file_path), get_metadata_path(file_path)]
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def get_resume_headers(file_path, url):
+    """
+    Get the headers requesting the rest of an interrupted download
+
+    :param file_path: The final path of the file
+    :param url: The url about to be requested
+    :return: A dictionary with the Range and If-Range headers, empty if there is nothing to resume for this url
+    """
+    metadata = load_part_metadata(file_path)
+    if metadata is None or metadata['url'] != url:
+        return {}
+    size = os.path.getsize(get_part_path(file_path))
+    if size == 0 or (metadata['length'] is not None and size >= metadata['length']):
+        return {}
+    return {'Range': f'bytes={size}-', 'If-Range': metadata['etag'] or metadata['last_modified']}
+
+
+def parse_content_range(value):
+    """
+    Parse a Content-Range header
+
+    :param value: The header value, e.g. 'bytes 100-199/1000'
+    :return: A (first byte, last byte, total length or None) tuple, or None if the value is not a byte range
+    """
+    match = CONTENT_RANGE_PATTERN.match(value.strip()) if value else None
+    if match is None:
+        return None
+    first, last, total = match.groups()
+    return int(first), int(last), int(total) if total != '*' else None
+
+
+def get_resume_offset(res, file_path):
+    """
+    Get the offset of a partial response in the part of a file
+
+    :param res: A 206 response
+    :param file_path: The final path of the file
+    :return: The number of bytes of the part the body continues, or None if it does not continue the part
+    """
+    content_range = parse_content_range(res.headers.get('Content-Range'))
+    part_path = get_part_path(file_path)
+    if content_range is None or not os.path.exists(part_path) or content_range[0] != os.path.getsize(part_path):
+        return None
+    return content_range[0]
+
+
+def get_total_length(res):
+    """
+    Get the length of the whole file of a response
+
+    :param res: A 200 or 206 response
+    :return: The number of bytes, None if unknown
+    """
+    if res.status_code == 206:
+        content_range = parse_content_range(res.headers.get('Content-Range'))
+        return content_range[2] if content_range is not None else None
+    if 'Content-Length' in res.headers:
+        return int(res.headers['Content-Length'])
+    return None
+
+
+def get_part_metadata(res, url):
+    """
+    Get the metadata needed to resume the download of a response
+
+    :param res: A 200 or 206 response
+    :param url: The requested url
+    :return: The metadata dictionary, or None if the download cannot be resumed
+    """
+    etag = res.headers.get('ETag')
+    last_modified = res.headers.get('Last-Modified')
+    # If-Range needs a strong ETag, or a Last-Modified date
+    if etag is not None and etag.startswith('W/'):
+        etag = None
+    if (etag is None and last_modified is None) or res.headers.get('Accept-Ranges', '').lower() == 'none':
+        return None
+    return {'url': url, 'etag': etag, 'last_modified': last_modified, 'length': get_total_length(res)}
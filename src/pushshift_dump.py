@@ -0,0 +1,278 @@
+# Streaming ingestion of the Pushshift monthly submission dumps ('RS_YYYY-MM.zst', zstd compressed NDJSON).
+#
+# A dump is decompressed as a stream and read one line at a time, so memory stays the same whatever the size
+# of the dump. The submissions of the wanted subreddits are picked with a set lookup on the lowercased
+# 'subreddit' field, read from the raw bytes of the line without decoding it, and staged as plain json lines, one
+# file per subreddit:
+#   <staging folder>/<dump name>/<subreddit>.jsonl
+# The dumps are filtered in parallel, one month per process, and the staged submissions are then written by a
+# single process in month order (see reddit.ingest_dumps), so the parallel months never write to the same
+# archive files.
+# The links of a month are appended to the link files after their sizes are recorded, so the links of a month that
+# was interrupted are cut off again before it is ingested again (see rollback_staged_links).
+
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import zstandard
+
+from submission_json import get_imgur_url_from_bytes, loads_json
+
+
+DUMP_NAME_PATTERN = re.compile(r'^RS_(\d{4})-(\d{2})\.zst$')
+# The dumps are compressed with long distance matching and need a window larger than the zstd default
+MAX_WINDOW_SIZE = 2 ** 31
+# Number of decompressed bytes read at a time
+READ_SIZE = 4 * 1024 * 1024
+# Number of staged bytes kept in memory before they are written to the staging files
+STAGING_BUFFER_SIZE = 16 * 1024 * 1024
+STAGING_EXTENSION = '.jsonl'
+# The dump whose links are being appended and the sizes of the link files before it, in the links folder
+LINK_OFFSETS_FILE_NAME = '.ingesting_links.json'
+# The 'subreddit' field of a json line. The crossposted submissions nested in a submission have one too.
+SUBREDDIT_FIELD_PATTERN = re.compile(rb'"subreddit":\s*"([^"]*)"')
+
+
+def list_dumps(dump_folder):
+    """
+    List the monthly submission dumps of a folder
+
+    :param dump_folder: The folder containing the 'RS_YYYY-MM.zst' files
+    :return: The sorted list of dump paths, oldest month first
+    """
+    return [os.path.join(dump_folder, name) for name in sorted(os.listdir(dump_folder))
+            if DUMP_NAME_PATTERN.match(name)]
+
+
+def load_subreddits(subreddits_path):
+    """
+    Load the list of subreddits to keep
+
+    :param subreddits_path: A text file with one subreddit per line, e.g. 'consolidated_subreddits.txt'
+    :return: A dictionary {lowercased subreddit: subreddit as written in the file}
+    """
+    with open(subreddits_path, 'r') as f:
+        return {line.strip().lower(): line.strip() for line in f if line.strip()}
+
+
+def iter_dump_lines(dump_path, read_size=READ_SIZE):
+    """
+    Stream the lines of a zstd compressed NDJSON dump
+
+    :param dump_path: The path of the dump
+    :param read_size: The number of decompressed bytes read at a time
+    :return: A generator of lines as bytes, without the line break
+    """
+    decompressor = zstandard.ZstdDecompressor(max_window_size=MAX_WINDOW_SIZE)
+    with open(dump_path, 'rb') as f, decompressor.stream_reader(f) as reader:
+        remainder = b''
+        while True:
+            chunk = reader.read(read_size)
+            if not chunk:
+                break
+            lines = (remainder + chunk).split(b'\n')
+            # The last line may continue in the next chunk
+            remainder = lines.pop()
+            for line in lines:
+                if line:
+                    yield line
+        if remainder:
+            yield remainder
+
+
+def get_subreddit_from_bytes(line):
+    """
+    Read the subreddit of a json encoded submission without decoding it
+
+    Only a single plain 'subreddit' field is read from the bytes. A line with several of them (crossposts), with an
+    escaped subreddit name, or that is not a whole json object, is decoded like before, so the result is the
+    same as decoding every line.
+
+    :param line: The json encoded submission as bytes
+    :return: The subreddit, None if the submission has none
+    :raise ValueError: If the line has to be decoded and is not valid json
+    """
+    if line.endswith(b'}'):
+        fields = SUBREDDIT_FIELD_PATTERN.findall(line)
+        if len(fields) == 1 and b'\\' not in fields[0]:
+            return fields[0].decode('utf-8', 'replace')
+    return loads_json(line).get('subreddit')
+
+
+def filter_dump(dump_path, subreddits, staging_folder, read_size=READ_SIZE):
+    """
+    Stage the submissions of a dump that belong to the wanted subreddits
+
+    :param dump_path: The path of the dump
+    :param subreddits: A dictionary {lowercased subreddit: subreddit}, see load_subreddits
+    :param staging_folder: The folder the '<subreddit>.jsonl' files are written to
+    :param read_size: The number of decompressed bytes read at a time
+    :return: A dictionary {subreddit: number of staged submissions}, with the number of lines that could not be
+        decoded under None. The staged lines are only decoded when they are written (see get_subreddit_from_bytes).
+    """
+    os.makedirs(staging_folder, exist_ok=True)
+    counts = {}
+    buffers = {}
+    buffered = 0
+
+    def flush():
+        nonlocal buffered
+        for subreddit, lines in buffers.items():
+            with open(os.path.join(staging_folder, subreddit + STAGING_EXTENSION), 'ab') as f:
+                f.write(b'\n'.join(lines) + b'\n')
+        buffers.clear()
+        buffered = 0
+
+    for line in iter_dump_lines(dump_path, read_size=read_size):
+        try:
+            subreddit = get_subreddit_from_bytes(line)
+        except ValueError:
+            counts[None] = counts.get(None, 0) + 1
+            continue
+        subreddit = subreddits.get((subreddit or '').lower())
+        if subreddit is None:
+            continue
+        buffers.setdefault(subreddit, []).append(line)
+        counts[subreddit] = counts.get(subreddit, 0) + 1
+        buffered += len(line)
+        if buffered >= STAGING_BUFFER_SIZE:
+            flush()
+    flush()
+    return counts
+
+
+def get_staging_folder(staging_root, dump_path):
+    """
+    :param staging_root: The folder containing the staging folders of all the dumps
+    :param dump_path: The path of the dump
+    :return: The staging folder of the dump
+    """
+    return os.path.join(staging_root, os.path.basename(dump_path)[:-len('.zst')])
+
+
+def filter_dumps(dump_paths, subreddits, staging_root, max_workers=None):
+    """
+    Filter several dumps in parallel, one dump per process
+
+    :param dump_paths: The paths of the dumps
+    :param subreddits: A dictionary {lowercased subreddit: subreddit}, see load_subreddits
+    :param staging_root: The folder the staging folder of each dump is created in
+    :param max_workers: The number of processes, one per cpu if None
+    :return: A generator of (dump path, staging folder, counts) tuples in the order of dump_paths, each one as soon
+        as its dump and the dumps before it are filtered
+    """
+    staging_folders = [get_staging_folder(staging_root, dump_path) for dump_path in dump_paths]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(filter_dump, dump_paths, [subreddits] * len(dump_paths), staging_folders)
+        for dump_path, staging_folder, counts in zip(dump_paths, staging_folders, results):
+            yield dump_path, staging_folder, counts
+
+
+def iter_staged_lines(staging_folder):
+    """
+    Iterate over the json lines staged for a dump
+
+    :param staging_folder: The staging folder of the dump
+    :return: A generator of (subreddit, json encoded submission) tuples, grouped by subreddit
+    """
+    for name in sorted(os.listdir(staging_folder)):
+        if not name.endswith(STAGING_EXTENSION):
+            continue
+        subreddit = name[:-len(STAGING_EXTENSION)]
+        with open(os.path.join(staging_folder, name), 'rb') as f:
+            for line in f:
+                yield subreddit, line
+
+
+def iter_staged_submissions(staging_folder):
+    """
+    Iterate over the submissions staged for a dump
+
+    :param staging_folder: The staging folder of the dump
+    :return: A generator of (subreddit, submission dictionary) tuples, grouped by subreddit
+    """
+    for subreddit, line in iter_staged_lines(staging_folder):
+        yield subreddit, loads_json(line)
+
+
+def rollback_staged_links(links_folder, ingested):
+    """
+    Cut the link files back to their sizes before a dump whose links were not all written
+
+    :param links_folder: The folder containing the '<subreddit>.txt' link files
+    :param ingested: The names of the dumps recorded as ingested
+    :return: The name of the dump whose links were removed, or None
+    """
+    offsets_path = os.path.join(links_folder, LINK_OFFSETS_FILE_NAME)
+    if not os.path.exists(offsets_path):
+        return None
+    with open(offsets_path, 'r') as f:
+        record = json.load(f)
+    dump_name = record['dump']
+    # A dump recorded as ingested was interrupted after it was recorded, its links are complete
+    if dump_name not in ingested:
+        for subreddit, size in record['sizes'].items():
+            link_path = os.path.join(links_folder, subreddit + '.txt')
+            if os.path.exists(link_path) and os.path.getsize(link_path) > size:
+                with open(link_path, 'r+b') as f:
+                    f.truncate(size)
+    os.remove(offsets_path)
+    return dump_name if dump_name not in ingested else None
+
+
+def clear_staged_links(links_folder):
+    """
+    Forget the sizes recorded by write_staged_links, once the dump is recorded as ingested
+
+    :param links_folder: The folder containing the '<subreddit>.txt' link files
+    :return: None
+    """
+    offsets_path = os.path.join(links_folder, LINK_OFFSETS_FILE_NAME)
+    if os.path.exists(offsets_path):
+        os.remove(offsets_path)
+
+
+def write_staged_links(staging_folder, links_folder):
+    """
+    Append the imgur links of the submissions staged for a dump to the link files of their subreddits
+
+    The links are filtered like imgur.get_imgur_urls_from_subreddit filters the archived submissions, and only the
+    submissions that may link to imgur are decoded.
+    The sizes of the link files are recorded first, call clear_staged_links once the dump is recorded as ingested
+    and rollback_staged_links before ingesting again after an interruption.
+
+    :param staging_folder: The staging folder of the dump
+    :param links_folder: The folder containing the '<subreddit>.txt' link files
+    :return: A dictionary {subreddit: number of links written}
+    """
+    os.makedirs(links_folder, exist_ok=True)
+    sizes = {}
+    for name in os.listdir(staging_folder):
+        if name.endswith(STAGING_EXTENSION):
+            link_path = os.path.join(links_folder, name[:-len(STAGING_EXTENSION)] + '.txt')
+            sizes[name[:-len(STAGING_EXTENSION)]] = os.path.getsize(link_path) if os.path.exists(link_path) else 0
+    offsets_path = os.path.join(links_folder, LINK_OFFSETS_FILE_NAME)
+    with open(offsets_path + '.tmp', 'w') as f:
+        json.dump({'dump': os.path.basename(staging_folder) + '.zst', 'sizes': sizes}, f)
+    os.replace(offsets_path + '.tmp', offsets_path)
+    written = {}
+    current = None
+    f = None
+    try:
+        for subreddit, line in iter_staged_lines(staging_folder):
+            if subreddit != current:
+                if f is not None:
+                    f.close()
+                current = subreddit
+                f = open(os.path.join(links_folder, subreddit + '.txt'), 'a')
+                written[subreddit] = 0
+            imgur_url = get_imgur_url_from_bytes(line)
+            if imgur_url is not None:
+                f.write(imgur_url + '\n')
+                written[subreddit] += 1
+    finally:
+        if f is not None:
+            f.close()
+    return written
@@ -2,25 +2,39 @@
 # The goal is to extract all the imgur links from a list of subreddits.
 
 # Import libraries
-from pmaw import PushshiftAPI
+from pmaw import PushshiftAPI, Request
 from dotenv import load_dotenv
 
 import datetime
+import functools
 import json
 import logging
 import os
 import logging.handlers
+import atexit
+import queue
 import praw
 import getpass
+import sys
+import threading
+import time
+import requests
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import apprise
 
+import archive_store
+import pushshift_dump
+
 
 load_dotenv()
 
 # Configure logging to log to both the console and a rotating log file named 'log.txt' in the 'Logs' directory
 # The log file will be rotated every 10 MB and will keep the 5 most recent logs
 # The log file will be encoded in UTF-8
+# The records are put in a queue and written by a background thread, so logging never blocks the archiving threads
 
 # Create the 'Logs' directory if it doesn't exist
 os.makedirs('Logs', exist_ok=True)
@@ -41,8 +55,17 @@ log_file_handler.setFormatter(log_format)
 # Set the console log handler format
 log_console_handler.setFormatter(log_format)
 
-# Create the logger
-logging.basicConfig(level=logging.INFO, handlers=[log_file_handler, log_console_handler])
+# Create the logger, its only handler puts the records in the queue
+log_queue = queue.SimpleQueue()
+log_queue_handler = logging.handlers.QueueHandler(log_queue)
+# Only merge the arguments into the message here, the listener's handlers apply the log format
+log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[log_queue_handler])
+# The listener thread formats the records and writes them to the file and the console
+log_listener = logging.handlers.QueueListener(log_queue, log_file_handler, log_console_handler)
+log_listener.start()
+# Write the records still in the queue before exiting
+atexit.register(log_listener.stop)
 
 
 # Function to log a message to the console and the log file
@@ -50,6 +73,71 @@ def log(message):
     logging.info(message)
 
 
+class ProgressLog:
+    """
+    Aggregated progress records of the submissions of a subreddit, instead of one record per submission
+
+    One record with the counts, the rate and the last submission id is logged every 'interval' seconds.
+    With sample_every > 0 the detail line of every 'sample_every'-th submission is logged as well.
+    """
+
+    def __init__(self, subreddit, interval=None, sample_every=None):
+        """
+        :param subreddit: The subreddit the submissions belong to
+        :param interval: The number of seconds between two progress records, defaults to the
+            LOG_PROGRESS_INTERVAL environment variable or 30
+        :param sample_every: Log the detail line of one submission out of this many, defaults to the
+            LOG_SAMPLE_EVERY environment variable or 0 (no detail lines)
+        """
+        self.subreddit = subreddit
+        self.interval = interval if interval is not None else float(os.getenv('LOG_PROGRESS_INTERVAL', 30))
+        self.sample_every = sample_every if sample_every is not None else int(os.getenv('LOG_SAMPLE_EVERY', 0))
+        self.written = 0
+        self.existing = 0
+        self.last_id = None
+        self.started = time.monotonic()
+        self._last_report = self.started
+        self._last_count = 0
+
+    def add(self, submission_id, is_new):
+        """
+        Count a submission and log a progress record if the interval elapsed
+
+        :param submission_id: The id of the submission
+        :param is_new: True if the submission was written, False if it already existed
+        :return: None
+        """
+        if is_new:
+            self.written += 1
+        else:
+            self.existing += 1
+        self.last_id = submission_id
+        count = self.written + self.existing
+        if self.sample_every > 0 and count % self.sample_every == 0:
+            if is_new:
+                log(f'Wrote submission {submission_id} of r/{self.subreddit}')
+            else:
+                log(f'Submission {submission_id} of r/{self.subreddit} already exists.')
+        now = time.monotonic()
+        if now - self._last_report >= self.interval:
+            self.report(now)
+
+    def report(self, now=None):
+        """
+        Log a progress record with the counts, the rate since the last record and the last submission id
+
+        :param now: The current time.monotonic()
+        :return: None
+        """
+        now = now if now is not None else time.monotonic()
+        count = self.written + self.existing
+        rate = (count - self._last_count) / max(now - self._last_report, 1e-9)
+        log(f'r/{self.subreddit}: {self.written} written, {self.existing} already archived, '
+            f'{rate:.1f} submissions/s, last id {self.last_id}')
+        self._last_report = now
+        self._last_count = count
+
+
 CLIENT_ID = os.getenv('CLIENT_ID')
 CLIENT_SECRET = os.getenv('CLIENT_SECRET')
 USER_AGENT = os.getenv('USER_AGENT')
@@ -165,10 +253,221 @@ def parse_multireddit_subreddits():
     log(f'Parsed {len(subreddits)} subreddits.')
 
 
+# Base url of a Pushshift compatible API, e.g. a local stand-in server for testing
+PUSHSHIFT_URL = os.getenv('PUSHSHIFT_URL')
+
+
+class RateLimiter:
+    """
+    Thread safe limiter spacing requests evenly to a maximum number of requests per minute
+    """
+
+    def __init__(self, requests_per_minute):
+        """
+        :param requests_per_minute: The maximum number of requests per minute
+        """
+        self.requests_per_minute = requests_per_minute
+        self.interval = 60 / requests_per_minute
+        self._lock = threading.Lock()
+        self._next_time = time.monotonic()
+
+    def wait(self):
+        """
+        Block until the next request is allowed
+
+        :return: None
+        """
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ThreadSafeRequest(Request):
+    """
+    pmaw Request that only installs its exit signal handlers on the main thread
+
+    pmaw installs them on every search, which raises an error when subreddits are archived from worker threads.
+    """
+
+    def check_sigs(self):
+        if threading.current_thread() is threading.main_thread():
+            super().check_sigs()
+
+
+# pmaw creates its Request objects from the PushshiftAPIBase module
+# (the 'pmaw.PushshiftAPIBase' attribute is shadowed by the class of the same name, so go through sys.modules)
+sys.modules['pmaw.PushshiftAPIBase'].Request = ThreadSafeRequest
+
+
+class SharedBudgetPushshiftAPI(PushshiftAPI):
+    """
+    PushshiftAPI that shares a rate limiter and a worker budget with the other instances
+
+    Every request waits for the shared rate limiter and holds one slot of the shared worker semaphore,
+    so several subreddits archived at the same time never exceed the global limits together.
+    """
+
+    def __init__(self, rate_limiter=None, worker_budget=None, **kwargs):
+        """
+        :param rate_limiter: A RateLimiter shared by all the instances
+        :param worker_budget: A threading.Semaphore limiting the requests in flight across all the instances
+        :param kwargs: The PushshiftAPI arguments
+        """
+        super().__init__(**kwargs)
+        self.rate_limiter = rate_limiter
+        self.worker_budget = worker_budget
+        if PUSHSHIFT_URL is not None:
+            self._base_url = PUSHSHIFT_URL.rstrip('/') + '/{{endpoint}}'
+
+    def _impose_rate_limit(self):
+        super()._impose_rate_limit()
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait()
+
+    def _get(self, url, payload={}):
+        if self.worker_budget is None:
+            return super()._get(url, payload)
+        with self.worker_budget:
+            return super()._get(url, payload)
+
+
+def estimate_subreddit_size(subreddit, rate_limiter=None):
+    """
+    Estimate the number of submissions of a subreddit from the Pushshift search metadata
+
+    :param subreddit: The subreddit
+    :param rate_limiter: A RateLimiter shared with the other requests to Pushshift
+    :return: The estimated number of submissions, or 0 if it could not be estimated
+    """
+    base_url = PUSHSHIFT_URL.rstrip('/') if PUSHSHIFT_URL is not None else 'https://api.pushshift.io'
+    if rate_limiter is not None:
+        rate_limiter.wait()
+    try:
+        r = requests.get(f'{base_url}/reddit/submission/search',
+                         params={'subreddit': subreddit, 'size': 0, 'metadata': 'true'},
+                         timeout=30)
+        r.raise_for_status()
+        return int(r.json()['metadata']['es']['hits']['total']['value'])
+    except (requests.RequestException, KeyError, TypeError, ValueError) as e:
+        log(f'Could not estimate the size of r/{subreddit}: {e}')
+        return 0
+
+
+# Earliest created_utc searched for, reddit went online in June 2005
+REDDIT_EPOCH = 1118000000
+
+
+def merge_ranges(ranges):
+    """
+    Merge overlapping and adjacent [since, until) ranges
+
+    :param ranges: A list of [since, until] pairs
+    :return: A sorted list of disjoint [since, until] pairs
+    """
+    merged = []
+    for since, until in sorted(ranges):
+        if merged and since <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], until)
+        else:
+            merged.append([since, until])
+    return merged
+
+
+def get_missing_ranges(covered, since, until):
+    """
+    Get the parts of [since, until) that are not covered yet
+
+    :param covered: A sorted list of disjoint [since, until] pairs
+    :param since: The start of the range
+    :param until: The end of the range
+    :return: A list of [since, until] pairs
+    """
+    missing = []
+    for covered_since, covered_until in covered:
+        if covered_since > since:
+            missing.append([since, min(covered_since, until)])
+        since = max(since, covered_until)
+        if since >= until:
+            break
+    if since < until:
+        missing.append([since, until])
+    return missing
+
+
+def load_checkpoint(subreddit_folder):
+    """
+    Load the checkpoint of a subreddit archive
+
+    The checkpoint file './Archive/subreddit/.checkpoint' records the created_utc ranges that were
+    completely archived: {"covered": [[since, until], ...]}
+
+    :param subreddit_folder: The folder containing the subreddit archive
+    :return: A sorted list of disjoint [since, until] pairs
+    """
+    checkpoint_path = os.path.join(subreddit_folder, '.checkpoint')
+    if not os.path.exists(checkpoint_path):
+        return []
+    with open(checkpoint_path, 'r') as f:
+        return merge_ranges(json.load(f)['covered'])
+
+
+def save_checkpoint(subreddit_folder, covered):
+    """
+    Atomically save the checkpoint of a subreddit archive
+
+    :param subreddit_folder: The folder containing the subreddit archive
+    :param covered: A list of [since, until] pairs
+    :return: None
+    """
+    os.makedirs(subreddit_folder, exist_ok=True)
+    checkpoint_path = os.path.join(subreddit_folder, '.checkpoint')
+    with open(checkpoint_path + '.tmp', 'w') as f:
+        json.dump({'covered': merge_ranges(covered)}, f)
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+
+def write_submission_file(subreddit, submission):
+    """
+    Write a submission to its own json file with the path format './Archive/subreddit/YYYY/MM/YYYY-MM-DD_submission_id.json'
+
+    :param subreddit: The subreddit of the submission
+    :param submission: The submission dictionary
+    :return: True if the submission was written, False if it already existed
+    """
+    # Get the date of the submission
+    submission_date = datetime.datetime.fromtimestamp(submission['created_utc'])
+    # Get the year and month of the submission
+    submission_year = submission_date.strftime('%Y')
+    submission_month = submission_date.strftime('%m')
+    # Create the path to the submission file relative to the current directory
+    submission_path = f'./Archive/{subreddit}/{submission_year}/{submission_month}/' \
+                      f'{submission_year}-{submission_month}-{str(submission_date.day).rjust(2, "0")}' \
+                      f'_{submission["id"]}.json'
+    # Create the directory if it doesn't exist
+    os.makedirs(os.path.dirname(submission_path), exist_ok=True)
+    # Check if the submission has already been archived
+    if os.path.exists(submission_path):
+        return False
+    # Write the submission to the path with pretty formatting and create the file if it doesn't exist
+    with open(submission_path, 'w+') as f:
+        json.dump(submission, f, indent=2)
+    return True
+
+
 # Function to archive a given subreddit
-# The function will get all the submissions from the subreddit in separate requests for each month
+# The function will get all the submissions from the subreddit in separate requests for each time window
 # The function will then write each submission to a text file with the path format 'subreddit/YYYY-MM/submission_id.json'
-def archive_subreddit(subreddit):
+def archive_subreddit(subreddit,
+                      storage='files',
+                      num_workers=None,
+                      rate_limiter=None,
+                      worker_budget=None,
+                      progress=None,
+                      window_days=90,
+                      ingest_delay=24 * 60 * 60):
     """
     This function archives a given subreddit submissions from the Pushshift API.
 
@@ -176,46 +475,94 @@ def archive_subreddit(subreddit):
 
     The function will then write each submission to a text file with the path format  './Archive/subreddit/YYYY/MM/YYYY-MM-DD_submission_id.json'
 
+    With storage='segments' the submissions are instead appended to one compressed segment per month
+    with the path format './Archive/subreddit/YYYY-MM.jsonl.gz' (see archive_store.py).
+
+    The submissions are requested in time windows of window_days. After a window is written it is recorded in
+    the checkpoint of the subreddit (see load_checkpoint), so an interrupted run resumes at the first missing
+    window, and a later run only requests the submissions newer than the last covered window. A window pmaw did not
+    get completely is not recorded.
+
     :param subreddit: The subreddit to archive
+    :param storage: The storage backend, either 'files' or 'segments'
+    :param num_workers: The number of pmaw worker threads, defaults to 5 per cpu
+    :param rate_limiter: A RateLimiter shared with the other subreddits archived at the same time
+    :param worker_budget: A threading.Semaphore shared with the other subreddits archived at the same time
+    :param progress: A function called with (subreddit, number of submissions written so far)
+    :param window_days: The number of days requested and checkpointed at a time
+    :param ingest_delay: The number of seconds Pushshift may take to ingest a submission, the most recent
+        submissions are only recorded as covered once they are older than this
     :return: None
     """
-    # Skip if the subreddit folder already exists
-    if os.path.exists(f'./Archive/{subreddit}'):
-        log(f'r/{subreddit} already exists.')
-        return
+    subreddit_folder = f'./Archive/{subreddit}'
+    covered = load_checkpoint(subreddit_folder)
+    archive_until = int(time.time()) - ingest_delay
+    missing = get_missing_ranges(covered, REDDIT_EPOCH, archive_until)
+    if covered:
+        log(f'r/{subreddit} is archived until {datetime.datetime.fromtimestamp(covered[-1][1])}, '
+            f'{len(missing)} range(s) missing.')
     log(f'Archiving r/{subreddit}')
     # Initialize the API
-    api = PushshiftAPI(
-        num_workers=os.cpu_count() * 5,
+    api = SharedBudgetPushshiftAPI(
+        rate_limiter=rate_limiter,
+        worker_budget=worker_budget,
+        num_workers=num_workers if num_workers is not None else os.cpu_count() * 5,
+        # Let the shared rate limiter be the one that limits the requests
+        rate_limit=rate_limiter.requests_per_minute if rate_limiter is not None else 60,
         file_checkpoint=10,
         # jitter='full'
     )
-    # Get the submissions from the subreddit
-    submissions = api.search_submissions(subreddit=subreddit,
-                                         mem_safe=True,
-                                         safe_exit=True)
-    # Write the submissions to a json file with the path format './Archive/subreddit/YYYY/MM/YYYY-MM-DD_submission_id.json'
-    for submission in submissions:
-        # Get the date of the submission
-        submission_date = datetime.datetime.fromtimestamp(submission['created_utc'])
-        # Get the year and month of the submission
-        submission_year = submission_date.strftime('%Y')
-        submission_month = submission_date.strftime('%m')
-        # Create the path to the submission file relative to the current directory
-        submission_path = f'./Archive/{subreddit}/{submission_year}/{submission_month}/' \
-                          f'{submission_year}-{submission_month}-{str(submission_date.day).rjust(2, "0")}' \
-                          f'_{submission["id"]}.json'
-        # Create the directory if it doesn't exist
-        os.makedirs(os.path.dirname(submission_path), exist_ok=True)
-        # Check if the submission has already been archived
-        if os.path.exists(submission_path):
-            log(f'Submission {submission["id"]} already exists.')
-            continue
-        # Write the submission to the path with pretty formatting and create the file if it doesn't exist
-        with open(submission_path, 'w+') as f:
-            json.dump(submission, f, indent=2)
-        # Print the submission path
-        log(f'Wrote submission {submission["id"]} to {submission_path}')
+    if progress is not None:
+        progress(subreddit, 0)
+    written = 0
+    # One progress record per interval instead of one record per submission
+    progress_log = ProgressLog(subreddit)
+    writer = archive_store.SegmentWriter(subreddit_folder) if storage == 'segments' else None
+    window = window_days * 24 * 60 * 60
+    try:
+        for missing_since, missing_until in missing:
+            for since in range(missing_since, missing_until, window):
+                until = min(since + window, missing_until)
+                # Get the submissions from the subreddit
+                # pmaw installs signal handlers for safe_exit, which is only possible on the main thread
+                submissions = api.search_submissions(subreddit=subreddit,
+                                                     since=since,
+                                                     until=until,
+                                                     mem_safe=True,
+                                                     safe_exit=threading.current_thread() is threading.main_thread())
+                for submission in submissions:
+                    if writer is not None:
+                        # Append the submissions to the compressed monthly segments
+                        is_new = writer.append(submission)
+                    else:
+                        # Write the submissions to a json file with the path format './Archive/subreddit/YYYY/MM/YYYY-MM-DD_submission_id.json'
+                        is_new = write_submission_file(subreddit, submission)
+                    progress_log.add(submission['id'], is_new)
+                    if is_new:
+                        written += 1
+                        if progress is not None:
+                            progress(subreddit, written)
+                # Only record the window once everything in it is on disk
+                if writer is not None:
+                    writer.flush()
+                # pmaw returns early when it is interrupted, with the failed requests put back in its request list
+                # and the number of results it did not get left in its limit. Such a window stays missing and is
+                # requested again. The requests still listed once the limit is reached are not needed.
+                unfinished = len(api.req.req_list)
+                remaining = api.req.limit if api.req.limit is not None else 0
+                if api.req.exit.is_set() or remaining > 0:
+                    log(f'WARNING: r/{subreddit} is incomplete from {datetime.datetime.fromtimestamp(since)} to '
+                        f'{datetime.datetime.fromtimestamp(until)} ({unfinished} unfinished requests, '
+                        f'{remaining} submissions missing), it will be requested again')
+                    continue
+                covered.append([since, until])
+                save_checkpoint(subreddit_folder, covered)
+    finally:
+        if writer is not None:
+            writer.close()
+    if progress_log.last_id is not None:
+        progress_log.report()
+    log(f'Wrote {written} submissions of r/{subreddit} to {subreddit_folder}')
 
 
 def get_imgur_links(subreddit):
@@ -246,15 +593,161 @@ def get_imgur_links(subreddit):
     return imgur_links
 
 
-def run():
+def ingest_dumps(dump_folder,
+                 storage='files',
+                 links_folder='./data/subreddit_links',
+                 subreddits_path='consolidated_subreddits.txt',
+                 max_workers=None):
+    """
+    Archive the subreddits in 'consolidated_subreddits.txt' from the Pushshift monthly dumps instead of the API
+
+    The dumps are streamed and filtered in parallel, one month per process (see pushshift_dump.py), then the kept
+    submissions are written month by month:
+    - storage='files': one json file per submission, like archive_subreddit
+    - storage='segments': the compressed monthly segments of archive_store.py
+    - storage='links': only the imgur links, appended to '<links_folder>/<subreddit>.txt'. The links of a dump
+      that was interrupted are removed before it is ingested again.
+    The ingested dumps are recorded in a '.ingested_dumps' file in the output folder and skipped by the next runs.
+
+    :param dump_folder: The folder containing the 'RS_YYYY-MM.zst' dumps
+    :param storage: The output, either 'files', 'segments' or 'links'
+    :param links_folder: The folder of the link files with storage='links'
+    :param subreddits_path: The text file with one subreddit per line
+    :param max_workers: The number of dumps filtered at the same time, one per cpu if None
+    :return: A dictionary {subreddit: number of submissions or links written}
+    """
+    output_folder = links_folder if storage == 'links' else './Archive'
+    os.makedirs(output_folder, exist_ok=True)
+    ingested_path = os.path.join(output_folder, '.ingested_dumps')
+    ingested = set()
+    if os.path.exists(ingested_path):
+        with open(ingested_path, 'r') as f:
+            ingested = set(f.read().splitlines())
+    dump_paths = [dump_path for dump_path in pushshift_dump.list_dumps(dump_folder)
+                  if os.path.basename(dump_path) not in ingested]
+    subreddits = pushshift_dump.load_subreddits(subreddits_path)
+    if storage == 'links':
+        interrupted = pushshift_dump.rollback_staged_links(links_folder, ingested)
+        if interrupted is not None:
+            log(f'Removed the links of the interrupted dump {interrupted}, it is ingested again')
+    log(f'Ingesting {len(dump_paths)} dump(s) from {dump_folder} for {len(subreddits)} subreddits '
+        f'({len(ingested)} already ingested)')
+    written = {}
+    # The staging folder is next to the output, on the same disk, and only holds the submissions of the kept
+    # subreddits. It is not inside the output, where it would look like a subreddit folder.
+    staging_root = tempfile.mkdtemp(prefix='.dump_staging_', dir=os.path.dirname(os.path.abspath(output_folder)))
+    try:
+        for dump_path, staging_folder, counts in pushshift_dump.filter_dumps(dump_paths, subreddits, staging_root,
+                                                                             max_workers=max_workers):
+            dump_name = os.path.basename(dump_path)
+            if counts.get(None):
+                log(f'WARNING: {counts[None]} line(s) of {dump_name} could not be decoded')
+            if storage == 'links':
+                dump_written = pushshift_dump.write_staged_links(staging_folder, links_folder)
+            else:
+                dump_written = {}
+                writers = {}
+                try:
+                    for subreddit, submission in pushshift_dump.iter_staged_submissions(staging_folder):
+                        if storage == 'segments':
+                            if subreddit not in writers:
+                                writers[subreddit] = archive_store.SegmentWriter(f'./Archive/{subreddit}')
+                            is_new = writers[subreddit].append(submission)
+                        else:
+                            is_new = write_submission_file(subreddit, submission)
+                        if is_new:
+                            dump_written[subreddit] = dump_written.get(subreddit, 0) + 1
+                finally:
+                    for writer in writers.values():
+                        writer.close()
+            shutil.rmtree(staging_folder)
+            # Only record the dump once everything in it is on disk
+            with open(ingested_path, 'a') as f:
+                f.write(dump_name + '\n')
+            if storage == 'links':
+                pushshift_dump.clear_staged_links(links_folder)
+            for subreddit, count in dump_written.items():
+                written[subreddit] = written.get(subreddit, 0) + count
+            log(f'Ingested {dump_name}: {sum(dump_written.values())} written out of '
+                f'{sum(count for subreddit, count in counts.items() if subreddit is not None)} kept submissions')
+    finally:
+        shutil.rmtree(staging_root)
+    return written
+
+
+def run(storage='files',
+        max_concurrent=4,
+        total_workers=None,
+        requests_per_minute=60,
+        report_interval=60):
+    """
+    Archive all the subreddits in 'consolidated_subreddits.txt', several at a time
+
+    The subreddits are ordered by their estimated number of submissions, largest first, so the big ones
+    start early and the small ones fill the gaps at the end. All the subreddits being archived share
+    one rate limit and one budget of requests in flight.
+    The archiving only starts once every subreddit is estimated: the estimates take one request each under the
+    shared rate limit, e.g. about a minute for 60 subreddits at 60 requests per minute.
+
+    :param storage: The storage backend, either 'files' or 'segments'
+    :param max_concurrent: The number of subreddits archived at the same time
+    :param total_workers: The number of Pushshift requests in flight across all subreddits, defaults to 5 per cpu
+    :param requests_per_minute: The Pushshift requests per minute across all subreddits
+    :param report_interval: The number of seconds between progress reports
+    :return: None
+    """
     # Get the list of subreddits from a text file named 'subreddits.txt'
     with open('consolidated_subreddits.txt', 'r') as f:
         subreddits = f.read().splitlines()
         # print(subreddits)
-    # Archive all the subreddits
-    for subreddit in subreddits:
-        # Archive the subreddit
-        archive_subreddit(subreddit)
+    if total_workers is None:
+        total_workers = os.cpu_count() * 5
+    # The size estimates count against the same rate limit as the archiving
+    rate_limiter = RateLimiter(requests_per_minute)
+    worker_budget = threading.Semaphore(total_workers)
+    # Estimate the size of every subreddit and archive the largest ones first
+    log(f'Estimating the size of {len(subreddits)} subreddits before archiving them')
+    with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        sizes = dict(zip(subreddits, executor.map(functools.partial(estimate_subreddit_size,
+                                                                    rate_limiter=rate_limiter),
+                                                  subreddits)))
+    subreddits = sorted(subreddits, key=lambda subreddit: sizes[subreddit], reverse=True)
+    written = {}
+    finished = threading.Event()
+
+    def update_progress(subreddit, count):
+        written[subreddit] = count
+
+    def report_progress():
+        while not finished.wait(report_interval):
+            # The finished subreddits are removed from another thread, the pairs are copied at once
+            active = ', '.join(f'r/{subreddit}: {count}/~{sizes[subreddit]}'
+                               for subreddit, count in list(written.items()))
+            if active:
+                log(f'Archiving progress - {active}')
+
+    reporter = threading.Thread(target=report_progress, daemon=True)
+    reporter.start()
+    # Archive the subreddits, max_concurrent at a time
+    with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        futures = {executor.submit(archive_subreddit,
+                                   subreddit,
+                                   storage=storage,
+                                   # Split the budget, more threads would only wait for the semaphore
+                                   num_workers=max(1, -(-total_workers // max_concurrent)),
+                                   rate_limiter=rate_limiter,
+                                   worker_budget=worker_budget,
+                                   progress=update_progress): subreddit
+                   for subreddit in subreddits}
+        for future in as_completed(futures):
+            subreddit = futures[future]
+            try:
+                future.result()
+                log(f'Finished r/{subreddit} ({written.pop(subreddit, 0)} submissions written)')
+            except Exception as e:
+                written.pop(subreddit, None)
+                log(f'ERROR: archiving r/{subreddit} failed: {e}')
+    finished.set()
     # # Get all the imgur links from the subreddits
     # for subreddit in subreddits:
     #     # print(subreddit)
@@ -262,4 +755,9 @@ def run():
 
 
 if __name__ == '__main__':
-    run()
+    # PUSHSHIFT_DUMPS=<folder of the monthly dumps> archives from the dumps instead of the API,
+    # DUMP_STORAGE=files|segments|links picks the output
+    if os.getenv('PUSHSHIFT_DUMPS'):
+        ingest_dumps(os.environ['PUSHSHIFT_DUMPS'], storage=os.getenv('DUMP_STORAGE', 'files'))
+    else:
+        run()
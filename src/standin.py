@@ -0,0 +1,417 @@
+# Local stand-in servers used to test and benchmark the pipelines without touching the real services.
+#
+# PushshiftStandin answers '/reddit/submission/search' like the Pushshift API does for pmaw:
+# results sorted by created_utc descending, 'since'/'until' time slices, 'size' limits and the
+# metadata pmaw uses to count the remaining results of a slice.
+#
+# Point reddit.py at it with the PUSHSHIFT_URL environment variable, e.g.:
+#   server = standin.PushshiftStandin({'pics': submissions}).start()
+#   os.environ['PUSHSHIFT_URL'] = server.url
+#
+# ImgurStandin imitates imgur.com and i.imgur.com: images, '.png' page urls redirected to i.imgur.com,
+# album zips, single image albums redirected to a '/download' url that answers 403, removed images
+# redirected to 'removed.png' and per host rate limits answered with 429 and Retry-After.
+# The download engine keeps requesting the real imgur urls through RewritingTransport, which sends them to
+# the stand-in; the stand-in tells the hosts apart by the Host header.
+#
+# WastebinStandin stores the posted texts in memory and serves them back like Wastebin.
+
+import io
+import json
+import threading
+import time
+import zipfile
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import httpx
+
+
+class StandinRequestHandler(BaseHTTPRequestHandler):
+    """
+    Request handler dispatching to the 'handle_<method>' function of the stand-in server
+    """
+
+    # Keep the connections alive like the real services do
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.standin.handle_request(self, 'GET')
+
+    def do_HEAD(self):
+        self.server.standin.handle_request(self, 'HEAD')
+
+    def do_POST(self):
+        self.server.standin.handle_request(self, 'POST')
+
+    def log_message(self, format, *args):
+        # Keep the benchmark and test output clean
+        pass
+
+
+class StandinServer:
+    """
+    Base class of the stand-in servers, running a threaded http server in the background
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        """
+        :param host: The address to listen on
+        :param port: The port to listen on, 0 picks a free port
+        """
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    def start(self):
+        """
+        Start the server in a background thread
+
+        :return: The stand-in server
+        """
+        self._server = ThreadingHTTPServer((self.host, self.port), StandinRequestHandler)
+        self._server.daemon_threads = True
+        self._server.standin = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the server
+
+        :return: None
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def handle_request(self, handler, method):
+        with self._lock:
+            self.requests += 1
+        url = urlparse(handler.path)
+        self.handle(handler, method, url.path, {key: values[-1] for key, values in parse_qs(url.query).items()})
+
+    def handle(self, handler, method, path, query):
+        self.send(handler, 404, b'Not Found')
+
+    @staticmethod
+    def send(handler, status, body=b'', headers=None, method='GET'):
+        """
+        Send a complete response
+
+        :param handler: The request handler
+        :param status: The http status code
+        :param body: The response body as bytes
+        :param headers: A dictionary with additional headers
+        :param method: The request method, the body is not sent for HEAD requests
+        :return: None
+        """
+        handler.send_response(status)
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        if method != 'HEAD':
+            handler.wfile.write(body)
+
+    @staticmethod
+    def send_json(handler, data, status=200):
+        StandinServer.send(handler, status, json.dumps(data).encode('utf-8'),
+                           headers={'Content-Type': 'application/json'})
+
+
+class PushshiftStandin(StandinServer):
+    """
+    Pushshift compatible submission search over an in-memory set of submissions
+    """
+
+    def __init__(self, submissions_by_subreddit, latency=0.0, host='127.0.0.1', port=0):
+        """
+        :param submissions_by_subreddit: A dictionary {subreddit: [submission dictionaries]}
+        :param latency: The number of seconds each search request takes
+        :param host: The address to listen on
+        :param port: The port to listen on, 0 picks a free port
+        """
+        super().__init__(host=host, port=port)
+        self.latency = latency
+        # Keep the submissions sorted newest first, like the sort=created_utc&order=desc queries of pmaw
+        self.submissions = {subreddit.lower(): sorted(submissions, key=lambda s: s['created_utc'], reverse=True)
+                            for subreddit, submissions in submissions_by_subreddit.items()}
+
+    def handle(self, handler, method, path, query):
+        if path.rstrip('/') != '/reddit/submission/search':
+            self.send(handler, 404, b'Not Found')
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        submissions = self.submissions.get(query.get('subreddit', '').lower(), [])
+        since = int(query['since']) if 'since' in query else None
+        until = int(query['until']) if 'until' in query else None
+        matches = [submission for submission in submissions
+                   if (since is None or submission['created_utc'] >= since)
+                   and (until is None or submission['created_utc'] < until)]
+        size = int(query.get('size', 100))
+        # The created_utc range of the query, in milliseconds, where pmaw looks for it
+        ranges = []
+        if since is not None:
+            ranges.append({'range': {'created_utc': {'gte': since * 1000}}})
+        if until is not None:
+            ranges.append({'range': {'created_utc': {'lt': until * 1000}}})
+        self.send_json(handler, {
+            'data': matches[:size],
+            'metadata': {
+                'es': {'hits': {'total': {'value': len(matches)}},
+                       '_shards': {'total': 1, 'successful': 1}},
+                'es_query': {'query': {'bool': {'must': [{'bool': {'must': ranges}}]}}},
+            },
+        })
+
+
+class ImgurStandin(StandinServer):
+    """
+    imgur.com, i.imgur.com and api.imgur.com stand-in serving generated images, album zips and album manifests
+
+    The fate of an id is derived from its crc32, so the same id always behaves the same way.
+    """
+
+    def __init__(self,
+                 image_size=256 * 1024,
+                 removed_ratio=0.05,
+                 single_image_album_ratio=0.5,
+                 album_size=3,
+                 requests_per_second=None,
+                 latency=0.0,
+                 range_support=True,
+                 host='127.0.0.1',
+                 port=0):
+        """
+        :param image_size: The number of bytes of each image
+        :param removed_ratio: The share of ids redirected to the removed image
+        :param single_image_album_ratio: The share of albums redirected to a '/download' url instead of a zip,
+            the API lists a single image for them
+        :param album_size: The number of images in the zip and the manifest of an album
+        :param requests_per_second: The rate limit of each host, answered with 429, no limit if None
+        :param latency: The number of seconds each request takes before the response starts
+        :param range_support: Answer the Range requests of images with 206, or ignore them like some servers do
+        :param host: The address to listen on
+        :param port: The port to listen on, 0 picks a free port
+        """
+        super().__init__(host=host, port=port)
+        self.range_support = range_support
+        self.image_size = image_size
+        self.removed_ratio = removed_ratio
+        self.single_image_album_ratio = single_image_album_ratio
+        self.album_size = album_size
+        self.requests_per_second = requests_per_second
+        self.latency = latency
+        self.status_codes = {}
+        # Token bucket of each host: {host: (tokens, last refill time)}
+        self._buckets = {}
+
+    def _fate(self, imgur_id):
+        return (zlib.crc32(imgur_id.encode('utf-8')) % 10000) / 10000
+
+    def image(self, imgur_id, size=None):
+        """
+        Get the generated content of an image
+
+        :param imgur_id: The imgur id
+        :param size: The number of bytes, defaults to image_size
+        :return: The image bytes
+        """
+        size = self.image_size if size is None else size
+        pattern = imgur_id.encode('utf-8') + b'\n'
+        return (pattern * (size // len(pattern) + 1))[:size]
+
+    def album_zip(self, imgur_id):
+        """
+        Get the zip of an album
+
+        :param imgur_id: The album id
+        :return: The zip bytes
+        """
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+            for i in range(self.album_size):
+                archive.writestr(f"{imgur_id}_{i}.jpg", self.image(f"{imgur_id}_{i}", self.image_size // self.album_size))
+        return buffer.getvalue()
+
+    def album_images(self, imgur_id):
+        """
+        Get the manifest of an album as listed by the API
+
+        :param imgur_id: The album id
+        :return: The list of image dictionaries
+        """
+        count = 1 if self._fate(imgur_id[::-1]) < self.single_image_album_ratio else self.album_size
+        return [{'id': f"{imgur_id}{i}", 'type': 'image/jpeg', 'link': f"https://i.imgur.com/{imgur_id}{i}.jpg"}
+                for i in range(count)]
+
+    def _allow(self, host):
+        if self.requests_per_second is None:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            tokens, last = self._buckets.get(host, (self.requests_per_second, now))
+            tokens = min(self.requests_per_second, tokens + (now - last) * self.requests_per_second)
+            allowed = tokens >= 1
+            self._buckets[host] = (tokens - 1 if allowed else tokens, now)
+            return allowed
+
+    def respond_image(self, handler, method, imgur_id):
+        """
+        Send an image, or the requested range of it if range requests are supported
+
+        :param handler: The request handler
+        :param method: The request method
+        :param imgur_id: The imgur id
+        :return: None
+        """
+        body = self.image(imgur_id)
+        etag = f'"{zlib.crc32(body):08x}"'
+        headers = {'Content-Type': 'image/jpeg', 'ETag': etag,
+                   'Accept-Ranges': 'bytes' if self.range_support else 'none'}
+        range_header = handler.headers.get('Range', '')
+        if self.range_support and range_header.startswith('bytes=') and handler.headers.get('If-Range', etag) == etag:
+            first, _, last = range_header[len('bytes='):].partition('-')
+            first = int(first)
+            last = min(int(last) if last else len(body) - 1, len(body) - 1)
+            if first >= len(body):
+                self.respond(handler, method, 416, headers={'Content-Range': f'bytes */{len(body)}'})
+                return
+            headers['Content-Range'] = f'bytes {first}-{last}/{len(body)}'
+            self.respond(handler, method, 206, body[first:last + 1], headers=headers)
+            return
+        self.respond(handler, method, 200, body, headers=headers)
+
+    def respond(self, handler, method, status, body=b'', headers=None):
+        with self._lock:
+            self.status_codes[status] = self.status_codes.get(status, 0) + 1
+        self.send(handler, status, body, headers=headers, method=method)
+
+    def handle(self, handler, method, path, query):
+        if self.latency:
+            time.sleep(self.latency)
+        host = handler.headers.get('Host', '').split(':')[0]
+        if not self._allow(host):
+            self.respond(handler, method, 429, headers={'Retry-After': '1'})
+            return
+        parts = [part for part in path.split('/') if part]
+        if host == 'api.imgur.com':
+            if not handler.headers.get('Authorization', '').startswith('Client-ID '):
+                self.respond(handler, method, 401, b'Unauthorized')
+                return
+            # /3/album/<id>/images and /3/gallery/<id>
+            if len(parts) >= 3 and parts[1] in ('album', 'gallery') and self._fate(parts[2]) >= self.removed_ratio:
+                images = self.album_images(parts[2])
+                data = images if parts[1] == 'album' else {'id': parts[2], 'is_album': True, 'images': images}
+                self.respond(handler, method, 200, json.dumps({'data': data, 'success': True}).encode('utf-8'),
+                             headers={'Content-Type': 'application/json'})
+                return
+            self.respond(handler, method, 404, json.dumps({'data': {'error': 'Not found'}, 'success': False})
+                         .encode('utf-8'), headers={'Content-Type': 'application/json'})
+            return
+        if host == 'i.imgur.com' and len(parts) == 1:
+            name = parts[0]
+            if name == 'removed.png':
+                self.respond(handler, method, 200, self.image('removed', 503), headers={'Content-Type': 'image/png'})
+                return
+            imgur_id = name.split('.')[0]
+            if self._fate(imgur_id) < self.removed_ratio:
+                self.respond(handler, method, 302, headers={'Location': 'https://i.imgur.com/removed.png'})
+                return
+            self.respond_image(handler, method, imgur_id)
+            return
+        if host == 'imgur.com':
+            if len(parts) == 3 and parts[0] == 'a' and parts[2] == 'zip':
+                imgur_id = parts[1]
+                if self._fate(imgur_id) < self.removed_ratio:
+                    self.respond(handler, method, 302, headers={'Location': 'https://i.imgur.com/removed.png'})
+                elif self._fate(imgur_id[::-1]) < self.single_image_album_ratio:
+                    self.respond(handler, method, 302, headers={'Location': f'https://imgur.com/download/{imgur_id}/'})
+                else:
+                    self.respond(handler, method, 200, self.album_zip(imgur_id),
+                                 headers={'Content-Type': 'application/zip'})
+                return
+            if parts and parts[0] == 'download':
+                self.respond(handler, method, 403, b'Forbidden')
+                return
+            if len(parts) == 1 and '.' in parts[0]:
+                self.respond(handler, method, 302, headers={'Location': f'https://i.imgur.com/{parts[0]}'})
+                return
+        self.respond(handler, method, 404, b'Not Found')
+
+
+class WastebinStandin(StandinServer):
+    """
+    Wastebin stand-in keeping the posted texts in memory
+    """
+
+    def __init__(self, latency=0.0, host='127.0.0.1', port=0):
+        """
+        :param latency: The number of seconds each post takes
+        :param host: The address to listen on
+        :param port: The port to listen on, 0 picks a free port
+        """
+        super().__init__(host=host, port=port)
+        self.latency = latency
+        self.pastes = {}
+
+    def handle(self, handler, method, path, query):
+        if method == 'POST':
+            if self.latency:
+                time.sleep(self.latency)
+            data = json.loads(handler.rfile.read(int(handler.headers.get('Content-Length', 0))))
+            with self._lock:
+                paste_id = f"{len(self.pastes):08x}"
+                self.pastes[paste_id] = data['text']
+            self.send_json(handler, {'path': f'/{paste_id}'})
+            return
+        paste_id = path.strip('/')
+        if paste_id not in self.pastes:
+            self.send(handler, 404, b'Not Found', method=method)
+            return
+        self.send(handler, 200, self.pastes[paste_id].encode('utf-8'), headers={'Content-Type': 'text/plain'},
+                  method=method)
+
+
+class RewritingTransport(httpx.AsyncBaseTransport):
+    """
+    httpx transport sending every request to a stand-in server, keeping the original Host header
+
+    It also records the time until the response headers of each request arrived.
+    """
+
+    def __init__(self, target_url, transport=None):
+        """
+        :param target_url: The url of the stand-in server
+        :param transport: The transport actually sending the requests, a new httpx.AsyncHTTPTransport if None
+        """
+        self.target = httpx.URL(target_url)
+        self.transport = transport if transport is not None else httpx.AsyncHTTPTransport()
+        self.latencies = []
+
+    async def handle_async_request(self, request):
+        request.url = request.url.copy_with(scheme=self.target.scheme, host=self.target.host, port=self.target.port)
+        started = time.perf_counter()
+        response = await self.transport.handle_async_request(request)
+        self.latencies.append(time.perf_counter() - started)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
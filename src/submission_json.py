@@ -0,0 +1,66 @@
+# Decoding of the archived submissions and the test for an imgur link, shared by the link extraction in imgur.py
+# and the dump ingestion in pushshift_dump.py.
+# It only depends on the standard library (and orjson when installed), so the worker processes filtering the dumps
+# do not import the whole downloader.
+
+import json
+
+# orjson is optional, it only makes decoding the archived submissions faster
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def get_imgur_url_from_submission(submission, filter_moderated=True):
+    """
+    Get the imgur url from a submission dictionary
+
+    :param submission: The submission dictionary
+    :param filter_moderated: Whether to filter out moderated submissions
+    :return: The imgur url
+    """
+    if filter_moderated:
+        if "removed_by_category" in submission.keys():
+            if submission["removed_by_category"] is not None:
+                return None
+    if 'domain' in submission.keys() and 'url' in submission.keys():
+        if submission['domain'] is not None and submission['url'] is not None:
+            if 'imgur' in submission['domain'] and 'imgur' in submission['url']:
+                return submission['url']
+    return None
+
+
+def loads_json(data):
+    """
+    Decode a json document, using orjson when it is installed
+
+    orjson is stricter than the json module (e.g. NaN or integers larger than 64 bits), so documents it
+    rejects are decoded again with the json module to get exactly the same result.
+
+    :param data: The json document as bytes
+    :return: The decoded document
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def get_imgur_url_from_bytes(data, filter_moderated=True):
+    """
+    Get the imgur url from a json encoded submission
+
+    Most submissions do not link to imgur, so the raw bytes are checked first and only documents that contain
+    'imgur' are decoded. A document without the literal bytes could still spell it with \\u00XX escapes,
+    so documents containing such escapes are decoded as well. This gives the same result as decoding everything.
+
+    :param data: The json encoded submission as bytes
+    :param filter_moderated: Whether to filter out moderated submissions
+    :return: The imgur url
+    """
+    if b'imgur' not in data and b'\\u00' not in data:
+        return None
+    return get_imgur_url_from_submission(loads_json(data), filter_moderated)
@@ -0,0 +1,245 @@
+# Adaptive throttling for the async download engine.
+#
+# TokenBucket spaces the requests to one host. Its rate grows additively while the host answers normally
+# and is halved when the host throttles (429/503), honoring Retry-After.
+# AdaptiveConcurrency limits the number of downloads in flight. It adds a slot when latency and error
+# rate stay low and halves the limit when the server throttles (AIMD, like TCP congestion control).
+# Throttle combines both for the download engine.
+
+import asyncio
+import email.utils
+import time
+from urllib.parse import urlparse
+
+
+# Status codes that mean the server wants us to slow down
+THROTTLE_STATUS_CODES = (429, 503)
+# Starting (requests per second, burst) of each host
+DEFAULT_HOST_RATES = {
+    'imgur.com': (2, 4),
+    'i.imgur.com': (10, 20),
+}
+DEFAULT_RATE = (5, 10)
+
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header
+
+    :param value: The header value, either a number of seconds or an http date
+    :return: The number of seconds to wait, or None if the header is missing or invalid
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class TokenBucket:
+    """
+    Token bucket with an additive increase / multiplicative decrease rate
+    """
+
+    def __init__(self, rate, burst=None, min_rate=0.1, max_rate=None):
+        """
+        :param rate: The starting number of requests per second
+        :param burst: The number of requests that can be sent at once after an idle period
+        :param min_rate: The lowest rate the bucket backs off to
+        :param max_rate: The highest rate the bucket grows to, defaults to 10 times the starting rate
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate if max_rate is not None else rate * 10
+        # Grow by a twentieth of the starting rate per successful request
+        self.increase = rate / 20
+        self.tokens = self.burst
+        self.blocked_until = 0.0
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    async def acquire(self):
+        """
+        Wait until a request may be sent
+
+        :return: None
+        """
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_success(self):
+        """
+        Grow the rate after a normal response
+
+        :return: None
+        """
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self, retry_after=None):
+        """
+        Halve the rate and pause the bucket after the server throttled a request
+
+        :param retry_after: The number of seconds the server asked us to wait
+        :return: None
+        """
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = 0
+        pause = retry_after if retry_after is not None else 1 / self.rate
+        self.blocked_until = max(self.blocked_until, time.monotonic() + pause)
+
+
+class AdaptiveConcurrency:
+    """
+    Limit of concurrent downloads that adjusts itself to the latency and error rate of the server
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=32, window=20, max_error_rate=0.1):
+        """
+        :param initial: The starting number of concurrent downloads
+        :param minimum: The lowest number of concurrent downloads
+        :param maximum: The highest number of concurrent downloads
+        :param window: The number of responses evaluated before the limit is changed
+        :param max_error_rate: The error rate above which the limit is decreased
+        """
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.active = 0
+        self._responses = 0
+        self._errors = 0
+        self._latency = None
+        self._best_latency = None
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def _set_limit(self, limit):
+        self.limit = max(self.minimum, min(self.maximum, limit))
+        self._responses = 0
+        self._errors = 0
+
+    def on_response(self, latency, error=False):
+        """
+        Record a response and add a slot at the end of a healthy window
+
+        A window is healthy when the error rate is low and the average latency is less than twice the best
+        average latency seen so far.
+
+        :param latency: The number of seconds until the response headers arrived
+        :param error: Whether the response was an error
+        :return: None
+        """
+        self._responses += 1
+        self._errors += int(error)
+        self._latency = latency if self._latency is None else 0.8 * self._latency + 0.2 * latency
+        if self._responses < self.window:
+            return
+        if self._best_latency is None or self._latency < self._best_latency:
+            self._best_latency = self._latency
+        if self._errors / self._responses > self.max_error_rate:
+            self._set_limit(self.limit - 1)
+        elif self._latency < 2 * self._best_latency:
+            self._set_limit(self.limit + 1)
+        else:
+            self._set_limit(self.limit)
+
+    def on_throttle(self):
+        """
+        Halve the limit after the server throttled a request
+
+        :return: None
+        """
+        self._set_limit(self.limit // 2)
+
+
+class Throttle:
+    """
+    Per host token buckets and an adaptive concurrency limit shared by all the download workers
+    """
+
+    def __init__(self, max_concurrency=32, initial_concurrency=4, host_rates=None):
+        """
+        :param max_concurrency: The highest number of concurrent downloads
+        :param initial_concurrency: The starting number of concurrent downloads
+        :param host_rates: A dictionary {host: (requests per second, burst)} with the starting rates
+        """
+        self.host_rates = dict(DEFAULT_HOST_RATES)
+        self.host_rates.update(host_rates or {})
+        self.buckets = {}
+        self.concurrency = AdaptiveConcurrency(initial=min(initial_concurrency, max_concurrency),
+                                               maximum=max_concurrency)
+
+    def bucket(self, url):
+        """
+        Get the token bucket of the host of a url
+
+        :param url: The url
+        :return: The TokenBucket of the host
+        """
+        host = urlparse(url).netloc
+        if host not in self.buckets:
+            rate, burst = self.host_rates.get(host, DEFAULT_RATE)
+            self.buckets[host] = TokenBucket(rate, burst)
+        return self.buckets[host]
+
+    async def before_request(self, url):
+        """
+        Wait until a request to the host of a url may be sent
+
+        :param url: The url
+        :return: None
+        """
+        await self.bucket(url).acquire()
+
+    def on_response(self, url, status_code, latency, headers=None, throttled=False):
+        """
+        Update the rates with the outcome of a request
+
+        :param url: The requested url
+        :param status_code: The status code of the response
+        :param latency: The number of seconds until the response headers arrived
+        :param headers: The response headers, used for Retry-After
+        :param throttled: Treat the response as throttling even if the status code does not say so
+        :return: True if the server throttled the request
+        """
+        bucket = self.bucket(url)
+        if throttled or status_code in THROTTLE_STATUS_CODES:
+            retry_after = parse_retry_after(headers.get('Retry-After')) if headers is not None else None
+            bucket.on_throttle(retry_after)
+            self.concurrency.on_throttle()
+            return True
+        bucket.on_success()
+        self.concurrency.on_response(latency, error=status_code >= 500)
+        return False
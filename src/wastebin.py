@@ -0,0 +1,111 @@
+# Helpers for the Wastebin pastes the crawljobs point to.
+#
+# The uploads share one pooled requests.Session that retries throttled and failed requests.
+# PasteCache remembers the paste of every uploaded text by its sha256, so a crawljob regenerated from the same
+# urls reuses the pastes that have not expired yet instead of uploading them again.
+
+import hashlib
+import json
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+DEFAULT_CACHE_PATH = './data/wastebin_cache.json'
+
+
+def create_session(pool_size=8, retries=3):
+    """
+    Create the pooled session shared by the uploads
+
+    :param pool_size: The number of connections kept open
+    :param retries: The number of retries of a failed or throttled request
+    :return: A requests.Session
+    """
+    retry = Retry(total=retries,
+                  backoff_factor=1,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=None,
+                  respect_retry_after_header=True)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_text_hash(text, extension=None):
+    """
+    Get the key of a text in the paste cache
+
+    :param text: The text of the paste
+    :param extension: The file extension of the paste
+    :return: The hex sha256 of the extension and the text
+    """
+    content_hash = hashlib.sha256()
+    content_hash.update(f"{extension or ''}\n".encode('utf-8'))
+    content_hash.update(text.encode('utf-8'))
+    return content_hash.hexdigest()
+
+
+class PasteCache:
+    """
+    Persistent {text hash: paste url and expiry time} cache of the uploaded pastes
+    """
+
+    def __init__(self, cache_path=DEFAULT_CACHE_PATH):
+        """
+        :param cache_path: The path of the json file the cache is stored in
+        """
+        self.cache_path = cache_path
+        self._pastes = {}
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r') as f:
+                self._pastes = json.load(f)
+        # Forget the expired pastes
+        now = time.time()
+        self._pastes = {key: paste for key, paste in self._pastes.items() if paste['expires_at'] > now}
+
+    def get(self, text_hash, min_ttl=0):
+        """
+        Get the url of a cached paste
+
+        :param text_hash: The key of the text, see get_text_hash
+        :param min_ttl: The number of seconds the paste must still be available for
+        :return: The url of the paste, or None if there is no paste valid for long enough
+        """
+        paste = self._pastes.get(text_hash)
+        if paste is None or paste['expires_at'] - time.time() < min_ttl:
+            return None
+        return paste['url']
+
+    def add(self, text_hash, url, expires):
+        """
+        Remember a paste
+
+        :param text_hash: The key of the text, see get_text_hash
+        :param url: The url of the paste
+        :param expires: The number of seconds from now the paste expires
+        :return: None
+        """
+        self._pastes[text_hash] = {'url': url, 'expires_at': time.time() + expires}
+
+    def save(self):
+        """
+        Write the cache to disk
+
+        :return: None
+        """
+        os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+        with open(self.cache_path + '.tmp', 'w') as f:
+            json.dump(self._pastes, f)
+        os.replace(self.cache_path + '.tmp', self.cache_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.save()
@@ -0,0 +1,277 @@
+# Shared work queue spreading the downloads over several downloader containers.
+#
+# The queue is a SQLite file on a volume shared by the containers (e.g. /data). Every job is a file to download,
+# so a file is queued once whatever the number of urls pointing to it. A worker claims a batch of pending jobs
+# with a lease: the jobs are its own until the lease expires, and a background thread renews the leases of the
+# jobs it still holds (heartbeat). A completed job is recorded once and never handed out again, except a transient
+# failure which is queued again until it was claimed MAX_CLAIMS times. The jobs of a crashed worker are reclaimed by
+# the other workers when their lease expires.
+#
+# Job states:
+#   pending - waiting to be claimed
+#   leased  - claimed by 'owner' until 'lease_expires'
+#   done    - finished with 'outcome'
+
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+
+DEFAULT_QUEUE_PATH = './data/work_queue.sqlite'
+DEFAULT_LEASE_SECONDS = 300
+# Number of claims after which a job failing with a transient error is done for good
+MAX_CLAIMS = 3
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+
+
+def connect(queue_path, check_same_thread=True):
+    """
+    Open the queue database
+
+    :param queue_path: The path of the SQLite database
+    :param check_same_thread: Only allow the thread opening the connection to use it
+    :return: A sqlite3 connection in autocommit mode, transactions are started explicitly
+    """
+    os.makedirs(os.path.dirname(queue_path) or '.', exist_ok=True)
+    # Wait for the other workers instead of failing while they hold the write lock
+    db = sqlite3.connect(queue_path, timeout=60, isolation_level=None, check_same_thread=check_same_thread)
+    db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+               'file_path TEXT PRIMARY KEY, url TEXT NOT NULL, state TEXT NOT NULL, owner TEXT, '
+               'lease_expires REAL, claims INTEGER NOT NULL DEFAULT 0, outcome TEXT, updated REAL)')
+    db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_expires)')
+    return db
+
+
+class WorkQueue:
+    """
+    Lease based queue of (url, file path) download jobs shared by several processes
+
+    The methods block while another worker holds the write lock of the database, the download engine calls them from
+    a thread of its own instead of its event loop. The connection is shared by the threads of a worker and used by
+    one of them at a time.
+    """
+
+    def __init__(self, queue_path=DEFAULT_QUEUE_PATH, lease_seconds=DEFAULT_LEASE_SECONDS, worker_id=None,
+                 max_claims=MAX_CLAIMS):
+        """
+        :param queue_path: The path of the SQLite database, on a volume shared by the workers
+        :param lease_seconds: The number of seconds a claimed job stays reserved without a heartbeat
+        :param worker_id: The name of this worker, defaults to the host name and a random suffix
+        :param max_claims: The number of claims after which a job failing with a transient error is done
+        """
+        self.queue_path = queue_path
+        self.lease_seconds = lease_seconds
+        self.worker_id = worker_id or f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        self.max_claims = max_claims
+        self._db = connect(queue_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._heartbeat_stop = threading.Event()
+        self._heartbeat_thread = None
+
+    def add(self, urls_and_file_paths, batch_size=10000):
+        """
+        Queue jobs, the files already queued or done are left as they are
+
+        :param urls_and_file_paths: An iterable of (url, file path) tuples
+        :param batch_size: The number of jobs inserted per transaction
+        :return: The number of jobs added
+        """
+        added = 0
+        batch = []
+        for url, file_path in urls_and_file_paths:
+            batch.append((file_path, url, PENDING, time.time()))
+            if len(batch) >= batch_size:
+                added += self._add_batch(batch)
+                batch = []
+        if batch:
+            added += self._add_batch(batch)
+        return added
+
+    def _add_batch(self, batch):
+        with self._lock:
+            before = self._db.total_changes
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.executemany('INSERT OR IGNORE INTO jobs (file_path, url, state, updated) VALUES (?, ?, ?, ?)',
+                                     batch)
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            return self._db.total_changes - before
+
+    def adopt(self, urls_and_file_paths):
+        """
+        Queue jobs found while working on a claimed job (e.g. the images of an album) already leased to this worker,
+        so they are reclaimed by another worker if this one crashes before finishing them
+
+        :param urls_and_file_paths: An iterable of (url, file path) tuples
+        :return: The list of the (url, file path) tuples that were not queued yet, the others belong to another job
+        """
+        now = time.time()
+        adopted = []
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                for url, file_path in urls_and_file_paths:
+                    cursor = self._db.execute('INSERT OR IGNORE INTO jobs (file_path, url, state, owner, '
+                                              'lease_expires, claims, updated) VALUES (?, ?, ?, ?, ?, 1, ?)',
+                                              (file_path, url, LEASED, self.worker_id, now + self.lease_seconds, now))
+                    if cursor.rowcount == 1:
+                        adopted.append((url, file_path))
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        return adopted
+
+    def claim(self, batch_size=100):
+        """
+        Lease a batch of pending jobs, or of jobs whose lease expired
+
+        :param batch_size: The maximum number of jobs claimed
+        :return: A list of (url, file path) tuples, empty when there is nothing left to claim
+        """
+        now = time.time()
+        with self._lock:
+            # The write lock is taken up front, so two workers never claim the same jobs
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                jobs = self._db.execute('SELECT file_path, url FROM jobs '
+                                        'WHERE state = ? OR (state = ? AND lease_expires < ?) LIMIT ?',
+                                        (PENDING, LEASED, now, batch_size)).fetchall()
+                self._db.executemany('UPDATE jobs SET state = ?, owner = ?, lease_expires = ?, claims = claims + 1, '
+                                     'updated = ? WHERE file_path = ?',
+                                     [(LEASED, self.worker_id, now + self.lease_seconds, now, file_path)
+                                      for file_path, url in jobs])
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        return [(url, file_path) for file_path, url in jobs]
+
+    def iter_claims(self, batch_size=100):
+        """
+        Claim batches of jobs until the queue is drained
+
+        :param batch_size: The number of jobs claimed at a time
+        :return: A generator of (url, file path) tuples, the next batch is only claimed when the previous is consumed
+        """
+        while True:
+            jobs = self.claim(batch_size)
+            if not jobs:
+                return
+            yield from jobs
+
+    def complete(self, file_path, outcome, retry=False):
+        """
+        Record the outcome of a job, once
+
+        Completing a job twice, or a job that is not in the queue (e.g. an image of an expanded album), does nothing.
+        A job to retry is queued again for any worker to claim, unless it was already claimed max_claims times.
+
+        :param file_path: The file path of the job
+        :param outcome: The outcome of the download
+        :param retry: The job failed with a transient error and can be tried again later
+        :return: True if the job was completed by this call, False if it was queued again or was not held
+        """
+        now = time.time()
+        with self._lock:
+            if retry:
+                cursor = self._db.execute('UPDATE jobs SET state = ?, outcome = ?, owner = NULL, lease_expires = NULL, '
+                                          'updated = ? WHERE file_path = ? AND state != ? AND claims < ?',
+                                          (PENDING, outcome, now, file_path, DONE, self.max_claims))
+                if cursor.rowcount == 1:
+                    return False
+            cursor = self._db.execute('UPDATE jobs SET state = ?, outcome = ?, owner = ?, lease_expires = NULL, '
+                                      'updated = ? WHERE file_path = ? AND state != ?',
+                                      (DONE, outcome, self.worker_id, now, file_path, DONE))
+            return cursor.rowcount == 1
+
+    def heartbeat(self, db=None):
+        """
+        Renew the leases of the jobs held by this worker
+
+        :param db: The connection to use, the connection of the queue if None
+        :return: The number of leases renewed
+        """
+        if db is None:
+            with self._lock:
+                return self.heartbeat(self._db)
+        cursor = db.execute('UPDATE jobs SET lease_expires = ? WHERE state = ? AND owner = ?',
+                            (time.time() + self.lease_seconds, LEASED, self.worker_id))
+        return cursor.rowcount
+
+    def _run_heartbeat(self, interval):
+        # A connection of its own, so the heartbeat never waits for the engine
+        db = connect(self.queue_path)
+        try:
+            while not self._heartbeat_stop.wait(interval):
+                self.heartbeat(db)
+        finally:
+            db.close()
+
+    def start_heartbeat(self, interval=None):
+        """
+        Renew the leases of this worker from a background thread
+
+        :param interval: The number of seconds between two renewals, a third of the lease by default
+        :return: None
+        """
+        self._heartbeat_stop.clear()
+        self._heartbeat_thread = threading.Thread(target=self._run_heartbeat,
+                                                  args=(interval or self.lease_seconds / 3,),
+                                                  daemon=True)
+        self._heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        """
+        Stop renewing the leases, the jobs still held expire and are reclaimed by the other workers
+
+        :return: None
+        """
+        if self._heartbeat_thread is not None:
+            self._heartbeat_stop.set()
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+
+    def release(self):
+        """
+        Give back the jobs held by this worker right away, e.g. when it stops before finishing them
+
+        :return: The number of jobs released
+        """
+        with self._lock:
+            cursor = self._db.execute('UPDATE jobs SET state = ?, owner = NULL, lease_expires = NULL, updated = ? '
+                                      'WHERE state = ? AND owner = ?', (PENDING, time.time(), LEASED, self.worker_id))
+            return cursor.rowcount
+
+    def counts(self):
+        """
+        Count the jobs in each state
+
+        :return: A dictionary {state: number of jobs}
+        """
+        with self._lock:
+            return dict(self._db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+
+    def close(self):
+        """
+        Stop the heartbeat and close the database
+
+        :return: None
+        """
+        self.stop_heartbeat()
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()